@@ -0,0 +1,245 @@
+'''
+Dense origin x destination matrix store
+- one float32 (orig x dest) array per metric, plus the origin and destination
+  id arrays, saved as .npy files that are opened memory-mapped
+- replaces reading long-format (id_orig, id_dest, distance, ...) tables back
+  from SQL for the nearest distance and optimisation scripts
+'''
+import os
+import shutil
+import numpy as np
+import pandas as pd
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# where the matrices are kept: {matrix_directory}/{state}/{table_name}/
+matrix_directory = '/homedirs/man112/access_inequality_index/data/matrix'
+
+
+def path(state, table_name):
+    return os.path.join(matrix_directory, state, table_name)
+
+
+def _ids(ids):
+    '''
+    an id array as it is stored: object ids (e.g. geoid strings from
+    postgres) become strings, which .npy files hold without pickling
+    '''
+    ids = np.asarray(ids)
+    return ids.astype(str) if ids.dtype == object else ids
+
+
+def _lookup(ids, stored):
+    '''
+    ids converted to the dtype of the stored ids they are looked up in
+    '''
+    ids = np.atleast_1d(ids)
+    if stored.dtype.kind == 'U':
+        return ids.astype(str)
+    if stored.dtype.kind in 'iuf':
+        # ids that are not numbers become nan and match nothing
+        return pd.to_numeric(pd.Series(ids, dtype=object), errors='coerce').values
+    return ids
+
+
+class AccessMatrix:
+    '''
+    float32 origin x destination matrices sharing two id index arrays
+    '''
+    def __init__(self, orig_ids, dest_ids, values):
+        self.orig_ids = _ids(orig_ids)
+        self.dest_ids = _ids(dest_ids)
+        # dict of metric: (orig x dest) array (possibly a memmap)
+        self.values = values
+        self._dest_pos = None
+        self._orig_pos = None
+
+    ############## Storage ##############
+    @classmethod
+    def create(cls, directory, orig_ids, dest_ids, metrics):
+        '''
+        new matrix on disk, filled with nan, to be written tile by tile
+        '''
+        os.makedirs(directory, exist_ok=True)
+        orig_ids, dest_ids = _ids(orig_ids), _ids(dest_ids)
+        np.save(os.path.join(directory, 'orig_ids.npy'), orig_ids)
+        np.save(os.path.join(directory, 'dest_ids.npy'), dest_ids)
+        values = {}
+        for metric in metrics:
+            values[metric] = np.lib.format.open_memmap(os.path.join(directory, '{}.npy'.format(metric)),
+                                                       mode='w+', dtype=np.float32,
+                                                       shape=(len(orig_ids), len(dest_ids)))
+            values[metric][:] = np.nan
+        return cls(orig_ids, dest_ids, values)
+
+    @classmethod
+    def open(cls, directory, mode='r'):
+        '''
+        memory-map a saved matrix; nothing is read until it is used
+        '''
+        orig_ids = np.load(os.path.join(directory, 'orig_ids.npy'))
+        dest_ids = np.load(os.path.join(directory, 'dest_ids.npy'))
+        values = {}
+        for fn in sorted(os.listdir(directory)):
+            metric = fn[:-4]
+            if fn.endswith('.npy') and metric not in ('orig_ids', 'dest_ids'):
+                values[metric] = np.load(os.path.join(directory, fn), mmap_mode=mode)
+        return cls(orig_ids, dest_ids, values)
+
+    @classmethod
+    def from_frame(cls, df, metrics, symmetric=False):
+        '''
+        matrix from a long-format (id_orig, id_dest, metrics...) frame
+        symmetric: the frame holds each pair once (see table_symmetric), the
+        other direction is filled in by mirroring
+        '''
+        if symmetric:
+            orig_ids, positions = np.unique(np.concatenate([df['id_orig'].values, df['id_dest'].values]), return_inverse=True)
+            orig_pos, dest_pos = np.split(positions.ravel(), 2)
+            dest_ids = orig_ids
+        else:
+            orig_ids, orig_pos = np.unique(df['id_orig'].values, return_inverse=True)
+            dest_ids, dest_pos = np.unique(df['id_dest'].values, return_inverse=True)
+        values = {}
+        for metric in metrics:
+            values[metric] = np.full((len(orig_ids), len(dest_ids)), np.nan, dtype=np.float32)
+            if symmetric:
+                values[metric][dest_pos, orig_pos] = pd.to_numeric(df[metric]).values
+            values[metric][orig_pos, dest_pos] = pd.to_numeric(df[metric]).values
+        return cls(orig_ids, dest_ids, values)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'orig_ids.npy'), self.orig_ids)
+        np.save(os.path.join(directory, 'dest_ids.npy'), self.dest_ids)
+        for metric, values in self.values.items():
+            np.save(os.path.join(directory, '{}.npy'.format(metric)), np.asarray(values, dtype=np.float32))
+
+    def write_tile(self, tile, values):
+        '''
+        store one table_query tile (see table_tiles.scatter)
+        '''
+        for metric, tile_values in values.items():
+            if tile.transpose:
+                tile_values = tile_values.T
+            self.values[metric][tile.orig_start:tile.orig_stop, tile.dest_start:tile.dest_stop] = tile_values
+
+    def flush(self):
+        for values in self.values.values():
+            if isinstance(values, np.memmap):
+                values.flush()
+
+    ############## Lookup ##############
+    def dest_index(self, dests):
+        '''
+        column positions of destination ids (ids not in the matrix are dropped)
+        '''
+        if self._dest_pos is None:
+            self._dest_pos = pd.Index(self.dest_ids)
+        cols = self._dest_pos.get_indexer(_lookup(dests, self.dest_ids))
+        return cols[cols >= 0]
+
+    def orig_index(self, origs):
+        '''
+        row positions of origin ids (-1 where an id is not in the matrix)
+        '''
+        if self._orig_pos is None:
+            self._orig_pos = pd.Index(self.orig_ids)
+        return self._orig_pos.get_indexer(_lookup(origs, self.orig_ids))
+
+    def column(self, dest, metric='distance'):
+        '''
+        one destination's values for every origin, indexed by origin id
+        '''
+        cols = self.dest_index(dest)
+        if len(cols) == 0:
+            raise KeyError(dest)
+        return pd.Series(self.values[metric][:, cols[0]], index=self.orig_ids, name=metric)
+
+    def subset(self, dests):
+        '''
+        in-memory matrix of the given destinations only
+        '''
+        cols = self.dest_index(dests)
+        return AccessMatrix(self.orig_ids, self.dest_ids[cols],
+                            {metric: np.asarray(values[:, cols]) for metric, values in self.values.items()})
+
+    def nearest(self, metric='distance', dests=None):
+        '''
+        per origin: the minimum of metric over dests (all if None) and the
+        destination it is reached at
+        '''
+        cols = slice(None) if dests is None else self.dest_index(dests)
+        values = np.asarray(self.values[metric][:, cols])
+        dest_ids = self.dest_ids[cols]
+        reachable = ~np.isnan(values).all(axis=1)
+        best = np.zeros(len(values), dtype=int)
+        best[reachable] = np.nanargmin(values[reachable], axis=1)
+        nearest_ids = dest_ids[best].astype(object)
+        nearest_ids[~reachable] = None
+        return pd.DataFrame({'id_orig': self.orig_ids,
+                             metric: np.where(reachable, values[np.arange(len(values)), best], np.nan),
+                             'id_dest': nearest_ids})
+
+    def frame(self):
+        '''
+        long-format (id_orig, id_dest, metrics...) frame, as the SQL tables hold
+        '''
+        df = pd.DataFrame({'id_orig': np.repeat(self.orig_ids, len(self.dest_ids)),
+                           'id_dest': np.tile(self.dest_ids, len(self.orig_ids))})
+        for metric, values in self.values.items():
+            df[metric] = np.asarray(values).ravel()
+        return df
+
+
+def load(state, table_name, db, metrics=('distance', 'duration'), mode=None, symmetric=False):
+    '''
+    open the saved matrix for a table; the first time, the table is read
+    from SQL and saved as a matrix so later loads skip the row parsing
+    mode: the transport mode to load from a multi-mode run's table
+    symmetric: the table holds the upper triangle only (see table_symmetric)
+    '''
+    directory = path(state, table_name if mode is None else '{}_{}'.format(table_name, mode))
+    if os.path.exists(os.path.join(directory, 'orig_ids.npy')):
+        return AccessMatrix.open(directory)
+    logger.info('No matrix saved for {}, converting it from SQL'.format(table_name))
+    if mode is None:
+        df = pd.read_sql('SELECT * FROM {}'.format(table_name), db['con'])
+    else:
+        df = pd.read_sql('SELECT * FROM {} WHERE mode = %s'.format(table_name), db['con'], params=(mode,))
+    matrix = AccessMatrix.from_frame(df, [m for m in metrics if m in df.columns], symmetric)
+    matrix.save(directory)
+    return AccessMatrix.open(directory)
+
+
+def discard(state, table_name, modes=()):
+    '''
+    remove the saved matrices of a table that is about to be rewritten, so
+    load() converts the new table rather than returning the old matrix
+    modes: the transport modes of a multi-mode run (saved as {table_name}_{mode})
+    '''
+    for name in [table_name] + ['{}_{}'.format(table_name, mode) for mode in modes]:
+        if os.path.exists(path(state, name)):
+            logger.info('Removing the saved matrix of {}'.format(name))
+            shutil.rmtree(path(state, name))
+
+
+def open_for_writing(directory, orig_ids, dest_ids, metrics, resume=False):
+    '''
+    the matrix a query run writes to: reopened when resuming, else created
+    '''
+    if resume and os.path.exists(os.path.join(directory, 'orig_ids.npy')):
+        return AccessMatrix.open(directory, mode='r+')
+    return AccessMatrix.create(directory, orig_ids, dest_ids, metrics)
+
+
+def record(tiles, matrix):
+    '''
+    pass (tile, values) pairs from table_query.iter_tiles through, storing
+    each in the matrix on the way
+    '''
+    for tile, values in tiles:
+        matrix.write_tile(tile, values)
+        yield tile, values
+    matrix.flush()
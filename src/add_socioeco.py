@@ -1,9 +1,10 @@
 # user defined variables
 from config import *
 
-def import_csv(state):
+def import_csv(state, mode=None):
     '''
     import a csv into the postgres db
+    mode: the transport mode to take, if nearest_dist holds several
     '''
     db, context = cfg_init(state)
 
@@ -12,7 +13,10 @@ def import_csv(state):
     county = county_codes[state]
 
     # import distances
-    dist = pd.read_sql("SELECT id_orig, distance FROM nearest_dist WHERE service = 'supermarket'", db['con'])
+    if mode is None:
+        dist = pd.read_sql("SELECT id_orig, distance FROM nearest_dist WHERE service = 'supermarket'", db['con'])
+    else:
+        dist = pd.read_sql("SELECT id_orig, distance FROM nearest_dist WHERE service = 'supermarket' AND mode = %s", db['con'], params=(mode,))
     dist = dist.loc[dist['distance']!=0]
     dist['geoid10'] = dist['id_orig']
     # import race and ethnicity
@@ -0,0 +1,173 @@
+'''
+Benchmark the OSRM query path against a stub server (see mock_osrm)
+Runs the real table query code - url building, the pooled client, response
+decoding, row building and COPY formatting (or a real COPY with db_url) - at
+increasing sizes, and reports pairs/s, peak RSS and the time spent in each
+stage. Each size runs in its own process, so its peak RSS is its own.
+'''
+# user defined variables
+sizes = [10**4, 10**5, 10**6, 10**7] # O-D pairs per run
+dest_n = 1000 # destinations per run (origins = pairs / dest_n)
+latency = 0.005 # seconds the stub holds each response
+batch_limit = 10000 # O-D pairs per table request
+coord_encoding = 'polyline6' # url coordinate encoding ['text', 'polyline', 'polyline6']
+max_in_flight = None # requests kept in flight (None: one per core)
+db_url = None # postgres url (postgresql+psycopg2://...) to COPY into; None: rows are formatted for COPY and discarded
+output = 'benchmark_query.json' # where the results are written
+
+import io
+import json
+import time
+import resource
+import threading
+from queue import Empty
+import multiprocessing as mp
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+import mock_osrm
+import query_metrics
+import table_query
+import table_stream
+# functions - logging
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+############## Stage Timing ##############
+class StageTimer:
+    '''
+    seconds spent in each stage, summed over threads
+    '''
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def iterate(self, stage, items):
+        '''
+        the items of a generator, timing the work done to produce each
+        '''
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start)
+            yield item
+
+
+############## Benchmark ##############
+def run_size(pairs, url, results):
+    '''
+    query and write `pairs` O-D pairs through the real code path
+    (run in a child process; the result dict is put on results)
+    '''
+    rng = np.random.default_rng(0)
+    dest = min(dest_n, pairs)
+    orig = max(1, pairs // dest)
+    orig_xy = np.column_stack([rng.uniform(-88.0, -87.5, orig), rng.uniform(41.6, 42.1, orig)])
+    dest_xy = np.column_stack([rng.uniform(-88.0, -87.5, dest), rng.uniform(41.6, 42.1, dest)])
+    orig_ids = np.array(['17031{:010d}'.format(i) for i in range(orig)])
+    dest_ids = np.arange(dest)
+    metrics = ['distance', 'duration']
+    timer = StageTimer()
+    run_metrics = query_metrics.RunMetrics('benchmark_{}'.format(pairs))
+    options = table_query.table_options(url, 'driving', metrics, batch_limit=batch_limit,
+                                        coordinates=coord_encoding, max_in_flight=max_in_flight,
+                                        run_metrics=run_metrics)
+    # time the stages inside the query code
+    iter_queries, decode_table, tile_frame = table_query.iter_queries, table_query.decode_table, table_stream.tile_frame
+    table_query.iter_queries = lambda *args, **kwargs: timer.iterate('build_urls', iter_queries(*args, **kwargs))
+    table_query.decode_table = timer.wrap('decode', decode_table)
+    table_stream.tile_frame = timer.wrap('rows', tile_frame)
+    try:
+        start = time.perf_counter()
+        frames = table_stream.tile_frames(table_query.iter_tiles(orig_xy, dest_xy, options), orig_ids, dest_ids, metrics)
+        if db_url:
+            from sqlalchemy.engine import create_engine
+            db = {'engine': create_engine(db_url)}
+            write_start = time.perf_counter()
+            rows = table_stream.copy_frames(frames, db, 'benchmark_query')
+            timer.add('write', time.perf_counter() - write_start)
+        else:
+            rows = 0
+            for tile, frame in frames:
+                # what copy_frames does before handing rows to COPY
+                format_start = time.perf_counter()
+                frame.to_csv(io.StringIO(), sep='\t', header=False, index=False)
+                timer.add('write', time.perf_counter() - format_start)
+                rows += len(frame)
+        seconds = time.perf_counter() - start
+    finally:
+        table_query.iter_queries, table_query.decode_table, table_stream.tile_frame = iter_queries, decode_table, tile_frame
+    summary = run_metrics.summary()
+    timer.add('http', sum(run_metrics.latencies))
+    results.put({'pairs': rows, 'origins': orig, 'destinations': dest, 'seconds': seconds,
+                 'pairs_per_s': rows / seconds,
+                 # ru_maxrss is in kilobytes on linux
+                 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                 'requests': summary['requests'], 'response_mb': summary['response_bytes'] / 2**20,
+                 'stage_seconds': dict(timer.seconds)})
+
+
+def wait_result(process, queue, pairs):
+    '''
+    the result of one size's process, raising if it dies without one
+    '''
+    while True:
+        # a result put just before exiting may still be on its way
+        alive = process.is_alive()
+        try:
+            result = queue.get(timeout=1)
+            process.join()
+            return result
+        except Empty:
+            if not alive:
+                process.join()
+                raise RuntimeError('Benchmark of {} pairs failed (exit code {})'.format(pairs, process.exitcode))
+
+
+def main():
+    results = []
+    with mock_osrm.MockOSRM(latency=latency) as server:
+        logger.info('Stub OSRM at {} ({}s latency)'.format(server.url, latency))
+        for pairs in sizes:
+            queue = mp.Queue()
+            process = mp.Process(target=run_size, args=(pairs, server.url, queue))
+            process.start()
+            result = wait_result(process, queue, pairs)
+            logger.info('{} pairs: {:.0f} pairs/s, peak RSS {:.0f} MB'.format(result['pairs'], result['pairs_per_s'], result['peak_rss_mb']))
+            results.append(result)
+    with open(output, 'w') as file:
+        json.dump({'settings': {'dest_n': dest_n, 'latency': latency, 'batch_limit': batch_limit,
+                                'coord_encoding': coord_encoding, 'max_in_flight': max_in_flight,
+                                'write': 'copy' if db_url else 'format'},
+                   'results': results}, file, indent=2)
+    # stage seconds are summed over threads, so they can exceed the wall time
+    table = pd.DataFrame([{**{k: v for k, v in r.items() if k != 'stage_seconds'}, **r['stage_seconds']} for r in results])
+    print(table.round(2).to_string(index=False))
+    logger.info('Results written to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ from config import *
 db, context = cfg_init(state)
 import inequality_function
 import numpy as np
+import access_matrix
 
 group = 'H7X001'
 # optimizer = 'ede_{}'.format(group)
@@ -29,43 +30,48 @@ beta = -1.0
 kappa = inequality_function.calc_kappa(dist_current.distance,
                                         beta, weights = dist_current['H7X001'])
 
-# all distances
-sql = 'SELECT * FROM block2blockgroup'
-block2bg = pd.read_sql(sql, db["con"])
-block2bg = block2bg.rename(columns={'id_orig':'geoid10'})
-block2bg = block2bg.set_index('id_dest', drop=False)
-block2bg = block2bg.sort_index()
+# all distances (memory-mapped block x block group matrix)
+block2bg = access_matrix.load(state, 'block2blockgroup', db)
+# matrix rows of the blocks with distances and demographics
+dist_current = dist_current[~np.isnan(dist_current[group])]
+rows = block2bg.orig_index(dist_current.geoid10)
+in_matrix = rows >= 0
+candidate_dists = np.asarray(block2bg.values['distance'])
+
+def new_distance(base, bg):
+    # the minimum of the current distances and those to block group bg
+    dist = base.copy()
+    col = block2bg.dest_index(bg)[0]
+    dist[in_matrix] = np.fmin(dist[in_matrix], candidate_dists[rows[in_matrix], col])
+    return dist
 
 bg_selected = []
 ede_selected = []
-bg_candidates = np.unique(block2bg.index)
+bg_candidates = np.sort(block2bg.dest_ids)
+dist_base = dist_current.distance.values
+weights = dist_current[group].values
 
 for i in tqdm(range(5)):
     ede_candidates = []
     for candidate in bg_candidates:
-        # get the new distances
-        dist_new = block2bg[block2bg.index.isin([candidate] + bg_selected)]
-        # dist_new = block2bg[block2bg.id_dest == candidate]
-        # add to the current distances
-        dist_concat = pd.concat([dist_current, dist_new])
         # determine the new minimum distances
-        dist_min = dist_concat.groupby('geoid10').min()
-        dist_min = dist_min[~np.isnan(dist_min[group])]
+        dist_min = new_distance(dist_base, candidate)
         if optimizer == 'mean':
             # calculate the mean
-            ede = np.average(dist_min.distance,
-                                weights = dist_min[group])
+            ede = np.average(dist_min,
+                                weights = weights)
         else:
             # calculate the new EDE
-            ede = inequality_function.kolm_pollak_ede(dist_min.distance,
+            ede = inequality_function.kolm_pollak_ede(dist_min,
                                                     kappa = kappa,
-                                                    weights = dist_min[group])
+                                                    weights = weights)
         # store EDE and candidate node
         ede_candidates += [ede]
     # select candidate with minimum EDE
     index_min = np.argmin(ede_candidates)
     bg_chosen = bg_candidates[index_min]
     bg_selected += [bg_chosen]
+    dist_base = new_distance(dist_base, bg_chosen)
     ede_selected += [ede_candidates[index_min]]
     print(ede_selected)
     # repeat for remaining candidates
@@ -87,10 +93,8 @@ df = pd.read_csv(fn)
 df = df.drop(['Unnamed: 0'], axis=1)
 
 # determine new distance
-dist_new = block2bg[block2bg.index.isin(bg_selected)]
-dist_concat = pd.concat([dist_current, dist_new])
-dist_min = dist_concat.groupby('geoid10').min()
-dist_min = dist_min[~np.isnan(dist_min[group])]
+dist_min = dist_current.copy()
+dist_min['distance'] = dist_base
 
 # calculate poverty
 percentage_poverty = (dist_min['JOCE002'] + dist_min['JOCE003'])/dist_min['JOCE001']
@@ -0,0 +1,131 @@
+'''
+Estimate network distances as straight-line distance x a circuity factor
+For screening a city before querying it in full: a small random sample of
+origin x destination pairs is queried through OSRM, the circuity factor
+(network / great-circle distance) is fitted on half of it - optionally
+varying with the local density of blocks, a stand-in for road density - and
+its error is measured on the other half. Nearest destinations then come from
+a KD-tree, with no further queries.
+'''
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import nearest_query
+import table_query
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# radius (m) blocks are counted in for the local density
+density_radius = 1000
+# pairs closer than this (m) are left out of the fit, their ratios are noise
+min_straight = 200
+
+
+def straight_line(orig_xy, dest_xy):
+    '''
+    (orig x dest) great-circle metres
+    '''
+    orig, dest = nearest_query.to_sphere(orig_xy), nearest_query.to_sphere(dest_xy)
+    return nearest_query.great_circle(np.linalg.norm(orig[:, None] - dest[None], axis=-1))
+
+
+def local_density(xy, radius=density_radius):
+    '''
+    points within radius metres of each point, per km2
+    '''
+    sphere = nearest_query.to_sphere(np.asarray(xy, dtype=float))
+    counts = cKDTree(sphere).query_ball_point(sphere, 2 * np.sin(radius / (2 * nearest_query.EARTH_RADIUS)), return_length=True)
+    return counts / (np.pi * (radius / 1000)**2)
+
+
+class Circuity:
+    '''
+    log(network / straight) = a + b log(density), fitted by least squares
+    (b = 0 without density); durations from the sample's seconds per metre
+    '''
+    def __init__(self, by_density=False):
+        self.by_density = by_density
+        self.coef = np.zeros(2)
+        self.seconds_per_m = np.nan
+
+    def design(self, density):
+        return np.column_stack([np.ones(len(density)), np.log(density) if self.by_density else np.zeros(len(density))])
+
+    def fit(self, straight, network, density, duration=None):
+        keep = (straight > min_straight) & np.isfinite(network) & (network > 0)
+        self.coef = np.linalg.lstsq(self.design(density[keep]), np.log(network[keep] / straight[keep]), rcond=None)[0]
+        if duration is not None:
+            self.seconds_per_m = np.nanmedian(duration[keep] / network[keep])
+        return self
+
+    def factor(self, density):
+        density = np.asarray(density, dtype=float)
+        return np.exp(self.design(density.ravel()) @ self.coef).reshape(density.shape)
+
+    def distance(self, straight, density):
+        return straight * self.factor(density)
+
+
+############## Calibration ##############
+def calibrate(orig_xy, dest_xy, options, sample=200, by_density=False, seed=0):
+    '''
+    query a sample x sample random block of pairs, fit on half the sampled
+    origins and report the error on the other half
+    returns the fitted Circuity (on the whole sample) and the report (dict)
+    '''
+    if min(sample, len(orig_xy)) < 2 or len(dest_xy) == 0:
+        # one origin leaves one half of the fit empty
+        raise ValueError('Calibrating circuity needs at least 2 sampled origins and a destination, got {} and {}'.format(
+            min(sample, len(orig_xy)), len(dest_xy)))
+    # the fit needs network distances whatever metrics the run itself queries
+    options = dict(options, metrics=['distance'] + [m for m in options['metrics'] if m != 'distance'])
+    rng = np.random.default_rng(seed)
+    orig = rng.choice(len(orig_xy), size=min(sample, len(orig_xy)), replace=False)
+    dest = rng.choice(len(dest_xy), size=min(sample, len(dest_xy)), replace=False)
+    values = table_query.query_matrix(orig_xy[orig], dest_xy[dest], options)
+    straight = straight_line(orig_xy[orig], dest_xy[dest])
+    density = np.broadcast_to(local_density(orig_xy)[orig][:, None], straight.shape)
+    duration = values.get('duration')
+    # each origin's pairs fall in one half
+    half = np.arange(len(orig)) % 2 == 0
+    arrays = lambda rows: (straight[rows].ravel(), values['distance'][rows].ravel(), density[rows].ravel(),
+                           None if duration is None else duration[rows].ravel())
+    model = Circuity(by_density).fit(*arrays(half))
+    test_straight, test_network, test_density, _ = arrays(~half)
+    estimate = model.distance(test_straight, test_density)
+    keep = np.isfinite(test_network) & (test_straight > min_straight)
+    error = (estimate[keep] - test_network[keep]) / test_network[keep]
+    # the error that reaches nearest_dist: each held-out origin's nearest sampled destination
+    true_nearest = np.nanmin(values['distance'][~half], axis=1)
+    est_nearest = np.min(model.distance(straight[~half], density[~half]), axis=1)
+    nearest_error = (est_nearest - true_nearest) / true_nearest
+    report = {'pairs': int(values['distance'].size), 'factor': float(np.exp(model.coef[0])),
+              'density_exponent': float(model.coef[1]),
+              'median_abs_error': float(np.median(np.abs(error))), 'p90_abs_error': float(np.percentile(np.abs(error), 90)),
+              'bias': float(np.mean(error)), 'nearest_median_abs_error': float(np.nanmedian(np.abs(nearest_error))),
+              'nearest_bias': float(np.nanmean(nearest_error))}
+    logger.info('Circuity {:.2f} (density exponent {:.3f}) from {} pairs: held-out error median {:.1%}, p90 {:.1%}, bias {:+.1%}; nearest distance median {:.1%}, bias {:+.1%}'.format(
+        report['factor'], report['density_exponent'], report['pairs'], report['median_abs_error'],
+        report['p90_abs_error'], report['bias'], report['nearest_median_abs_error'], report['nearest_bias']))
+    # the estimator used is fitted on the whole sample
+    return Circuity(by_density).fit(*arrays(slice(None))), report
+
+
+def nearest(model, orig_xy, dest_xy, density):
+    '''
+    estimated nearest destination of each origin, as nearest_query.query_nearest
+    (the factor only depends on the origin, so the nearest is the straight-line nearest)
+    '''
+    if len(dest_xy) == 0:
+        # none is reachable
+        result = {'distance': np.full(len(orig_xy), np.nan), 'index': np.full(len(orig_xy), -1)}
+        if np.isfinite(model.seconds_per_m):
+            result['duration'] = np.full(len(orig_xy), np.nan)
+        return result
+    chord, index = cKDTree(nearest_query.to_sphere(dest_xy)).query(nearest_query.to_sphere(orig_xy))
+    distance = model.distance(nearest_query.great_circle(chord), density)
+    result = {'distance': distance, 'index': index}
+    if np.isfinite(model.seconds_per_m):
+        result['duration'] = distance * model.seconds_per_m
+    return result
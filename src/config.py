@@ -30,6 +30,9 @@ logging.basicConfig(
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
 
+# osrm-routed workers sharing each region's dataset, on the ports from osrm_url's (see init_osrm)
+routed_workers = 1
+
 def cfg_init(state):
     # SQL connection
     db = dict()
@@ -38,6 +41,7 @@ def cfg_init(state):
     db['port'] = '5001'
     # city information
     context = dict()
+    context['state'] = state
     if state == 'md':
         db['name'] = 'access_md'
         context['city_code'] = 'bal'
@@ -113,6 +117,10 @@ def cfg_init(state):
         context['city'] = 'San_Francisco'
         context['osrm_url'] = 'http://localhost:6013'
         context['services'] = ['supermarket']#,'hospital']
+    # osrm-routed instances serving the same data as osrm_url; add more to
+    # spread the table requests over them (see osrm_client.Endpoints)
+    host, port = context['osrm_url'].rsplit(':', 1)
+    context['osrm_endpoints'] = ['{}:{}'.format(host, int(port) + i) for i in range(routed_workers)]
     # connect to database
     db['engine'] = create_engine('postgresql+psycopg2://postgres:' + db['passw'] + '@' + db['host'] + '/' + db['name'] + '?port=' + db['port'])
     db['address'] = "host=" + db['host'] + " dbname=" + db['name'] + " user=postgres password='"+ db['passw'] + "' port=" + db['port']
@@ -3,6 +3,7 @@ from config import *
 db, context = cfg_init(state)
 import inequality_function
 import numpy as np
+import access_matrix
 
 group = 'H7X001'
 # optimizer = 'ede_{}'.format(group)
@@ -30,8 +31,7 @@ dist.to_csv('../data/export/{}_distance_current.csv'.format(context['city']))
 
 
 # all distances
-sql = 'SELECT * FROM block2blockgroup'
-block2bg = pd.read_sql(sql, db["con"])
+block2bg = access_matrix.load(state, 'block2blockgroup', db).frame()
 block2bg = block2bg.rename(columns={'id_orig':'geoid10'})
 block2bg = block2bg.set_index('id_dest', drop=False)
 block2bg = block2bg.sort_index()
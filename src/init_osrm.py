@@ -1,49 +1,229 @@
 import subprocess
 import os
+import hashlib
+import osrm_probe
+import osrm_servers
+
+# transport mode options
+mode_dict = {'driving':'car','walking':'foot','cycling':'bicycle'}
+
+# the preprocessing each routing algorithm needs after osrm-extract, and the file it leaves
+compile_steps = {'mld': ['osrm-partition', 'osrm-customize'], 'ch': ['osrm-contract']}
+compiled_file = {'mld': 'osrm.partition', 'ch': 'osrm.hsgr'}
 
 def main(config, logger):
     ''' run the shell script that
-    - removes the existing docker
     - downloads the osrm files
-    - establishes the osrm routing docker
+    - reuses a running docker already serving the data, or removes it
+    - establishes the osrm routing docker and waits until it answers
+    With several transport modes each gets its own compiled data and
+    osrm-routed container (see mode_urls).
+    OSRM.algorithm 'auto' compiles for both MLD and CH and serves with the
+    one that answered table requests faster (see osrm_probe).
+    Containers are kept warm between runs (see osrm_servers), each on its
+    own host port, which is written back to OSRM.port / OSRM.mode_ports.
+    OSRM.routed_workers above 1 loads each network once into shared memory
+    (osrm-datastore) and serves it from that many osrm-routed containers on
+    consecutive ports (see run_routed).
     '''
-    # transport mode options
-    mode_dict = {'driving':'car','walking':'foot','cycling':'bicycle'}
-
     # pull the variables from the config file
     state_name = config['OSM']['state']
-    continent = config['OSM']['continent']
-    country = config['OSM']['country']
-    port = config['OSRM']['port']
-    transport_mode = mode_dict[config['transport_mode']]
     directory = config['OSM']['data_directory']
     state = config['location']['state']
-
-    # in shell, remove any existing dockers
-    shell_commands = [
-                    'docker stop osrm-{}'.format(state),
-                    'docker rm osrm-{}'.format(state),
-                    ]
-    for com in shell_commands:
-        subprocess.run(com.split())
+    modes = transport_modes(config)
+    urls = mode_urls(config)
+    algorithm = config['OSRM'].get('algorithm', 'mld')
+    compile_for = list(osrm_probe.algorithms) if algorithm == 'auto' else [algorithm]
+    names = [container_name(config, mode) for mode in modes]
+    workers = config['OSRM'].get('routed_workers') or 1
+    ports = set()
 
     # download the data
-    download_data = 'wget -N https://download.geofabrik.de/{}/{}/{}-latest.osm.pbf -P {}'.format(continent, country, state_name, directory)
-    p = subprocess.run(download_data.split(), stderr=subprocess.PIPE, bufsize=0)
+    downloaded = download(config)
+
+    config['OSRM']['fingerprints'] = {}
+    config['OSRM']['algorithms'] = {}
+    for mode in modes:
+        transport_mode = mode_dict[mode]
+        mode_directory = data_directory(config, mode)
+        if mode_directory != directory:
+            # the other modes compile their own copy of the extract
+            os.makedirs(mode_directory, exist_ok=True)
+            pbf = os.path.join(mode_directory, '{}-latest.osm.pbf'.format(state_name))
+            if downloaded and os.path.exists(pbf):
+                os.remove(pbf)
+            if not os.path.exists(pbf):
+                os.link(os.path.join(directory, '{}-latest.osm.pbf'.format(state_name)), pbf)
+        # identifies the routing data for the O-D cache (see od_cache) and the warm containers
+        config['OSRM']['fingerprints'][mode] = dataset_fingerprint(directory, state_name, transport_mode)
+        # compiled from this extract with this profile (e.g. not left by another first mode)
+        compiled = all(os.path.exists(os.path.join(mode_directory, '{}-latest.{}'.format(state_name, compiled_file[a]))) for a in compile_for)
+        compiled = compiled and compiled_fingerprint(mode_directory, state_name) == config['OSRM']['fingerprints'][mode]
 
-    # if the data does not redownload, it does not need to re-compile.
-    if not '304 Not Modified' in str(p.stderr):
-        logger.info('Compiling the data files')
-        shell_commands = [
-                        # init docker data
-                        'docker run -t -v {}:/data osrm/osrm-backend osrm-extract -p /opt/{}.lua /data/{}-latest.osm.pbf'.format(directory, transport_mode, state_name),
-                        'docker run -t -v {}:/data osrm/osrm-backend osrm-partition /data/{}-latest.osrm'.format(directory, state_name),
-                        'docker run -t -v {}:/data osrm/osrm-backend osrm-customize /data/{}-latest.osrm'.format(directory, state_name),
-                        ]
-        for com in shell_commands:
-            subprocess.run(com.split(), stdout=open(os.devnull, 'wb'))
+        # a container already serving this data is used as it is
+        name = container_name(config, mode)
+        labels = None
+        if not downloaded and compiled:
+            labels = osrm_servers.warm(name, config['OSRM']['fingerprints'][mode], None if algorithm == 'auto' else algorithm, workers,
+                                       config['OSRM'].get('max_table_size', 100000))
+        if labels is not None:
+            logger.info('Reusing {}, already serving this data'.format(name))
+            set_port(config, mode, labels['osrm.port'])
+            config['OSRM']['algorithms'][mode] = labels['osrm.algorithm']
+            ports.update(range(int(labels['osrm.port']), int(labels['osrm.port']) + workers))
+            osrm_servers.touch(name, labels['osrm.port'], workers)
+            continue
+        osrm_servers.stop(name)
+
+        # if the data does not redownload (or change profile), it does not need to re-compile.
+        if downloaded or not compiled:
+            logger.info('Compiling the data files for {}'.format(mode))
+            shell_commands = [
+                            # init docker data
+                            'docker run -t -v {}:/data osrm/osrm-backend osrm-extract -p /opt/{}.lua /data/{}-latest.osm.pbf'.format(mode_directory, transport_mode, state_name),
+                            ]
+            for a in compile_for:
+                shell_commands += ['docker run -t -v {}:/data osrm/osrm-backend {} /data/{}-latest.osrm'.format(mode_directory, step, state_name)
+                                   for step in compile_steps[a]]
+            for com in shell_commands:
+                subprocess.run(com.split(), stdout=open(os.devnull, 'wb'))
+            with open(fingerprint_path(mode_directory, state_name), 'w') as file:
+                file.write(config['OSRM']['fingerprints'][mode])
+        else:
+            logger.info('Data not re-downloaded and compiled because no changes to online version')
+
+        # the configured port, unless another warm container holds it
+        port = osrm_servers.free_port(urls[mode].rsplit(':', 1)[1], exclude=[name], taken=ports, n=workers)
+        set_port(config, mode, port)
+        ports.update(range(port, port + workers))
+
+        mode_algorithm = algorithm
+        if algorithm == 'auto':
+            mode_algorithm = osrm_probe.recorded(mode_directory, state_name, config['OSRM']['fingerprints'][mode])
+            if mode_algorithm is None:
+                mode_algorithm = probe(config, mode, logger)
+            else:
+                logger.info('Using {} for {}, as probed before'.format(mode_algorithm, mode))
+        config['OSRM']['algorithms'][mode] = mode_algorithm
+        # make room among the warm containers for this one
+        osrm_servers.evict(config['OSRM'].get('warm_memory_gb', 32), keep=names,
+                           reserve=osrm_servers.dataset_size(mode_directory, state_name))
+        logger.info('Starting {} and waiting for it to load the data'.format(name))
+        if not run_routed(config, mode, mode_algorithm, workers):
+            # never release queries to a server that is not listening
+            osrm_servers.stop(name)
+            raise RuntimeError('{} did not answer within {}s'.format(name, config['OSRM'].get('ready_timeout', 1800)))
+        osrm_servers.touch(name, port, workers)
+    config['OSRM']['fingerprint'] = config['OSRM']['fingerprints'][modes[0]]
+
+def run_routed(config, mode, algorithm, workers=1):
+    ''' start a mode's osrm-routed container with the given algorithm,
+    labelled with the data it serves (see osrm_servers), and wait until it
+    answers. With several workers the first container loads the network
+    into shared memory with osrm-datastore and serves from it, the others
+    share its IPC namespace and serve the same dataset on the following ports.
+    Returns whether they all answered. '''
+    name = container_name(config, mode)
+    host, port = mode_urls(config)[mode].rsplit(':', 1)
+    state_name = config['OSM']['state']
+    timeout = config['OSRM'].get('ready_timeout', 1800)
+    routed = 'osrm-routed --algorithm {} --max-table-size {}'.format(algorithm, config['OSRM'].get('max_table_size', 100000))
+    labels = osrm_servers.label_args(config['OSRM']['fingerprints'][mode], algorithm, port, workers,
+                                     config['OSRM'].get('max_table_size', 100000))
+    if workers == 1:
+        run_docker = 'docker run -d --name {} -t -i -p {}:5000 -v {}:/data osrm/osrm-backend {} /data/{}-latest.osrm'.format(
+            name, port, data_directory(config, mode), routed, state_name).split()
+        subprocess.run(run_docker[:5] + labels + run_docker[5:])
     else:
-        logger.info('Data not re-downloaded and compiled because no changes to online version')
+        dataset = '{}-{}'.format(state_name, mode)
+        shared = '{} --shared-memory --dataset-name {}'.format(routed, dataset)
+        run_docker = 'docker run -d --name {} --ipc=shareable -t -i -p {}:5000 -v {}:/data osrm/osrm-backend sh -c'.format(
+            name, port, data_directory(config, mode)).split()
+        subprocess.run(run_docker[:5] + labels + run_docker[5:] + ['osrm-datastore --dataset-name {} /data/{}-latest.osrm && {}'.format(dataset, state_name, shared)])
+    ready = osrm_servers.wait_ready('{}:{}'.format(host, port), mode, timeout)
+    for i, worker in enumerate(osrm_servers.worker_names(name, workers), 1):
+        run_docker = 'docker run -d --name {} -t -i -p {}:5000 osrm/osrm-backend {}'.format(worker, int(port) + i, shared).split()
+        subprocess.run(run_docker[:5] + osrm_servers.worker_args(name) + run_docker[5:])
+    for i in range(1, workers):
+        ready &= osrm_servers.wait_ready('{}:{}'.format(host, int(port) + i), mode, timeout)
+    return ready
+
+def set_port(config, mode, port):
+    ''' point a mode's url at the host port its container was given '''
+    osrm = config['OSRM']
+    osrm['mode_ports'] = dict(osrm.get('mode_ports') or {}, **{mode: int(port)})
+    if mode == transport_modes(config)[0]:
+        osrm['port'] = str(port)
+
+def probe(config, mode, logger):
+    ''' time the same table requests against osrm-routed with each algorithm,
+    record the faster for this dataset (see osrm_probe) and return it '''
+    state_name = config['OSM']['state']
+    mode_directory = data_directory(config, mode)
+    bbox = osrm_probe.pbf_bbox(os.path.join(mode_directory, '{}-latest.osm.pbf'.format(state_name)))
+    if bbox is None:
+        logger.info('No bounding box in the extract to probe in, using mld')
+        return 'mld'
+    points = osrm_probe.probe_points(bbox, config['OSRM'].get('probe_points', 100))
+    seconds = {}
+    for algorithm in osrm_probe.algorithms:
+        logger.info('Probing {} for {}'.format(algorithm, mode))
+        if run_routed(config, mode, algorithm):
+            seconds[algorithm] = osrm_probe.time_table(mode_urls(config)[mode], mode, points)
+        osrm_servers.stop(container_name(config, mode))
+    if not seconds:
+        return 'mld'
+    return osrm_probe.record(mode_directory, state_name, config['OSRM']['fingerprints'][mode], seconds)
+
+def download(config):
+    ''' fetch the OSM extract if the online version changed; returns whether it did '''
+    osm = config['OSM']
+    download_data = 'wget -N https://download.geofabrik.de/{}/{}/{}-latest.osm.pbf -P {}'.format(osm['continent'], osm['country'], osm['state'], osm['data_directory'])
+    p = subprocess.run(download_data.split(), stderr=subprocess.PIPE, bufsize=0)
+    return not '304 Not Modified' in str(p.stderr)
+
+def transport_modes(config):
+    ''' the transport modes of a config: transport_mode is one mode or a list '''
+    modes = config['transport_mode']
+    return [modes] if isinstance(modes, str) else list(modes)
+
+def mode_urls(config):
+    ''' the osrm-routed url serving each transport mode: OSRM.port for the
+    first mode, then the following ports (or OSRM.mode_ports[mode]), leaving
+    room for each mode's OSRM.routed_workers '''
+    osrm = config['OSRM']
+    ports = osrm.get('mode_ports') or {}
+    workers = osrm.get('routed_workers') or 1
+    return {mode: '{}:{}'.format(osrm['host'], ports.get(mode, int(osrm['port']) + i * workers))
+            for i, mode in enumerate(transport_modes(config))}
+
+def container_name(config, mode):
+    ''' the first mode keeps the single mode name, osrm-{state} '''
+    state = config['location']['state']
+    return 'osrm-{}'.format(state) if mode == transport_modes(config)[0] else 'osrm-{}-{}'.format(state, mode)
+
+def data_directory(config, mode):
+    ''' where a mode's network is compiled: the first mode's in the data
+    directory, as for a single mode, the others' in a subdirectory per profile '''
+    directory = config['OSM']['data_directory']
+    return directory if mode == transport_modes(config)[0] else os.path.join(directory, mode_dict[mode])
+
+def fingerprint_path(directory, state_name):
+    ''' where the fingerprint of the network compiled in a directory is kept '''
+    return os.path.join(directory, '{}-latest.osrm.fingerprint'.format(state_name))
+
+def compiled_fingerprint(directory, state_name):
+    ''' the fingerprint the network in a directory was compiled for, None if unknown '''
+    try:
+        with open(fingerprint_path(directory, state_name)) as file:
+            return file.read().strip()
+    except OSError:
+        return None
 
-    run_docker = 'docker run -d --name osrm-{} -t -i -p {}:5000 -v {}:/data osrm/osrm-backend osrm-routed --algorithm mld --max-table-size 100000 /data/{}-latest.osrm'.format(state, port, directory, state_name)
-    subprocess.run(run_docker.split())
+def dataset_fingerprint(directory, state_name, transport_mode):
+    ''' identifies the compiled network: the extract's size and modification
+    time (wget -N keeps the server's) and the profile it was compiled with '''
+    pbf = os.path.join(directory, '{}-latest.osm.pbf'.format(state_name))
+    stat = os.stat(pbf)
+    key = '{}:{}:{}:{}'.format(os.path.basename(pbf), stat.st_size, int(stat.st_mtime), transport_mode)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
@@ -0,0 +1,127 @@
+'''
+Stub OSRM server for benchmarking the query path without docker
+- answers /table/v1 (text or polyline coordinates, sources/destinations,
+  annotations, skip_waypoints) with a deterministic synthetic matrix:
+  distance is the L1 coordinate distance x 1e5, duration distance / 10
+- answers /nearest/v1 with the point itself
+- each response is delayed by a configurable latency
+'''
+import re
+import time
+import multiprocessing as mp
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+import numpy as np
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, default=lambda a: a.tolist()).encode()
+
+
+############## Coordinates ##############
+def decode_polyline(line, precision=5):
+    '''
+    (lon, lat) array from a Google polyline, decoded with NumPy
+    '''
+    chunks = np.frombuffer(line.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    ends = np.flatnonzero(chunks < 0x20)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    # position of each chunk within its value, least significant first
+    position = np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((chunks & 0x1f) << (5 * position), starts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    points = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10**precision
+    return points[:, ::-1]
+
+
+def parse_coordinates(text):
+    match = re.match(r'(polyline6?)\((.*)\)$', unquote(text))
+    if match:
+        return decode_polyline(match.group(2), 6 if match.group(1) == 'polyline6' else 5)
+    return np.array(text.replace(';', ',').split(','), dtype=float).reshape(-1, 2)
+
+
+def synthetic_distance(orig_xy, dest_xy):
+    '''
+    the matrix the stub answers with
+    '''
+    return np.round(np.abs(orig_xy[:, None, :] - dest_xy[None, :, :]).sum(axis=-1) * 1e5, 1)
+
+
+############## Server ##############
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # seconds each response is held back
+    latency = 0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        service, coordinates = url.path.split('/')[1], url.path.split('/')[-1]
+        points = parse_coordinates(coordinates)
+        if service == 'nearest':
+            body = {'code': 'Ok', 'waypoints': [{'location': points[0], 'distance': 0.0}]}
+        else:
+            indices = lambda key: np.array(query[key][0].split(';'), dtype=int) if key in query else np.arange(len(points))
+            sources, destinations = indices('sources'), indices('destinations')
+            distance = synthetic_distance(points[sources], points[destinations])
+            body = {'code': 'Ok'}
+            annotations = query.get('annotations', ['duration'])[0].split(',')
+            if 'distance' in annotations:
+                body['distances'] = distance
+            if 'duration' in annotations:
+                body['durations'] = np.round(distance / 10, 1)
+            if query.get('skip_waypoints', ['false'])[0] != 'true':
+                body['sources'] = [{'location': points[i], 'distance': 0.0} for i in sources]
+                body['destinations'] = [{'location': points[i], 'distance': 0.0} for i in destinations]
+        content = dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=0, latency=0, ready=None):
+    '''
+    run the stub in this process until it is killed
+    ready: a multiprocessing queue the bound port is put on
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), type('Handler', (Handler,), {'latency': latency}))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockOSRM:
+    '''
+    the stub running in its own process (so it does not share the GIL with
+    the code being measured); use as a context manager, `url` is its address
+    '''
+    def __init__(self, latency=0, port=0):
+        ready = mp.Queue()
+        self.process = mp.Process(target=serve, args=(port, latency, ready), daemon=True)
+        self.process.start()
+        self.url = 'http://127.0.0.1:{}'.format(ready.get(timeout=30))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
@@ -2,10 +2,13 @@
 Populate the database for the nearest proximity throughout time
 '''
 from config import *
+import access_matrix
 
-def determine_nearest(state):
+def determine_nearest(state, modes=None):
     '''
     determine closest services for time = 0 (initial case), all ids are open
+    modes: the transport modes of a multi-mode query run, each is read from
+    its own rows of the table and written with a 'mode' column
     '''
     db, context = cfg_init(state)
     con = db['con']
@@ -30,35 +33,27 @@ def determine_nearest(state):
     # get the times
     times = sorted(outs[services[0]].keys()) #times is just ['0'] in this initial case
     time_stamp = times[0] #because this is the initial case where everything is open
-    # get the distance matrix
-    distances = pd.read_sql('SELECT * FROM equality_index', db['con'])
-    #making the id_dest column the index
-    distances = distances.set_index('id_dest')
-    #converts distance column from string to float
-    distances.distance = pd.to_numeric(distances.distance)
+    for mode in modes or [None]:
+        # get the distance matrix (memory-mapped, see access_matrix)
+        distances = access_matrix.load(state, 'equality_index', db, mode=mode)
 
-    # block ids
-    id_orig = np.unique(distances.id_orig)
+        # loop services
+        for i in tqdm(range(len(services))):
+            service = services[i]
+            ids_open = outs[service][time_stamp]
+            # get the minimum distance over the open destinations
+            df_min = distances.nearest('distance', dests=ids_open)
+            df_min = df_min[['id_orig', 'distance']]
 
-    # loop services
-    for i in tqdm(range(len(services))):
-        service = services[i]
-        ids_open = outs[service][time_stamp]
-        # subset the distance matrix on dest_id
-        dists_sub = distances.loc[ids_open]
-        # get the minimum distance
-        df_min = dists_sub.groupby('id_orig')['distance'].min()
-        # prepare df to append: This makes distance the name of the column not the series
-        df_min = df_min.to_frame('distance')
-        df_min.reset_index(inplace=True)
-
-        # prepare df to append. Adding these columns as they are needed in simulation.py
-        df_min['service'] = service
-        df_min['time_stamp'] = time_stamp
-        df_min['sim_num'] = 0
-        df_min['metric'] = 0
-        # append
-        df = df.append(df_min, ignore_index=True)
+            # prepare df to append. Adding these columns as they are needed in simulation.py
+            df_min['service'] = service
+            df_min['time_stamp'] = time_stamp
+            df_min['sim_num'] = 0
+            df_min['metric'] = 0
+            if mode is not None:
+                df_min['mode'] = mode
+            # append
+            df = df.append(df_min, ignore_index=True)
     #sorts by id_orig
     df.sort_values(by=['id_orig', 'service'], inplace=True)
     # add df to sql, if it exists it will be replaced
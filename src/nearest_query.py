@@ -0,0 +1,253 @@
+'''
+Query each origin's nearest destination without the full O-D product
+Network distance is never shorter than the straight-line (great-circle)
+distance between the snapped points. So each origin is only queried against
+the destinations nearest to it in a straight line, and that candidate set is
+widened until the best network distance found is no longer than the next
+candidate's straight-line lower bound. The result is the same as taking the
+minimum over the full matrix.
+'''
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import osrm_client
+import table_query
+import table_retry
+import table_tiles
+import table_url
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# the earth radius OSRM measures distances with (util/coordinate_calculation.hpp)
+EARTH_RADIUS = 6372797.560856
+
+
+############## Geometry ##############
+def to_sphere(xy):
+    '''
+    lon/lat in degrees to points on the unit sphere, where chord length
+    orders points the same way as great-circle distance
+    '''
+    lon, lat = np.radians(xy[:, 0]), np.radians(xy[:, 1])
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+def great_circle(chord):
+    '''
+    metres along the earth for a chord length on the unit sphere
+    '''
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+def lower_bound(straight, orig_snap, dest_snap, rel_tol=0.005, abs_tol=1.0):
+    '''
+    smallest network distance possible for a straight-line distance
+    The route starts and ends at the snapped points, which may each be up to
+    their snap distance closer. The tolerances absorb OSRM's approximate
+    segment lengths.
+    '''
+    return straight * (1 - rel_tol) - orig_snap - dest_snap - abs_tol
+
+
+############## Requests ##############
+class _Positions:
+    '''
+    a quarantine for one request, recording its points by their positions in
+    the full origin and destination arrays
+    dests_only: both sides are destinations (see dest_snaps)
+    '''
+    def __init__(self, quarantine, orig, dest, dests_only=False):
+        self.quarantine, self.orig, self.dest = quarantine, orig, dest
+        self.dests_only = dests_only
+
+    def add(self, side, position, reason):
+        if self.dests_only:
+            position = self.orig[position] if side == 'orig' else self.dest[position if side == 'dest' else position[1]]
+            side = 'dest'
+        elif side == 'pair':
+            position = (self.orig[position[0]], self.dest[position[1]])
+        else:
+            position = (self.orig if side == 'orig' else self.dest)[position]
+        self.quarantine.add(side, position, reason)
+
+
+def prober(orig_xy, dest_xy, options, client):
+    '''
+    probe(side, position): whether a point of orig_xy or dest_xy can be
+    queried on its own (as both ends of a 1x1 table), cached
+    '''
+    probed = {}
+
+    def probe(side, position):
+        if (side, position) not in probed:
+            x, y = (orig_xy if side == 'orig' else dest_xy)[position]
+            builder = table_url.TableUrlBuilder(options['url'], options['transport_mode'], [x], [y], ['distance'])
+            try:
+                table_retry.retry(lambda: table_query.req(builder.build([x], [y]), ['distance'], client),
+                                  options['retries'], options['backoff'], options.get('run_metrics'))
+                probed[(side, position)] = True
+            except ValueError:
+                probed[(side, position)] = False
+        return probed[(side, position)]
+    return probe
+
+
+def resolve(orig_xy, dest_xy, orig, dest, metrics, options, client, quarantine, probe, dests_only=False):
+    '''
+    values of the table request between orig_xy[orig] and dest_xy[dest], with
+    each waypoint's snap distance spread over its row or column
+    ('source_snap', 'destination_snap')
+    Failed requests are retried and split around the points that fail (see
+    table_retry); those are left as nan and added to quarantine.
+    '''
+    def fetch(part):
+        o, d = orig[part.orig_start:part.orig_stop], dest[part.dest_start:part.dest_stop]
+        builder = table_url.TableUrlBuilder(options['url'], options['transport_mode'], dest_xy[d, 0], dest_xy[d, 1],
+                                            metrics, encoding=options['coordinates'], skip_waypoints=False)
+        values = table_query.req(builder.build(orig_xy[o, 0], orig_xy[o, 1]), metrics, client, (len(o), len(d)), snaps=True)
+        # as (sources x destinations), so the halves of a split request join up
+        values['source_snap'] = np.repeat(values['source_snap'][:, None], len(d), axis=1)
+        values['destination_snap'] = np.repeat(values['destination_snap'][None, :], len(o), axis=0)
+        return values
+
+    def probe_part(side, position):
+        return probe(side, (orig if side == 'orig' else dest)[position])
+
+    tile = table_tiles.Tile(0, len(orig), 0, len(dest), False)
+    return table_retry.resolve(tile, fetch, probe_part, table_query.tile_shape,
+                               metrics + ['source_snap', 'destination_snap'],
+                               _Positions(quarantine, orig, dest, dests_only),
+                               options['retries'], options['backoff'], options.get('run_metrics'))
+
+
+def dest_snaps(dest_xy, options, client, quarantine, probe):
+    '''
+    how far each destination moves when snapped onto the network, nan for
+    destinations that cannot be queried
+    (one table request per batch_limit destinations, with a single source)
+    probe: a prober for dest_xy
+    '''
+    snaps = np.full(len(dest_xy), np.nan, dtype=np.float32)
+    chunk = max(1, min(options['batch_limit'], options['max_table_size'] - 1))
+    positions = np.arange(len(dest_xy))
+    for start in range(0, len(dest_xy), chunk):
+        dest = positions[start:start + chunk]
+        # a source that works on its own, so one bad point does not blank the batch
+        source = next((p for p in dest if probe('dest', p)), None)
+        if source is None:
+            for p in dest:
+                quarantine.add('dest', p, 'cannot be snapped onto the network')
+            continue
+        values = resolve(dest_xy, dest_xy, np.array([source]), dest, ['distance'], options, client,
+                         quarantine, lambda side, p: probe('dest', p), dests_only=True)
+        snaps[dest] = values['destination_snap'][0]
+    return snaps
+
+
+def candidate_batches(origins, candidates, batch_limit):
+    '''
+    group origins into table requests of (origins x union of their
+    candidates) with at most batch_limit pairs each
+    origins sharing their nearest candidate are grouped together
+    '''
+    batches = []
+    batch, union = [], set()
+    for i in np.argsort(candidates[:, 0], kind='stable'):
+        grown = union.union(candidates[i])
+        if batch and (len(batch) + 1) * len(grown) > batch_limit:
+            batches.append((origins[batch], np.array(sorted(union))))
+            batch, grown = [], set(candidates[i])
+        batch.append(i)
+        union = grown
+    if batch:
+        batches.append((origins[batch], np.array(sorted(union))))
+    return batches
+
+
+############## Nearest ##############
+def query_nearest(orig_xy, dest_xy, options, k=4, quarantine=None):
+    '''
+    nearest destination (by network distance) for every origin
+    returns a dict of 'distance' (and 'duration' to that destination if it
+    is in options['metrics']), 'index' (position in dest_xy, -1 if none is
+    reachable) and 'pairs' (the number of O-D pairs queried)
+    Points whose requests fail are left out and added to quarantine (a
+    table_retry.Quarantine).
+    '''
+    orig_n, dest_n = len(orig_xy), len(dest_xy)
+    metrics = ['distance'] + [m for m in options['metrics'] if m != 'distance']
+    if dest_n == 0:
+        # e.g. a service with no destinations: none is reachable
+        result = {'distance': np.full(orig_n, np.nan), 'index': np.full(orig_n, -1), 'pairs': 0}
+        if 'duration' in metrics:
+            result['duration'] = np.full(orig_n, np.nan)
+        return result
+    if quarantine is None:
+        quarantine = table_retry.Quarantine()
+    orig_sphere = to_sphere(orig_xy)
+    best = np.full(orig_n, np.inf)
+    best_index = np.full(orig_n, -1)
+    best_duration = np.full(orig_n, np.nan)
+    orig_snap = np.zeros(orig_n, dtype=np.float32)
+    pairs = 0
+
+    def fetch(batch):
+        orig, dest = batch
+        return batch, resolve(orig_xy, dest_xy, orig, dest, metrics, options, client, quarantine, probe)
+
+    with osrm_client.client(options) as client:
+        probe = prober(orig_xy, dest_xy, options, client)
+        snaps = dest_snaps(dest_xy, options, client, quarantine, probe)
+        # destinations that cannot be queried are never candidates
+        usable = np.flatnonzero(np.isfinite(snaps))
+        max_dest_snap = snaps[usable].max() if len(usable) else 0
+        tree = cKDTree(to_sphere(dest_xy[usable])) if len(usable) else None
+        pending = np.arange(orig_n if len(usable) else 0)
+        k_done, k = 0, min(k, len(usable))
+        while len(pending):
+            # straight-line candidates, plus the next one for the bound
+            chord, cands = tree.query(orig_sphere[pending], k=min(k + 1, len(usable)))
+            chord, cands = chord.reshape(len(pending), -1), usable[cands.reshape(len(pending), -1)]
+            batches = candidate_batches(pending, cands[:, k_done:k], options['batch_limit'])
+            for (orig, dest), values in client.imap(fetch, batches):
+                pairs += len(orig) * len(dest)
+                if options.get('run_metrics') is not None:
+                    options['run_metrics'].tile(len(orig) * len(dest))
+                dist = np.where(np.isnan(values['distance']), np.inf, values['distance'])
+                col = dist.argmin(axis=1)
+                found = dist[np.arange(len(orig)), col]
+                better = found < best[orig]
+                best[orig[better]] = found[better]
+                best_index[orig[better]] = dest[col[better]]
+                if 'duration' in metrics:
+                    best_duration[orig[better]] = values['duration'][np.arange(len(orig)), col][better]
+                # nan for an origin quarantined here, which then drops out unresolved
+                orig_snap[orig] = np.fmax.reduce(values['source_snap'], axis=1)
+            if k >= len(usable):
+                break
+            # resolved once no unqueried destination could be nearer
+            bound = lower_bound(great_circle(chord[:, k]), orig_snap[pending], max_dest_snap)
+            pending = pending[best[pending] > bound]
+            logger.info('{} origins unresolved after {} candidates'.format(len(pending), k))
+            k_done, k = k, min(2 * k, len(usable))
+
+    logger.info('Queried {} of {} O-D pairs ({:.2%})'.format(pairs, orig_n * dest_n, pairs / max(1, orig_n * dest_n)))
+    result = {'distance': np.where(np.isinf(best), np.nan, best), 'index': best_index, 'pairs': pairs}
+    if 'duration' in metrics:
+        result['duration'] = best_duration
+    return result
+
+
+def nearest_frame(result, orig_ids, dest_ids):
+    '''
+    (id_orig, distance, [duration,] id_dest) rows from query_nearest
+    '''
+    df = pd.DataFrame({'id_orig': orig_ids, 'distance': result['distance']})
+    if 'duration' in result:
+        df['duration'] = result['duration']
+    found = result['index'] >= 0
+    nearest_ids = np.full(len(df), None, dtype=object)
+    nearest_ids[found] = np.asarray(dest_ids)[result['index'][found]]
+    df['id_dest'] = nearest_ids
+    return df
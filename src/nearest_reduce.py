@@ -0,0 +1,84 @@
+'''
+Reduce streamed table results to each origin's nearest destinations
+- every tile is folded into a running k-nearest per origin and service as it
+  arrives, so the full matrix is never held, written or read back
+- the compact result replaces reading the whole table for
+  nearest_dist.determine_nearest
+'''
+import numpy as np
+import pandas as pd
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+class NearestReducer:
+    '''
+    the k nearest destinations of each service for every origin
+    services: the service (dest_type) of each destination
+    by: the metric destinations are ranked by; the other metrics are kept
+    for the same destinations
+    '''
+    def __init__(self, orig_n, services, metrics, k=1, by='distance'):
+        self.k = k
+        self.by = by if by in metrics else metrics[0]
+        self.metrics = [self.by] + [m for m in metrics if m != self.by]
+        self.services, self.codes = np.unique(np.asarray(services), return_inverse=True)
+        self.codes = self.codes.ravel()
+        # per service: (orig x k) destination positions (-1: none yet) and values
+        self.index = [np.full((orig_n, k), -1) for _ in self.services]
+        self.values = [{metric: np.full((orig_n, k), np.inf if metric == self.by else np.nan, dtype=np.float32)
+                        for metric in self.metrics} for _ in self.services]
+
+    def add(self, tile, values):
+        '''
+        fold one table_query tile into the running nearest
+        '''
+        rows = slice(tile.orig_start, tile.orig_stop)
+        # origin-major (orig x dest) views of the response
+        tile_values = {metric: values[metric].T if tile.transpose else values[metric] for metric in self.metrics}
+        codes = self.codes[tile.dest_start:tile.dest_stop]
+        for s in np.unique(codes):
+            cols = np.flatnonzero(codes == s)
+            index = np.concatenate([self.index[s][rows],
+                                    np.broadcast_to(tile.dest_start + cols, (tile.orig_stop - tile.orig_start, len(cols)))], axis=1)
+            ranked = np.concatenate([self.values[s][self.by][rows], tile_values[self.by][:, cols]], axis=1)
+            ranked = np.where(np.isnan(ranked), np.inf, ranked)
+            # the k smallest, in order (the running k are always among the candidates)
+            keep = np.argpartition(ranked, self.k - 1, axis=1)[:, :self.k]
+            keep = np.take_along_axis(keep, np.argsort(np.take_along_axis(ranked, keep, axis=1), axis=1), axis=1)
+            self.index[s][rows] = np.where(np.take_along_axis(ranked, keep, axis=1) < np.inf,
+                                           np.take_along_axis(index, keep, axis=1), -1)
+            for metric in self.metrics:
+                merged = ranked if metric == self.by else np.concatenate([self.values[s][metric][rows], tile_values[metric][:, cols]], axis=1)
+                self.values[s][metric][rows] = np.take_along_axis(merged, keep, axis=1)
+
+    def reduce(self, tiles):
+        '''
+        fold every (tile, values) pair from table_query.iter_tiles
+        '''
+        for tile, values in tiles:
+            self.add(tile, values)
+        return self
+
+    def frame(self, orig_ids, dest_ids):
+        '''
+        (id_orig, service, rank, metrics..., id_dest) rows; rank 0 is kept for
+        every origin (nan and no id_dest where nothing is reachable), later
+        ranks only where found
+        '''
+        orig_ids, dest_ids = np.asarray(orig_ids), np.asarray(dest_ids)
+        frames = []
+        for s, service in enumerate(self.services):
+            index = self.index[s]
+            df = pd.DataFrame({'id_orig': np.repeat(orig_ids, self.k),
+                               'service': str(service),
+                               'rank': np.tile(np.arange(self.k), len(orig_ids))})
+            for metric in self.metrics:
+                values = self.values[s][metric].ravel()
+                df[metric] = np.where(index.ravel() >= 0, values, np.nan)
+            nearest_ids = dest_ids[np.maximum(index.ravel(), 0)].astype(object)
+            nearest_ids[index.ravel() < 0] = None
+            df['id_dest'] = nearest_ids
+            frames.append(df[(df['rank'] == 0) | (index.ravel() >= 0)])
+        return pd.concat(frames, ignore_index=True)
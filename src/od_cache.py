@@ -0,0 +1,214 @@
+'''
+On-disk cache of table results
+- kept per transport profile and OSRM dataset fingerprint (see
+  init_osrm.dataset_fingerprint), so a rebuilt network starts a new cache
+- each completed run is saved as a segment: an access_matrix.AccessMatrix
+  whose ids are origin and destination coordinate keys
+- a run reads every pair the best matching segment holds and only queries
+  the origins and destinations it is missing
+'''
+import os
+import shutil
+import hashlib
+import itertools
+import numpy as np
+import pandas as pd
+from access_matrix import AccessMatrix
+import table_query
+import table_retry
+import table_tiles
+from table_tiles import Tile
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# where results are cached: {cache_directory}/{transport_mode}/{fingerprint}/{segment}/
+cache_directory = '/homedirs/man112/access_inequality_index/data/od_cache'
+
+
+def path(transport_mode, fingerprint):
+    return os.path.join(cache_directory, transport_mode, fingerprint)
+
+
+def coord_keys(xy):
+    '''
+    one key per coordinate, matched at 6 decimals (about 0.1 m)
+    '''
+    keys = np.round(np.asarray(xy, dtype=float) * 1e6).astype(np.int64)
+    return np.char.add(np.char.add(keys[:, 0].astype(str), ','), keys[:, 1].astype(str))
+
+
+def positions(index_keys, keys):
+    '''
+    position of each key in index_keys (the first, if repeated), -1 if absent
+    '''
+    index = pd.Index(index_keys)
+    if index.is_unique:
+        return index.get_indexer(keys)
+    first = np.flatnonzero(~index.duplicated())
+    found = index[first].get_indexer(keys)
+    return np.where(found >= 0, first[found], -1)
+
+
+def segments(directory):
+    '''
+    segment directories under directory (at any depth), newest first
+    '''
+    names = [root for root, dirs, files in os.walk(directory) if 'orig_ids.npy' in files]
+    names = [name for name in names if not os.path.basename(name).startswith('.')]
+    return sorted(names, key=os.path.getmtime, reverse=True)
+
+
+def size(directory):
+    return sum(os.path.getsize(os.path.join(directory, fn)) for fn in os.listdir(directory))
+
+
+class ODCache:
+    '''
+    the saved segments of one profile and dataset
+    max_gb: how much the whole cache (every profile and dataset) may hold,
+    the oldest segments are dropped beyond it
+    '''
+    def __init__(self, directory, max_gb=20):
+        self.directory = directory
+        self.max_gb = max_gb
+
+    def segments(self):
+        '''
+        segment directories, newest first
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        return segments(self.directory)
+
+    def best(self, orig_keys, dest_keys, metrics):
+        '''
+        (segment, row positions, column positions) of the segment holding the
+        most of the orig x dest pairs, or None
+        '''
+        found, covered = None, 0
+        for directory in self.segments():
+            segment = AccessMatrix.open(directory)
+            if not all(metric in segment.values for metric in metrics):
+                continue
+            rows = positions(segment.orig_ids, orig_keys)
+            cols = positions(segment.dest_ids, dest_keys)
+            pairs = (rows >= 0).sum() * (cols >= 0).sum()
+            if pairs > covered:
+                found, covered = (segment, rows, cols), pairs
+        return found
+
+    def prune(self):
+        '''
+        drop the oldest segments of the cache beyond max_gb (the newest is kept)
+        '''
+        total = 0
+        for i, directory in enumerate(segments(cache_directory)):
+            total += size(directory)
+            if i > 0 and total > self.max_gb * 2**30:
+                logger.info('Dropping the O-D cache segment {}'.format(directory))
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+class CachedRun:
+    '''
+    a table query run over orig x dest, split into cached and missing pairs
+
+    Origins and destinations are reordered (orig_order, dest_order) so that
+    those missing from the cache come first: the missing origins are queried
+    against every destination, the cached origins against the missing
+    destinations, and the rest is read from the cache. Once every tile has
+    passed through iter_tiles the run is saved as a new segment.
+    '''
+    def __init__(self, cache, orig_xy, dest_xy, options):
+        self.cache = cache
+        self.metrics = options['metrics']
+        orig_keys, dest_keys = coord_keys(orig_xy), coord_keys(dest_xy)
+        found = cache.best(orig_keys, dest_keys, self.metrics)
+        if found is None:
+            self.segment = None
+            rows, cols = np.full(len(orig_keys), -1), np.full(len(dest_keys), -1)
+        else:
+            self.segment, rows, cols = found
+        # missing first, cached last
+        self.orig_order = np.argsort(rows >= 0, kind='stable')
+        self.dest_order = np.argsort(cols >= 0, kind='stable')
+        self.rows, self.cols = rows[self.orig_order], cols[self.dest_order]
+        self.orig_keys, self.dest_keys = orig_keys[self.orig_order], dest_keys[self.dest_order]
+        orig_n, dest_n = len(rows), len(cols)
+        orig_missing, dest_missing = (rows < 0).sum(), (cols < 0).sum()
+
+        self.query_tiles = []
+        if orig_missing and dest_n:
+            self.query_tiles += table_query.plan(orig_missing, dest_n, options)
+        if orig_n - orig_missing and dest_missing:
+            self.query_tiles += [table_tiles.shift(tile, orig_offset=orig_missing)
+                                 for tile in table_query.plan(orig_n - orig_missing, dest_missing, options)]
+        self.cached_tiles = []
+        if orig_n - orig_missing and dest_n - dest_missing:
+            per = max(1, options['max_table_size'] // (dest_n - dest_missing))
+            self.cached_tiles = [Tile(start, min(start + per, orig_n), dest_missing, dest_n, False)
+                                 for start in range(orig_missing, orig_n, per)]
+        self.tiles = self.query_tiles + self.cached_tiles
+        cached = (orig_n - orig_missing) * (dest_n - dest_missing)
+        logger.info('{} of {} O-D pairs found in the cache'.format(cached, orig_n * dest_n))
+
+        digest = hashlib.sha1()
+        for keys in (self.orig_keys, self.dest_keys, self.metrics):
+            digest.update('\n'.join(keys).encode())
+        self.name = digest.hexdigest()
+
+    def read(self, tiles):
+        '''
+        (tile, values) of cached tiles, read from the segment
+        '''
+        for tile in tiles:
+            rows = self.rows[tile.orig_start:tile.orig_stop]
+            cols = self.cols[tile.dest_start:tile.dest_stop]
+            yield tile, {metric: np.asarray(self.segment.values[metric][np.ix_(rows, cols)])
+                         for metric in self.metrics}
+
+    def iter_tiles(self, orig_xy, dest_xy, options, tiles=None, quarantine=None):
+        '''
+        as table_query.iter_tiles, for orig_xy and dest_xy in orig_order and
+        dest_order: queried tiles first, then those read from the cache
+        '''
+        if tiles is None:
+            tiles = self.tiles
+        if quarantine is None:
+            quarantine = table_retry.Quarantine()
+        self.quarantine = quarantine
+        cached = set(self.cached_tiles)
+        results = itertools.chain(
+            table_query.iter_tiles(orig_xy, dest_xy, options, [tile for tile in tiles if tile not in cached], quarantine),
+            self.read([tile for tile in tiles if tile in cached]))
+        # a resumed run only sees part of the matrix, and quarantined pairs
+        # were never answered, so neither is saved
+        if len(tiles) < len(self.tiles):
+            return results
+        return self.record(results)
+
+    def record(self, results):
+        '''
+        pass (tile, values) through, saving the run as a segment at the end
+        '''
+        directory = os.path.join(self.cache.directory, self.name)
+        if os.path.exists(directory):
+            # nothing new: refresh it so it is kept
+            os.utime(directory)
+            yield from results
+            return
+        partial = os.path.join(self.cache.directory, '.' + self.name)
+        shutil.rmtree(partial, ignore_errors=True)
+        matrix = AccessMatrix.create(partial, self.orig_keys, self.dest_keys, self.metrics)
+        for tile, values in results:
+            matrix.write_tile(tile, values)
+            yield tile, values
+        matrix.flush()
+        del matrix
+        if self.quarantine:
+            shutil.rmtree(partial, ignore_errors=True)
+            return
+        os.rename(partial, directory)
+        self.cache.prune()
+        logger.info('Table results cached as {}'.format(directory))
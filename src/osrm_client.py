@@ -0,0 +1,234 @@
+'''
+Connection-pooled client for the OSRM table service
+- keep-alive sessions, one per worker thread
+- a bounded number of requests in flight at any time
+- requests spread over several osrm-routed endpoints serving the same data
+- throughput comparison against the joblib (process per request) path
+'''
+import time
+import threading
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+# functions - requests
+import requests
+from requests.adapters import HTTPAdapter
+# functions - parallel
+from joblib import Parallel, delayed
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+############## Endpoints ##############
+class Endpoints:
+    '''
+    osrm-routed instances serving the same dataset
+
+    Each request goes to the endpoint with the shortest expected wait: its
+    requests in flight (plus this one) times its recent latency. Endpoints
+    not yet timed are assumed as fast as the fastest, so each gets tried.
+    '''
+    def __init__(self, urls, smoothing=0.2):
+        self.urls = list(urls)
+        self.smoothing = smoothing
+        self.in_flight = [0] * len(self.urls)
+        # exponentially weighted mean seconds per request (None until timed)
+        self.latency = [None] * len(self.urls)
+        self.requests = [0] * len(self.urls)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        position of the endpoint to send the next request to
+        '''
+        with self._lock:
+            timed = [latency for latency in self.latency if latency is not None]
+            default = min(timed) if timed else 1.0
+            waits = [(n + 1) * (default if latency is None else latency)
+                     for n, latency in zip(self.in_flight, self.latency)]
+            i = waits.index(min(waits))
+            self.in_flight[i] += 1
+            return i
+
+    def release(self, i, seconds):
+        with self._lock:
+            self.in_flight[i] -= 1
+            self.requests[i] += 1
+            latency = self.latency[i]
+            self.latency[i] = seconds if latency is None else latency + self.smoothing * (seconds - latency)
+
+    def summary(self):
+        return {url: {'requests': n, 'latency_s': latency}
+                for url, n, latency in zip(self.urls, self.requests, self.latency)}
+
+
+############## Client ##############
+class TableClient:
+    '''
+    pooled-thread HTTP client for OSRM
+
+    Querying is I/O bound, so threads (not processes) are used and each thread
+    keeps one keep-alive session open to the server. At most `max_in_flight`
+    requests are outstanding; results are yielded in submission order.
+    endpoints: urls of osrm-routed instances serving the same data; urls
+    built for the first are sent to whichever Endpoints picks
+    run_metrics: a query_metrics.RunMetrics every request is recorded in
+    '''
+    def __init__(self, max_in_flight=None, timeout=300, endpoints=None, run_metrics=None):
+        endpoints = list(endpoints or [])
+        self.endpoints = Endpoints(endpoints) if len(endpoints) > 1 else None
+        self.max_in_flight = max_in_flight or default_in_flight() * max(1, len(endpoints))
+        self.timeout = timeout
+        self.run_metrics = run_metrics
+        if run_metrics is not None:
+            run_metrics.workers = self.max_in_flight
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def session(self):
+        '''
+        the keep-alive session belonging to the calling thread
+        (requests.Session is not safe to share between threads)
+        '''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            # osrm-routed compresses responses when asked
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            hosts = 1 if self.endpoints is None else len(self.endpoints.urls)
+            adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def get(self, url):
+        '''
+        GET on the calling thread's session (same call signature as requests.get)
+        '''
+        endpoint = None
+        if self.endpoints is not None:
+            base = self.endpoints.urls[0]
+            endpoint = self.endpoints.acquire()
+            if url.startswith(base):
+                url = self.endpoints.urls[endpoint] + url[len(base):]
+        start = time.perf_counter()
+        try:
+            response = self.session().get(url, timeout=self.timeout)
+        except Exception:
+            if endpoint is not None:
+                # an endpoint that fails is treated as timing out, so load moves off it
+                self.endpoints.release(endpoint, self.timeout)
+            if self.run_metrics is not None:
+                self.run_metrics.request(time.perf_counter() - start, 0, self._endpoint_url(endpoint), failed=True)
+            raise
+        seconds = time.perf_counter() - start
+        if endpoint is not None:
+            self.endpoints.release(endpoint, seconds)
+        if self.run_metrics is not None:
+            self.run_metrics.request(seconds, len(response.content), self._endpoint_url(endpoint),
+                                     failed=response.status_code >= 400)
+        return response
+
+    def _endpoint_url(self, endpoint):
+        return None if endpoint is None else self.endpoints.urls[endpoint]
+
+    def imap(self, func, items):
+        '''
+        lazily apply func to each item on the thread pool, keeping at most
+        max_in_flight calls outstanding, and yield the results in order
+        '''
+        window = deque()
+        for item in items:
+            if len(window) >= self.max_in_flight:
+                yield window.popleft().result()
+            window.append(self._pool.submit(func, item))
+        while window:
+            yield window.popleft().result()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        if self.endpoints is not None:
+            logger.info('Requests per endpoint: {}'.format(self.endpoints.summary()))
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+
+
+def default_in_flight():
+    '''
+    the OSRM server answers with one thread per core, so a window of about
+    that size keeps it busy without queueing requests on the server
+    '''
+    return mp.cpu_count()
+
+
+def in_flight(config):
+    '''
+    the in-flight window from the config ('OSRM': 'max_in_flight'), by
+    default one per core for each endpoint
+    '''
+    osrm = config.get('OSRM', {})
+    return osrm.get('max_in_flight') or default_in_flight() * max(1, len(osrm.get('endpoints') or []))
+
+
+def client(options):
+    '''
+    the client for a table_query options dict
+    '''
+    return TableClient(max_in_flight=options['max_in_flight'], endpoints=options.get('endpoints'),
+                       run_metrics=options.get('run_metrics'))
+
+
+############## Throughput Comparison ##############
+def _joblib_get(query_string, parse):
+    # the current path: a new connection per request in a worker process
+    return parse(requests.get(query_string).json())
+
+
+def _flatten(response):
+    # the same reshaping today's req() does on each response
+    return [[item for row in response[key] for item in row]
+            for key in ('distances', 'durations') if key in response]
+
+
+def compare_throughput(query_list, pairs, num_workers, max_in_flight=None, parse=_flatten):
+    '''
+    time the same list of table queries (covering `pairs` O-D pairs) through
+    the joblib path and the pooled client; parse is applied to each response
+    in both paths (in the joblib path its result is pickled back to the
+    parent, as happens today)
+    '''
+    timings = {}
+    # joblib path
+    start = time.perf_counter()
+    Parallel(n_jobs=num_workers)(delayed(_joblib_get)(q, parse) for q in query_list)
+    timings['joblib'] = time.perf_counter() - start
+    # pooled client
+    start = time.perf_counter()
+    with TableClient(max_in_flight=max_in_flight) as client:
+        for _ in client.imap(lambda q: parse(client.get(q).json()), query_list):
+            pass
+    timings['pooled'] = time.perf_counter() - start
+
+    summary = {'requests': len(query_list), 'pairs': pairs}
+    for path, seconds in timings.items():
+        summary[path] = {'seconds': seconds,
+                         'requests_per_s': len(query_list)/seconds,
+                         'pairs_per_s': pairs/seconds}
+        logger.info('{:>7}: {:.1f}s, {:.1f} requests/s, {:.0f} pairs/s'.format(
+                    path, seconds, len(query_list)/seconds, pairs/seconds))
+    logger.info('Pooled client speed-up: {:.2f}x'.format(timings['joblib']/timings['pooled']))
+    return summary
@@ -0,0 +1,127 @@
+'''
+Choose between OSRM's routing algorithms for a region by timing them
+- MLD (osrm-partition + osrm-customize) and CH (osrm-contract) can be
+  compiled side by side from one osrm-extract; init_osrm starts osrm-routed
+  with each in turn and times the same table requests against it
+- probe points are drawn inside the extract's bounding box, read from the
+  .osm.pbf header
+- the choice is kept next to the compiled data with the dataset fingerprint,
+  so it is only probed again when the extract changes
+'''
+import os
+import json
+import time
+import struct
+import zlib
+import numpy as np
+import requests
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+algorithms = ('mld', 'ch')
+
+
+############## Extract Bounds ##############
+def fields(buffer):
+    '''
+    {field number: value} of a protobuf message (varints and length-delimited
+    fields only, the last occurrence wins)
+    '''
+    values, i = {}, 0
+    while i < len(buffer):
+        key, i = varint(buffer, i)
+        number, wire = key >> 3, key & 7
+        if wire == 0:
+            values[number], i = varint(buffer, i)
+        elif wire == 2:
+            length, i = varint(buffer, i)
+            values[number], i = buffer[i:i + length], i + length
+        else:
+            # fixed 64 or 32 bit
+            i += 8 if wire == 1 else 4
+    return values
+
+
+def varint(buffer, i):
+    value = shift = 0
+    while True:
+        byte = buffer[i]
+        value |= (byte & 0x7f) << shift
+        i, shift = i + 1, shift + 7
+        if byte < 0x80:
+            return value, i
+
+
+def pbf_bbox(pbf):
+    '''
+    (left, bottom, right, top) of an .osm.pbf's header, None if it has none
+    https://wiki.openstreetmap.org/wiki/PBF_Format
+    '''
+    with open(pbf, 'rb') as file:
+        length = struct.unpack('>I', file.read(4))[0]
+        blob_header = fields(file.read(length))
+        blob = fields(file.read(blob_header[3]))
+    header = fields(zlib.decompress(blob[3]) if 3 in blob else blob.get(1, b''))
+    if 1 not in header:
+        return None
+    # sint64 nanodegrees, zigzag encoded
+    bbox = {k: ((v >> 1) ^ -(v & 1)) * 1e-9 for k, v in fields(header[1]).items()}
+    return bbox[1], bbox[4], bbox[2], bbox[3]
+
+
+def probe_points(bbox, n=100, seed=0):
+    '''
+    n (lon, lat) points spread over the middle of the bounding box
+    '''
+    left, bottom, right, top = bbox
+    rng = np.random.default_rng(seed)
+    # the middle half, as extracts' boxes reach into sea and neighbouring regions
+    lon = left + (right - left) * rng.uniform(0.25, 0.75, n)
+    lat = bottom + (top - bottom) * rng.uniform(0.25, 0.75, n)
+    return np.column_stack([lon, lat])
+
+
+############## Timing ##############
+def time_table(osrm_url, transport_mode, points, repeats=5):
+    '''
+    median seconds of an all-to-all table request between the points
+    (after one untimed request to warm the server up)
+    '''
+    url = '{}/table/v1/{}/{}?annotations=duration,distance'.format(
+        osrm_url, transport_mode, ';'.join('{:.6f},{:.6f}'.format(x, y) for x, y in points))
+    seconds = []
+    for i in range(repeats + 1):
+        started = time.perf_counter()
+        requests.get(url, timeout=300).raise_for_status()
+        seconds.append(time.perf_counter() - started)
+    return float(np.median(seconds[1:]))
+
+
+############## Record ##############
+def record_path(directory, state_name):
+    return os.path.join(directory, '{}-latest.osrm.probe.json'.format(state_name))
+
+
+def recorded(directory, state_name, fingerprint):
+    '''
+    the algorithm chosen for this dataset before, None if it was not probed
+    '''
+    try:
+        with open(record_path(directory, state_name)) as file:
+            record = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return record['algorithm'] if record.get('fingerprint') == fingerprint else None
+
+
+def record(directory, state_name, fingerprint, seconds):
+    '''
+    keep the timings and the faster algorithm; returns the faster algorithm
+    '''
+    algorithm = min(seconds, key=seconds.get)
+    with open(record_path(directory, state_name), 'w') as file:
+        json.dump({'fingerprint': fingerprint, 'algorithm': algorithm, 'seconds': seconds}, file, indent=2)
+    logger.info('Table request timings {}: using {}'.format(
+        ', '.join('{} {:.3f}s'.format(k, v) for k, v in seconds.items()), algorithm))
+    return algorithm
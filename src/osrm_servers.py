@@ -0,0 +1,216 @@
+'''
+Lifecycle of the osrm-routed containers across runs
+- readiness: work is only released once the server answers
+- reuse: containers are labelled with the dataset fingerprint (see
+  init_osrm.dataset_fingerprint), a running container with a matching label
+  is used as it is instead of reloading the data
+- warm servers are kept after a run, up to a memory bound, stopping the
+  least recently used first; each keeps its own host port(s)
+- a server may be several osrm-routed workers on consecutive ports sharing
+  one osrm-datastore dataset; the first container owns it, the others are
+  labelled with its name and stopped with it
+'''
+import os
+import json
+import time
+import socket
+import subprocess
+import requests
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# the warm containers: {name: {'last_used': unix time, 'port': first host port, 'workers': ports used}}
+registry_path = '/homedirs/man112/access_inequality_index/data/osrm_servers.json'
+
+# docker stats' memory units
+units = {'B': 1, 'KiB': 2**10, 'MiB': 2**20, 'GiB': 2**30, 'TiB': 2**40,
+         'kB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12}
+
+
+############## Readiness ##############
+def wait_ready(osrm_url, transport_mode, timeout=600):
+    '''
+    poll osrm-routed until it answers (any HTTP response: it only listens
+    once it has loaded the data)
+    '''
+    started = time.time()
+    while time.time() - started < timeout:
+        try:
+            requests.get('{}/nearest/v1/{}/0,0'.format(osrm_url, transport_mode), timeout=5)
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(1)
+    logger.warning('{} did not answer within {}s'.format(osrm_url, timeout))
+    return False
+
+
+############## Containers ##############
+def label_args(fingerprint, algorithm, port, workers=1, max_table_size=100000):
+    '''
+    docker run arguments labelling a container with what it serves
+    '''
+    return ['--label', 'osrm.fingerprint={}'.format(fingerprint),
+            '--label', 'osrm.algorithm={}'.format(algorithm),
+            '--label', 'osrm.port={}'.format(port),
+            '--label', 'osrm.workers={}'.format(workers),
+            '--label', 'osrm.max_table_size={}'.format(max_table_size)]
+
+
+def worker_args(owner):
+    '''
+    docker run arguments for a worker of the owner's shared-memory dataset
+    '''
+    return ['--ipc=container:{}'.format(owner), '--label', 'osrm.owner={}'.format(owner)]
+
+
+def inspect(name):
+    '''
+    the labels of a running container, None if it is not running
+    '''
+    p = subprocess.run(['docker', 'inspect', '--format', '{{json .Config.Labels}} {{.State.Running}}', name],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    if p.returncode != 0:
+        return None
+    labels, running = p.stdout.strip().rsplit(' ', 1)
+    return (json.loads(labels) or {}) if running == 'true' else None
+
+
+def warm(name, fingerprint, algorithm=None, workers=1, max_table_size=100000):
+    '''
+    the labels of the container if it is running on this dataset (and
+    algorithm, if given) with all its workers and this --max-table-size,
+    else None
+    '''
+    labels = inspect(name)
+    if labels is None or labels.get('osrm.fingerprint') != fingerprint:
+        return None
+    if labels.get('osrm.max_table_size') != str(max_table_size):
+        return None
+    if algorithm is not None and labels.get('osrm.algorithm') != algorithm:
+        return None
+    if labels.get('osrm.workers', '1') != str(workers) or any(inspect(worker) is None for worker in worker_names(name, workers)):
+        return None
+    return labels
+
+
+def worker_names(name, workers):
+    '''
+    the containers of a server's other workers
+    '''
+    return ['{}-{}'.format(name, i) for i in range(1, workers)]
+
+
+def stop(name):
+    '''
+    stop and remove a container, and the workers sharing its dataset
+    '''
+    p = subprocess.run(['docker', 'ps', '-aq', '--filter', 'label=osrm.owner={}'.format(name)],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    for worker in p.stdout.split():
+        for com in ['docker stop {}'.format(worker), 'docker rm {}'.format(worker)]:
+            subprocess.run(com.split(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for com in ['docker stop {}'.format(name), 'docker rm {}'.format(name)]:
+        subprocess.run(com.split(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    servers = load()
+    if servers.pop(name, None) is not None:
+        save(servers)
+
+
+def memory(name):
+    '''
+    bytes a container is using (0 if docker stats cannot tell)
+    '''
+    p = subprocess.run(['docker', 'stats', '--no-stream', '--format', '{{.MemUsage}}', name],
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    usage = p.stdout.split('/')[0].strip()
+    for unit in sorted(units, key=len, reverse=True):
+        if usage.endswith(unit):
+            try:
+                return float(usage[:-len(unit)]) * units[unit]
+            except ValueError:
+                break
+    return 0
+
+
+def dataset_size(directory, state_name):
+    '''
+    bytes of a compiled network, roughly what osrm-routed loads
+    '''
+    prefix = '{}-latest.osrm'.format(state_name)
+    return sum(os.path.getsize(os.path.join(directory, fn)) for fn in os.listdir(directory) if fn.startswith(prefix))
+
+
+############## Registry ##############
+def load():
+    try:
+        with open(registry_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(servers):
+    os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    with open(registry_path, 'w') as file:
+        json.dump(servers, file, indent=2)
+
+
+def touch(name, port, workers=1):
+    '''
+    mark a container as just used
+    '''
+    servers = load()
+    servers[name] = {'last_used': time.time(), 'port': int(port), 'workers': int(workers)}
+    save(servers)
+
+
+def running():
+    '''
+    the registry's containers that are still running (the others are dropped)
+    '''
+    servers = {name: server for name, server in load().items() if inspect(name) is not None}
+    save(servers)
+    return servers
+
+
+def free_port(port, exclude=(), taken=(), n=1):
+    '''
+    the first port from `port` starting n consecutive ports that no other
+    warm container holds and can be bound
+    exclude: containers whose ports may be taken over (they are about to be replaced)
+    '''
+    held = set(taken)
+    for name, server in running().items():
+        if name not in exclude:
+            held.update(range(server['port'], server['port'] + server.get('workers', 1)))
+    port = int(port)
+    while any(p in held or not bindable(p) for p in range(port, port + n)):
+        port += 1
+    return port
+
+
+def bindable(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('', port))
+            return True
+        except OSError:
+            return False
+
+
+def evict(limit_gb, keep=(), reserve=0):
+    '''
+    stop the least recently used warm containers until they use at most
+    limit_gb (less `reserve` bytes, for a server about to start)
+    keep: containers not to stop
+    '''
+    servers = running()
+    used = {name: memory(name) for name in servers}
+    for name in sorted(servers, key=lambda name: servers[name]['last_used']):
+        if sum(used.values()) + reserve <= limit_gb * 2**30:
+            break
+        if name in keep:
+            continue
+        logger.info('Stopping {} ({:.1f} GiB), the least recently used warm server'.format(name, used.pop(name) / 2**30))
+        stop(name)
@@ -22,12 +22,24 @@ from sqlalchemy.types import Float, Integer
 from sqlalchemy.engine import create_engine
 # functions - parallel
 import multiprocessing as mp
-from joblib import Parallel, delayed
 from tqdm import tqdm
 # functions - requests
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+import osrm_client
+import table_query
+import table_stream
+import access_matrix
+import run_manifest
+import nearest_query
+import snap_dedup
+import od_cache
+import table_retry
+import nearest_reduce
+import query_metrics
+import spatial_order
+import init_osrm
+import unreachable
+import road_graph
+import circuity
 # functions - logging
 import logging
 logging.basicConfig(
@@ -50,9 +62,44 @@ def main(config):
     elif config['script_mode'] == 'query':
         # query the distances
         logger.info('Querying invoked for {} in {}'.format(config['transport_mode'], config['location']['state']))
-        origxdest = query_points(db, config)
-        # add df to sql
-        write_to_postgres(origxdest, db)
+        config['run_metrics'] = query_metrics.RunMetrics('{}_{}'.format(config['location']['state'], db['table_name']))
+        if not config['SQL'].get('matrix', False):
+            # a matrix saved from an earlier run would no longer match the table
+            access_matrix.discard(config['location']['state'], db['table_name'], init_osrm.transport_modes(config))
+        origxdest, manifest, quarantine, requeries = query_points(db, config)
+        # add to sql, each batch is written as it arrives
+        write_to_postgres(origxdest, db, manifest=manifest)
+        # points whose requests kept failing
+        write_quarantine(quarantine, db)
+        # origins that came out unreachable, queried again from other points
+        write_requeried(requeries, db, config)
+        query_metrics.write(config['run_metrics'], config['OSRM'].get('prometheus_textfile'))
+    elif config['script_mode'] == 'nearest':
+        # only the nearest destination of each service, without the full matrix
+        # (for the first transport mode, if several are listed)
+        config = next(iter(mode_configs(config).values()))
+        logger.info('Nearest querying invoked for {} in {}'.format(config['transport_mode'], config['location']['state']))
+        config['run_metrics'] = query_metrics.RunMetrics('{}_nearest_dist'.format(config['location']['state']))
+        query_nearest(db, config)
+        query_metrics.write(config['run_metrics'], config['OSRM'].get('prometheus_textfile'))
+    elif config['script_mode'] == 'estimate':
+        # screening run: nearest distances as straight-line distance x a circuity
+        # factor calibrated on a sample of table queries
+        config = next(iter(mode_configs(config).values()))
+        logger.info('Circuity estimate invoked for {} in {}'.format(config['transport_mode'], config['location']['state']))
+        config['run_metrics'] = query_metrics.RunMetrics('{}_circuity'.format(config['location']['state']))
+        estimate_nearest(db, config)
+        query_metrics.write(config['run_metrics'], config['OSRM'].get('prometheus_textfile'))
+    elif config['script_mode'] == 'compare_client':
+        # time the pooled client against the joblib path on the real queries
+        config = next(iter(mode_configs(config).values()))
+        orig_df, dest_df = prepare_points(db, config)
+        options = table_query.options_from_config(config)
+        queries = table_query.iter_queries(orig_df[['x','y']].values, dest_df[['lon','lat']].values, options)
+        query_list = [query_string for tile, query_string in queries]
+        num_workers = int(mp.cpu_count() * config['par_frac'])
+        osrm_client.compare_throughput(query_list, len(orig_df)*len(dest_df), num_workers,
+                                        max_in_flight=osrm_client.in_flight(config))
 
     # close the connection
     db['con'].close()
@@ -75,6 +122,86 @@ def init_db(config):
 def query_points(db, config):
     '''
     query OSRM for distances between origins and destinations
+    returns a generator of (tile, origxdest frame), one per table request,
+    the run manifest (None if resuming is off), the quarantine of points
+    whose requests failed (filled as the generator runs) and a dict of mode:
+    unreachable.Requery (empty unless OSRM.requery_unreachable is set)
+    '''
+    orig_df, dest_df = prepare_points(db, config)
+    manifest = None
+    if config['OSRM'].get('resume', True):
+        # skip the table requests a previous run already wrote
+        manifest = run_manifest.RunManifest(db, config['SQL']['table_name'])
+    configs = mode_configs(config)
+    multi = len(configs) > 1
+    quarantine, requeries, streams = {}, {}, []
+    for mode, mode_config in configs.items():
+        quarantine[mode] = table_retry.Quarantine()
+        # df of durations, distances and ids, one table request at a time
+        frames = execute_table_query(orig_df, dest_df, mode_config, manifest, quarantine[mode], mode if multi else None)
+        if config['OSRM'].get('requery_unreachable', False) and config['OSRM'].get('engine', 'osrm') == 'osrm':
+            # count each origin's unreachable pairs as the frames go by
+            requeries[mode] = requery_unreachable(orig_df, dest_df, mode_config, mode if multi else None)
+            frames = requeries[mode].watch(frames)
+        streams.append(frames)
+    if not multi:
+        return streams[0], manifest, quarantine[mode], requeries
+    # several modes: the points are prepared once and the modes' table
+    # requests interleaved, into one table with a 'mode' column
+    return interleave(streams), manifest, quarantine, requeries
+
+def requery_unreachable(orig_df, dest_df, config, mode=None):
+    '''
+    the unreachable.Requery for a run, with the same columns as its frames
+    '''
+    dest_cols = {'dest_type': dest_df['dest_type'].values}
+    if mode is not None:
+        dest_cols['mode'] = np.full(len(dest_df), mode)
+    surface_xy = orig_df[['x_surface','y_surface']].values if 'x_surface' in orig_df else None
+    osrm = config['OSRM']
+    return unreachable.Requery(orig_df.index.values, orig_df[['x','y']].values, surface_xy,
+                               dest_df.index.values, dest_df[['lon','lat']].values,
+                               table_query.options_from_config(config), dest_cols,
+                               threshold=osrm.get('unreachable_share', 0.5),
+                               max_circuity=osrm.get('max_circuity', 4.0),
+                               number=osrm.get('resnap_candidates', 5))
+
+def mode_configs(config):
+    '''
+    one config per transport mode (transport_mode may be a list), each
+    pointing at the mode's osrm-routed and network (see init_osrm.mode_urls)
+    '''
+    modes = init_osrm.transport_modes(config)
+    if len(modes) == 1:
+        return {modes[0]: dict(config, transport_mode=modes[0])}
+    urls = init_osrm.mode_urls(config)
+    configs = {}
+    for mode in modes:
+        osrm = dict(config['OSRM'])
+        osrm['host'], osrm['port'] = urls[mode].rsplit(':', 1)
+        osrm['fingerprint'] = (osrm.get('fingerprints') or {}).get(mode)
+        if mode != modes[0]:
+            # the extra endpoints serve the first mode's network
+            osrm['endpoints'] = None
+        configs[mode] = dict(config, transport_mode=mode, OSRM=osrm)
+    return configs
+
+def interleave(streams):
+    '''
+    take from each generator in turn until all are done, so every mode's
+    requests are kept in flight
+    '''
+    streams = list(streams)
+    while streams:
+        for stream in list(streams):
+            try:
+                yield next(stream)
+            except StopIteration:
+                streams.remove(stream)
+
+def prepare_points(db, config):
+    '''
+    load the origins (block centroids) and destinations from the database
     '''
     location = config['location']
     # connect to db
@@ -86,6 +213,9 @@ def query_points(db, config):
 
     orig_df['x'] = orig_df.geom.centroid.x
     orig_df['y'] = orig_df.geom.centroid.y
+    # a point inside the block, to query from if the centroid snaps badly
+    surface = orig_df.geom.representative_point()
+    orig_df['x_surface'], orig_df['y_surface'] = surface.x, surface.y
     # drop duplicates
     orig_df.drop('geom',axis=1,inplace=True)
     orig_df.drop_duplicates(inplace=True)
@@ -106,92 +236,226 @@ def query_points(db, config):
     dest_df = dest_df.set_index('id')
     dest_df['lon'] = dest_df.geom.centroid.x
     dest_df['lat'] = dest_df.geom.centroid.y
-    # list of origxdest pairs
-    origxdest = pd.DataFrame(list(itertools.product(orig_df.index, dest_df.index)), columns = ['id_orig', 'id_dest'])
-    for metric in config['metric']:
-        origxdest['{}'.format(metric)] = None
-    origxdest['dest_type'] = len(orig_df)*list(dest_df['dest_type'])
-    # df of durations, distances, ids, and co-ordinates
-    origxdest = execute_table_query(origxdest, orig_df, dest_df, config)
-    return origxdest
+    return orig_df, dest_df
 
 ############## Parallel Table Query ##############
-def execute_table_query(origxdest, orig_df, dest_df, config):
+def execute_table_query(orig_df, dest_df, config, manifest=None, quarantine=None, mode=None):
+    '''
+    (tile, origxdest frame) pairs; with mode (a multi-mode run) the frames
+    get a 'mode' column and the tiles are (mode, tile)
+    '''
+    tiles, orig_ids, dest_ids, dest_types = query_tiles(orig_df, dest_df, config, manifest, quarantine, mode)
+    table_name = config['SQL']['table_name'] if mode is None else '{}_{}'.format(config['SQL']['table_name'], mode)
+    if config['SQL'].get('matrix', False):
+        # also keep the dense matrix for memory-mapped reading
+        matrix = access_matrix.open_for_writing(access_matrix.path(config['location']['state'], table_name),
+                                                orig_ids, dest_ids, config['metric'],
+                                                resume=manifest is not None and manifest.resumed)
+        tiles = access_matrix.record(tiles, matrix)
+    # origxdest rows for each tile, never the full product at once
+    dest_cols = {'dest_type': dest_types}
+    if mode is None:
+        return table_stream.tile_frames(tiles, orig_ids, dest_ids, config['metric'], dest_cols)
+    dest_cols['mode'] = np.full(len(dest_ids), mode)
+    frames = table_stream.tile_frames(tiles, orig_ids, dest_ids, config['metric'], dest_cols)
+    return (((mode, tile), frame) for tile, frame in frames)
+
+def query_tiles(orig_df, dest_df, config, manifest=None, quarantine=None, mode=None):
+    '''
+    generator of (tile, values) covering orig x dest, and the origin ids,
+    destination ids and destination types in the order the tiles index them
+    mode: the transport mode, in a multi-mode run (for the manifest)
+    '''
+    if config['OSRM'].get('engine', 'osrm') == 'graph':
+        return graph_tiles(orig_df, dest_df, config, manifest, mode)
     # Use the table service so as to reduce the amount of requests sent
     # https://github.com/Project-OSRM/osrm-backend/blob/master/docs/http.md#table-service
-
-    batch_limit = 10000
-    dest_n = len(dest_df)
-    orig_n = len(orig_df)
-    orig_per_batch = int(batch_limit/dest_n)
-    batch_n = math.ceil(orig_n/orig_per_batch)
-
-    #create query string
-    osrm_url = config['OSRM']['host'] + ':' + config['OSRM']['port']
-    base_string = osrm_url + "/table/v1/{}/".format(config['transport_mode'])
-
-    # make a string of all the destination coordinates
-    dest_string = ""
-    dest_df.reset_index(inplace=True, drop=True)
-    for j in range(dest_n):
-        #now add each dest in the string
-        dest_string += str(dest_df['lon'][j]) + "," + str(dest_df['lat'][j]) + ";"
-    #remove last semi colon
-    dest_string = dest_string[:-1]
-
-    # options string ('?annotations=duration,distance' will give distance and duration)
-    if len(config['metric']) == 2:
-        options_string_base = '?annotations=duration,distance'
+    options = table_query.options_from_config(config)
+    orig_xy, dest_xy = orig_df[['x','y']].values, dest_df[['lon','lat']].values
+    orig_ids, dest_ids, dest_types = orig_df.index.values, dest_df.index.values, dest_df['dest_type'].values
+    dedup = config['OSRM'].get('snap_dedup', False)
+    curve = config['OSRM'].get('spatial_order')
+    if dedup:
+        # query each network point once, the rows are fanned back out below
+        snaps = snap_dedup.SnapCache(snap_dedup.path(config['location']['state'], config['transport_mode'], config['OSRM'].get('fingerprint')))
+        precision = config['OSRM'].get('snap_precision', 6)
+        orig = snap_dedup.snap_groups(orig_xy, options, snaps, precision)
+        dest = snap_dedup.snap_groups(dest_xy, options, snaps, precision)
+        snaps.save()
+        if curve:
+            orig.permute(spatial_order.order(orig.xy, curve))
+            dest.permute(spatial_order.order(dest.xy, curve))
+        query_xy = orig.xy, dest.xy
     else:
-        options_string_base = '?annotations={}'.format(config['metric'][0]) #'?annotations=duration,distance'
-    # loop through the sets of
-    orig_sets = [(i, min(i+orig_per_batch, orig_n)) for i in range(0,orig_n,orig_per_batch)]
-
-    # create a list of queries
-    query_list = []
-    for i in orig_sets:
-        # make a string of all the origin coordinates
-        orig_string = ""
-        orig_ids = range(i[0],i[1])
-        for j in orig_ids:
-            #now add each dest in the string
-            orig_string += str(orig_df.x[j]) + "," + str(orig_df.y[j]) + ";"
-        # make a string of the number of the sources
-        source_str = '&sources=' + str(list(range(len(orig_ids))))[1:-1].replace(' ','').replace(',',';')
-        # make the string for the destinations
-        dest_idx_str = '&destinations=' + str(list(range(len(orig_ids), len(orig_ids)+len(dest_df))))[1:-1].replace(' ','').replace(',',';')
-        # combine and create the query string
-        options_string = options_string_base + source_str + dest_idx_str
-        query_string = base_string + orig_string + dest_string + options_string
-        # append to list of queries
-        query_list.append(query_string)
-    # # Table Query OSRM in parallel
-    #define cpu usage
-    num_workers = np.int(mp.cpu_count() * config['par_frac'])
-    #gets list of tuples which contain 1list of distances and 1list
-    logger.info('Querying the origin-destination pairs:')
-    results = Parallel(n_jobs=num_workers)(delayed(req)(query_string, config) for query_string in tqdm(query_list))
-    logger.info('Querying complete.')
-    # get the results in the right format
-    if len(config['metric']) == 2:
-        dists = [l for orig in results for l in orig[0]]
-        durs = [l for orig in results for l in orig[1]]
-        origxdest['distance'] = dists
-        origxdest['duration'] = durs
+        if curve:
+            # neighbouring origins share a request, neighbouring destinations a tile
+            orig_order, dest_order = spatial_order.order(orig_xy, curve), spatial_order.order(dest_xy, curve)
+            orig_xy, orig_ids = orig_xy[orig_order], orig_ids[orig_order]
+            dest_xy, dest_ids, dest_types = dest_xy[dest_order], dest_ids[dest_order], dest_types[dest_order]
+        query_xy = orig_xy, dest_xy
+    cached = None
+    if config['OSRM'].get('od_cache', False):
+        fingerprint = config['OSRM'].get('fingerprint')
+        if fingerprint is None:
+            logger.warning('No dataset fingerprint (set by init_osrm), the O-D cache is not used')
+        else:
+            # only query the pairs earlier runs on this dataset did not
+            cache = od_cache.ODCache(od_cache.path(config['transport_mode'], fingerprint), config['OSRM'].get('od_cache_gb', 20))
+            cached = od_cache.CachedRun(cache, query_xy[0], query_xy[1], options)
+            if dedup:
+                orig.permute(cached.orig_order)
+                dest.permute(cached.dest_order)
+                query_xy = orig.xy, dest.xy
+            else:
+                orig_xy, orig_ids = orig_xy[cached.orig_order], orig_ids[cached.orig_order]
+                dest_xy, dest_ids, dest_types = dest_xy[cached.dest_order], dest_ids[cached.dest_order], dest_types[cached.dest_order]
+                query_xy = orig_xy, dest_xy
+    if cached is not None:
+        tiles = cached.tiles
     else:
-        formed_results = [result for query in results for result in query]
-        origxdest['{}'.format(config['metric'][0])] = formed_results
-    return(origxdest)
-
-############## Read JSON ##############
-def req(query_string, config):
-    response = requests.get(query_string).json()
-    if len(config['metric']) == 2:
-        temp_dist = [item for sublist in response['distances'] for item in sublist]
-        temp_dur = [item for sublist in response['durations'] for item in sublist]
-        return temp_dist, temp_dur
+        tiles = table_query.plan(len(query_xy[0]), len(query_xy[1]), options)
+    if dedup:
+        # the original points, ordered so points sharing a network point are adjacent
+        orig_xy, orig_ids = orig.grouped(orig_xy), orig.grouped(orig_ids)
+        dest_xy, dest_ids, dest_types = dest.grouped(dest_xy), dest.grouped(dest_ids), dest.grouped(dest_types)
+        unique_tiles = {snap_dedup.expand_tile(tile, orig, dest): tile for tile in tiles}
+        tiles = list(unique_tiles)
+    if manifest is not None:
+        tiles = manifest.resume(tiles, orig_xy, dest_xy, orig_ids, dest_ids, options, mode)
+    logger.info('Querying the origin-destination pairs:')
+    if dedup:
+        tiles = [unique_tiles[tile] for tile in tiles]
+    if quarantine is not None:
+        # the ids behind each queried point, for the report
+        if dedup:
+            quarantine.orig_ids = np.split(orig_ids, orig.starts[1:-1])
+            quarantine.dest_ids = np.split(dest_ids, dest.starts[1:-1])
+        else:
+            quarantine.orig_ids, quarantine.dest_ids = orig_ids, dest_ids
+    fetch = table_query.iter_tiles if cached is None else cached.iter_tiles
+    tiles = fetch(query_xy[0], query_xy[1], options, tiles, quarantine)
+    if dedup:
+        tiles = snap_dedup.fan_out(tiles, orig, dest, offsets=config['OSRM'].get('snap_offset', False))
+    return tiles, orig_ids, dest_ids, dest_types
+
+
+############## Nearest Query ##############
+def query_nearest(db, config):
+    '''
+    nearest destination of each service for every origin, written in the
+    format of nearest_dist.py's 'nearest_dist' table (plus id_dest and duration)
+    With OSRM.nearest_k above 1 the k nearest are also written to 'nearest_k'.
+    '''
+    orig_df, dest_df = prepare_points(db, config)
+    k = config['OSRM'].get('nearest_k', 1)
+    if config['OSRM'].get('engine', 'osrm') == 'graph':
+        # one multi-source Dijkstra per service, in process
+        df = graph_nearest(orig_df, dest_df, config)
+    elif config['OSRM'].get('nearest_pruning', True) and k == 1:
+        # only query the destinations that could be nearest
+        df, quarantine = query_nearest_pruned(orig_df, dest_df, config)
+        write_quarantine(quarantine, db, key='service')
     else:
-        return [item for sublist in response['{}s'.format(config['metric'][0])] for item in sublist]
+        # query everything, reducing each table request as it arrives
+        quarantine = table_retry.Quarantine()
+        tiles, orig_ids, dest_ids, dest_types = query_tiles(orig_df, dest_df, config, quarantine=quarantine)
+        reducer = nearest_reduce.NearestReducer(len(orig_ids), dest_types, config['metric'], k)
+        df = reducer.reduce(tiles).frame(orig_ids, dest_ids)
+        write_quarantine(quarantine, db)
+        if k > 1:
+            df.to_sql('nearest_k', con=db['engine'], if_exists='replace', index=False)
+        df = df[df['rank'] == 0].drop(columns='rank')
+    write_nearest_dist(df, db)
+
+def write_nearest_dist(df, db):
+    '''
+    (id_orig, distance, [duration,] id_dest, service) rows to the 'nearest_dist' table
+    '''
+    # same columns as nearest_dist.py, as they are needed in simulation.py
+    df['time_stamp'] = '0'
+    df['sim_num'] = 0
+    df['metric'] = 0
+    df.sort_values(by=['id_orig', 'service'], inplace=True)
+    # add df to sql, if it exists it will be replaced
+    df.to_sql('nearest_dist', con=db['engine'], if_exists='replace', index=False)
+    cursor = db['con'].cursor()
+    cursor.execute('CREATE INDEX on nearest_dist (time_stamp);')
+    db['con'].commit()
+
+def query_nearest_pruned(orig_df, dest_df, config):
+    '''
+    nearest destination of each service, skipping the destinations a
+    great-circle lower bound rules out (see nearest_query)
+    returns the rows and a dict of service: the quarantine of points whose
+    requests failed
+    '''
+    options = table_query.options_from_config(config)
+    orig_xy = orig_df[['x','y']].values
+    df, quarantine = [], {}
+    for service in config['services']:
+        logger.info('Querying the nearest {}'.format(service))
+        dests = dest_df[dest_df['dest_type'] == service]
+        quarantine[service] = table_retry.Quarantine(orig_df.index.values, dests.index.values)
+        result = nearest_query.query_nearest(orig_xy, dests[['lon','lat']].values, options, quarantine=quarantine[service])
+        quarantine[service].log()
+        df_min = nearest_query.nearest_frame(result, orig_df.index.values, dests.index.values)
+        df_min['service'] = service
+        df.append(df_min)
+    return pd.concat(df, ignore_index=True), quarantine
+
+def estimate_nearest(db, config):
+    '''
+    nearest destination of each service as straight-line distance x a
+    circuity factor (see circuity), calibrated on OSRM.circuity_sample origins
+    and destinations; written to 'nearest_dist' like query_nearest, the
+    calibration error to 'circuity_calibration'
+    '''
+    orig_df, dest_df = prepare_points(db, config)
+    orig_xy = orig_df[['x','y']].values
+    by_density = config['OSRM'].get('circuity_by_density', False)
+    model, report = circuity.calibrate(orig_xy, dest_df[['lon','lat']].values, table_query.options_from_config(config),
+                                       config['OSRM'].get('circuity_sample', 200), by_density)
+    density = circuity.local_density(orig_xy)
+    df = []
+    for service in config['services']:
+        dests = dest_df[dest_df['dest_type'] == service]
+        result = circuity.nearest(model, orig_xy, dests[['lon','lat']].values, density)
+        df_min = nearest_query.nearest_frame(result, orig_df.index.values, dests.index.values)
+        df_min['service'] = service
+        df.append(df_min)
+    write_nearest_dist(pd.concat(df, ignore_index=True), db)
+    pd.DataFrame([report]).to_sql('circuity_calibration', con=db['engine'], if_exists='replace', index=False)
+
+def graph_tiles(orig_df, dest_df, config, manifest=None, mode=None):
+    '''
+    query_tiles on the OSM graph (see road_graph): every origin against a
+    few destinations per tile, computed across the cores
+    '''
+    graph = road_graph.load(config, config['transport_mode'])
+    orig_xy, dest_xy = orig_df[['x','y']].values, dest_df[['lon','lat']].values
+    orig_ids, dest_ids, dest_types = orig_df.index.values, dest_df.index.values, dest_df['dest_type'].values
+    tiles = road_graph.plan(len(orig_xy), len(dest_xy))
+    if manifest is not None:
+        tiles = manifest.resume(tiles, orig_xy, dest_xy, orig_ids, dest_ids, table_query.options_from_config(config), mode)
+    tiles = road_graph.iter_tiles(graph, orig_xy, dest_xy, config['metric'], tiles, n_jobs=max(1, int(mp.cpu_count() * config['par_frac'])))
+    return tiles, orig_ids, dest_ids, dest_types
+
+def graph_nearest(orig_df, dest_df, config):
+    '''
+    nearest destination of each service on the OSM graph (see road_graph)
+    '''
+    graph = road_graph.load(config, config['transport_mode'])
+    by = 'distance' if 'distance' in config['metric'] else config['metric'][0]
+    orig_xy = orig_df[['x','y']].values
+    df = []
+    for service in config['services']:
+        logger.info('Finding the nearest {} on the graph'.format(service))
+        dests = dest_df[dest_df['dest_type'] == service]
+        result = graph.nearest(orig_xy, dests[['lon','lat']].values, by)
+        df_min = nearest_query.nearest_frame(result, orig_df.index.values, dests.index.values)
+        df_min['service'] = service
+        df.append(df_min)
+    return pd.concat(df, ignore_index=True)
 
 
 ############## Create Destination Table in SQL ##############
@@ -240,32 +504,91 @@ def create_dest_table(db, config):
 
 
 ############## Save to SQL ##############
-def write_to_postgres(df, db, indices=True):
-    ''' quickly write to a postgres database
-        from https://stackoverflow.com/a/47984180/5890574'''
+def write_to_postgres(frames, db, indices=True, manifest=None):
+    ''' stream frames to a postgres database, writing while the next
+        frames are still being queried; with a manifest each table request
+        is committed as it is written so the run can be resumed '''
 
     logger.info('Writing data to SQL')
-    df.head(0).to_sql(db['table_name'], db['engine'], if_exists='replace',index=False) #truncates the table
-
-    conn = db['engine'].raw_connection()
-    cur = conn.cursor()
-    output = io.StringIO()
-    df.to_csv(output, sep='\t', header=False, index=False)
-    output.seek(0)
-    cur.copy_from(output, db['table_name'], null="") # null values become ''
-    logger.info('Distances written successfully to SQL as "{}"'.format(db['table_name']))
+    if manifest is None:
+        rows = table_stream.copy_frames(frames, db, db['table_name'], if_exists='replace') #truncates the table
+    else:
+        # the manifest has already cleared the table unless this run is resuming
+        rows = table_stream.copy_frames(frames, db, db['table_name'], if_exists='append', manifest=manifest)
+        manifest.close()
+    logger.info('{} distances written successfully to SQL as "{}"'.format(rows, db['table_name']))
 
     # update indices
     logger.info('Updating indices on SQL')
-    if indices == True:
+    if indices == True and table_stream.table_exists(db, db['table_name']):
+        cur = db['con'].cursor()
         queries = [
-                    'CREATE INDEX "{0}_dest_id" ON {0} ("id_dest");'.format(db['table_name']),
-                    'CREATE INDEX "{0}_orig_id" ON {0} ("id_orig");'.format(db['table_name'])
+                    'CREATE INDEX IF NOT EXISTS "{0}_dest_id" ON {0} ("id_dest");'.format(db['table_name']),
+                    'CREATE INDEX IF NOT EXISTS "{0}_orig_id" ON {0} ("id_orig");'.format(db['table_name'])
                     ]
         for q in queries:
             cur.execute(q)
+        db['con'].commit()
+
 
-    conn.commit()
+def write_requeried(requeries, db, config):
+    ''' replace the rows of origins that were re-queried from a better point
+        (see unreachable), in the table and the saved matrix, and save the
+        report of the origins checked as {table_name}_resnapped '''
+    reports = []
+    for mode, requery in requeries.items():
+        frame, report = requery.run()
+        if report is None:
+            continue
+        reports.append(report.assign(mode=mode) if len(requeries) > 1 else report)
+        if frame is None:
+            continue
+        ids = pd.unique(frame['id_orig']).tolist()
+        if config['SQL'].get('matrix', False):
+            # checked before the table is touched, so the two never disagree
+            table_name = db['table_name'] if len(requeries) == 1 else '{}_{}'.format(db['table_name'], mode)
+            matrix = access_matrix.AccessMatrix.open(access_matrix.path(config['location']['state'], table_name), mode='r+')
+            rows, cols = matrix.orig_index(ids), matrix.dest_index(requery.dest_ids)
+            if (rows < 0).any() or len(cols) != len(requery.dest_ids):
+                raise ValueError('Re-queried rows do not match the saved matrix "{}": {} of {} origins and {} of {} destinations found'.format(
+                    table_name, int((rows >= 0).sum()), len(ids), len(cols), len(requery.dest_ids)))
+        output = io.StringIO()
+        frame.to_csv(output, sep='\t', header=False, index=False)
+        output.seek(0)
+        # the old rows and their replacements in one transaction
+        cur = db['con'].cursor()
+        try:
+            if len(requeries) > 1:
+                cur.execute('DELETE FROM {} WHERE id_orig = ANY(%s) AND mode = %s;'.format(db['table_name']), (ids, mode))
+            else:
+                cur.execute('DELETE FROM {} WHERE id_orig = ANY(%s);'.format(db['table_name']), (ids,))
+            cur.copy_from(output, db['table_name'], null="")
+            db['con'].commit()
+        except Exception:
+            db['con'].rollback()
+            raise
+        if config['SQL'].get('matrix', False):
+            for metric in config['metric']:
+                matrix.values[metric][np.ix_(rows, cols)] = frame[metric].values.reshape(len(ids), len(requery.dest_ids))
+            matrix.flush()
+    if reports:
+        report = pd.concat(reports, ignore_index=True)
+        report.to_sql('{}_resnapped'.format(db['table_name']), db['engine'], if_exists='replace', index=False)
+        logger.info('{} unreachable origins written to "{}_resnapped"'.format(len(report), db['table_name']))
+
+def write_quarantine(quarantine, db, key='mode'):
+    ''' save the report of quarantined points as {table_name}_quarantine
+        quarantine: a table_retry.Quarantine, or a dict of mode (or the
+        column named by key): Quarantine '''
+    if isinstance(quarantine, dict):
+        reports = [q.frame().assign(**{key: name}) for name, q in quarantine.items() if len(q)]
+    else:
+        reports = [quarantine.frame()] if len(quarantine) else []
+    if not reports:
+        return
+    report = pd.concat(reports, ignore_index=True)
+    report.to_sql('{}_quarantine'.format(db['table_name']), db['engine'], if_exists='replace', index=False)
+    logger.warning('{} quarantined points written to "{}_quarantine"'.format(len(report), db['table_name']))
 
 
 if __name__ == '__main__':
@@ -5,7 +5,14 @@ Query origins to dests in OSRM
 # user defined variables
 par = True
 par_frac = 0.9
+max_in_flight = None # requests kept in flight to OSRM (None: one per core)
+batch_limit = 50000 # O-D pairs per table request
 transport_mode = 'walking'#'driving'
+coord_encoding = 'polyline6' # url coordinate encoding ['text', 'polyline', 'polyline6']
+resume = True # skip table requests an interrupted run already wrote
+engine = 'osrm' # routing engine ['osrm', 'graph'] (graph: in process on the OSM extract, see road_graph)
+curve_order = None # order origins and destinations along a space-filling curve ['hilbert', 'zorder', None]
+save_matrix = True # also save the matrix for access_matrix (memory-mapped reading)
 
 import utils
 from config import *
@@ -18,11 +25,13 @@ import shapely
 from geoalchemy2 import Geometry, WKTElement
 import requests
 from sqlalchemy.types import Float, Integer
-if par == True:
-    import multiprocessing as mp
-    from joblib import Parallel, delayed
-    from requests.adapters import HTTPAdapter
-    from requests.packages.urllib3.util.retry import Retry
+import table_query
+import road_graph
+import spatial_order
+import table_stream
+import run_manifest
+import query_metrics
+import access_matrix
 
 def main(state):
     '''
@@ -68,25 +77,30 @@ def query_points(db, context):
     dest_df['lon'] = dest_df.geom.centroid.x
     dest_df['lat'] = dest_df.geom.centroid.y
 
-    # list of origxdest pairs
-    origxdest = pd.DataFrame(list(itertools.product(orig_df.index, dest_df.index)), columns = ['id_orig','id_dest'])
-    origxdest['distance'] = None
-    origxdest['duration'] = None
-
-    logger.info('about to query {} O-D pairs'.format(len(origxdest)))
-    # df of durations, distances, ids, and co-ordinates
-    origxdest = execute_table_query(origxdest, orig_df, dest_df, context)
-
-    # add df to sql
+    logger.info('about to query {} O-D pairs'.format(len(orig_df)*len(dest_df)))
+    # tiles already written by an interrupted run are skipped
+    manifest = run_manifest.RunManifest(db, 'block2blockgroup') if resume else None
+    # df of durations, distances and ids, one table request at a time
+    context['run_metrics'] = query_metrics.RunMetrics('{}_block2blockgroup'.format(context['state']))
+    if not save_matrix:
+        # a matrix saved from an earlier run would no longer match the table
+        access_matrix.discard(context['state'], 'block2blockgroup')
+    origxdest = execute_table_query(orig_df, dest_df, context, manifest)
+
+    # add to sql, each batch is written as it arrives
     logger.info('Writing data to SQL')
-    write_to_postgres(origxdest, db, 'block2blockgroup')
+    write_to_postgres(origxdest, db, 'block2blockgroup', manifest)
+    query_metrics.write(context['run_metrics'])
+    if not table_stream.table_exists(db, 'block2blockgroup'):
+        # nothing was queried
+        return
     # origxdest.to_sql('block2blockgroup', con=db['engine'], if_exists='replace', index=False, dtype={"distance":Float(), "duration":Float(), 'id_dest':Integer()}, method='multi')
     logger.info('Distances written successfully to SQL')
     logger.info('Updating indices on SQL')
     # update indices
     queries = [
-                'CREATE INDEX "dest_idx" ON block2blockgroup ("id_dest");',
-                'CREATE INDEX "orig_idx" ON block2blockgroup ("id_orig");'
+                'CREATE INDEX IF NOT EXISTS "dest_idx" ON block2blockgroup ("id_dest");',
+                'CREATE INDEX IF NOT EXISTS "orig_idx" ON block2blockgroup ("id_orig");'
                 ]
     for q in queries:
         cursor.execute(q)
@@ -95,88 +109,53 @@ def query_points(db, context):
     db['con'].commit()
     logger.info('Query Complete')
 
-def write_to_postgres(df, db, table_name):
-    ''' quickly write to a postgres database
-        from https://stackoverflow.com/a/47984180/5890574'''
+def write_to_postgres(frames, db, table_name, manifest=None):
+    ''' stream frames to a postgres database, writing while the next
+        frames are still being queried; with a manifest each table request
+        is committed as it is written so the run can be resumed '''
 
-    df.head(0).to_sql(table_name, db['engine'], if_exists='replace',index=False) #truncates the table
+    if manifest is None:
+        table_stream.copy_frames(frames, db, table_name, if_exists='replace')
+    else:
+        # the manifest has already cleared the table unless this run is resuming
+        table_stream.copy_frames(frames, db, table_name, if_exists='append', manifest=manifest)
+        manifest.close()
 
-    conn = db['engine'].raw_connection()
-    cur = conn.cursor()
-    output = io.StringIO()
-    df.to_csv(output, sep='\t', header=False, index=False)
-    output.seek(0)
-    cur.copy_from(output, table_name, null="") # null values become ''
-    conn.commit()
 
-
-def execute_table_query(origxdest, orig_df, dest_df, context):
+def execute_table_query(orig_df, dest_df, context, manifest=None):
     # Use the table service so as to reduce the amount of requests sent
     # https://github.com/Project-OSRM/osrm-backend/blob/master/docs/http.md#table-service
-
-    batch_limit = 50000
-
-    dest_n = len(dest_df)
-    orig_n = len(orig_df)
-    orig_per_batch = int(batch_limit/dest_n)
-    batch_n = math.ceil(orig_n/orig_per_batch)
-
-    #create query string
-    base_string = context['osrm_url'] + "/table/v1/{}/".format(transport_mode)
-
-    # make a string of all the destination coordinates
-    dest_string = ""
-    for j in range(dest_n):
-        #now add each dest in the string
-        dest_string += str(dest_df['lon'][j]) + "," + str(dest_df['lat'][j]) + ";"
-    #remove last semi colon
-    dest_string = dest_string[:-1]
-
-    # options string
-    options_string_base = '?annotations=duration,distance'
-
-    # loop through the sets of
-    orig_sets = [(i, min(i+orig_per_batch, orig_n)) for i in range(0,orig_n,orig_per_batch)]
-
-    # create a list of queries
-    query_list = []
-    for i in orig_sets:
-        # make a string of all the origin coordinates
-        orig_string = ""
-        orig_ids = range(i[0],i[1])
-        for j in orig_ids:
-            #now add each dest in the string
-            orig_string += str(orig_df.x[j]) + "," + str(orig_df.y[j]) + ";"
-        # make a string of the number of the sources
-        source_str = '&sources=' + str(list(range(len(orig_ids))))[1:-1].replace(' ','').replace(',',';')
-        # make the string for the destinations
-        dest_idx_str = '&destinations=' + str(list(range(len(orig_ids), len(orig_ids)+len(dest_df))))[1:-1].replace(' ','').replace(',',';')
-        # combine and create the query string
-        options_string = options_string_base + source_str + dest_idx_str
-        query_string = base_string + orig_string + dest_string + options_string
-        # append to list of queries
-        query_list.append(query_string)
-
-    # # Table Query OSRM in parallel
-    if par == True:
-        #define cpu usage
-        num_workers = np.int(mp.cpu_count() * par_frac)
-        #gets list of tuples which contain 1list of distances and 1list
-        results = Parallel(n_jobs=num_workers)(delayed(req)(query_string) for query_string in tqdm(query_list))
-
-    # get the results in the right format
-    dists = [l for orig in results for l in orig[0]]
-    durs = [l for orig in results for l in orig[1]]
-    origxdest['distance'] = dists
-    origxdest['duration'] = durs
-
-    return(origxdest)
-
-def req(query_string):
-    response = requests.get(query_string).json()
-    temp_dist = [item for sublist in response['distances'] for item in sublist]
-    temp_dur = [item for sublist in response['durations'] for item in sublist]
-    return temp_dist, temp_dur
+    options = table_query.table_options(context['osrm_url'], transport_mode, ['distance','duration'],
+                                        batch_limit=batch_limit, coordinates=coord_encoding,
+                                        max_in_flight=max_in_flight if par else 1,
+                                        endpoints=context.get('osrm_endpoints'),
+                                        run_metrics=context.get('run_metrics'))
+    if curve_order:
+        # neighbouring origins share a request, neighbouring destinations a tile
+        orig_df = orig_df.iloc[spatial_order.order(orig_df[['x','y']].values, curve_order)]
+        dest_df = dest_df.iloc[spatial_order.order(dest_df[['lon','lat']].values, curve_order)]
+    orig_xy, dest_xy = orig_df[['x','y']].values, dest_df[['lon','lat']].values
+    if engine == 'graph':
+        # every block against a few block groups per tile, across the cores
+        tiles = road_graph.plan(len(orig_xy), len(dest_xy))
+    else:
+        tiles = table_query.plan(len(orig_xy), len(dest_xy), options)
+    if manifest is not None:
+        tiles = manifest.resume(tiles, orig_xy, dest_xy, orig_df.index.values, dest_df.index.values, options)
+    if engine == 'graph':
+        graph = road_graph.load_state(context['state'], transport_mode)
+        tiles = road_graph.iter_tiles(graph, orig_xy, dest_xy, options['metrics'], tiles, n_jobs=-1 if par else 1)
+    else:
+        tiles = table_query.iter_tiles(orig_xy, dest_xy, options, tiles)
+    if save_matrix:
+        # also keep the dense matrix for memory-mapped reading
+        matrix = access_matrix.open_for_writing(access_matrix.path(context['state'], 'block2blockgroup'),
+                                                orig_df.index.values, dest_df.index.values, options['metrics'],
+                                                resume=manifest is not None and manifest.resumed)
+        tiles = access_matrix.record(tiles, matrix)
+
+    # origxdest rows for each tile, never the full product at once
+    return table_stream.tile_frames(tiles, orig_df.index.values, dest_df.index.values, options['metrics'])
 
 
 if __name__ == "__main__":
@@ -2,8 +2,8 @@ import nearest_dist
 import add_socioeco
 import init_osrm
 import query
+import osrm_servers
 import yaml
-import subprocess
 # functions - logging
 import logging
 logging.basicConfig(
@@ -27,13 +27,19 @@ def multi_regions():
     for state in states:
         config_filename = state
         # calculate the distances
-        query_osrm(config_filename)
-        # determine the nearest distance
-        logger.info('determine the nearest distance for {}'.format(state))
-        nearest_dist.determine_nearest(state)
+        config = query_osrm(config_filename)
+        # determine the nearest distance (the nearest and estimate modes write it directly, for the first mode)
+        modes = init_osrm.transport_modes(config)
+        mode = None
+        if config['script_mode'] not in ('nearest', 'estimate'):
+            logger.info('determine the nearest distance for {}'.format(state))
+            if len(modes) > 1:
+                # one set of rows per mode, the socioeconomic merge takes the first
+                mode = modes[0]
+            nearest_dist.determine_nearest(state, modes if len(modes) > 1 else None)
         # merge with socioeconomic data
         logger.info('merge with socioeconomic data')
-        add_socioeco.import_csv(state)
+        add_socioeco.import_csv(state, mode)
 
 
 
@@ -42,24 +48,28 @@ def query_osrm(config_filename):
     with open('./src/config/{}.yaml'.format(config_filename)) as file:
         config = yaml.load(file)
 
-    # initialize the OSRM server
-    logger.info('Initialize the OSRM server for {} to {} in {}'.format(config['transport_mode'], config['services'],config['location']['city']))
-    init_osrm.main(config, logger)
-    logger.info('OSRM server initialized')
+    graph = config['OSRM'].get('engine', 'osrm') == 'graph'
+    if graph:
+        # routed in process (see road_graph), only the extract is needed
+        init_osrm.download(config)
+    else:
+        # initialize the OSRM server
+        logger.info('Initialize the OSRM server for {} to {} in {}'.format(config['transport_mode'], config['services'],config['location']['city']))
+        init_osrm.main(config, logger)
+        logger.info('OSRM server initialized')
 
     # query the OSRM server
     query.main(config)
 
-    # shutdown the OSRM server
-    if config['OSRM']['shutdown']:
-        shell_commands = [
-                            'docker stop osrm-{}'.format(config['location']['state']),
-                            'docker rm osrm-{}'.format(config['location']['state']),
-                            ]
-        for com in shell_commands:
-            com = com.split()
-            subprocess.run(com)
-    logger.info('OSRM server shutdown and removed')
+    # shutdown the OSRM server, or keep it warm for the next run (see osrm_servers)
+    if not graph:
+        if config['OSRM']['shutdown']:
+            for mode in init_osrm.transport_modes(config):
+                osrm_servers.stop(init_osrm.container_name(config, mode))
+            logger.info('OSRM server shutdown and removed')
+        else:
+            osrm_servers.evict(config['OSRM'].get('warm_memory_gb', 32))
+    return config
 
 if __name__ == '__main__':
     multi_regions()
@@ -0,0 +1,157 @@
+'''
+Per-request instrumentation of OSRM query runs
+- latency histogram, response bytes, O-D pairs per second, retries and how
+  busy the in-flight window was kept
+- written as a JSON run summary and, optionally, a Prometheus textfile (for
+  node_exporter's textfile collector)
+'''
+import os
+import json
+import time
+import threading
+from datetime import datetime
+import numpy as np
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# where run summaries are written: {metrics_directory}/{name}_{timestamp}.json
+metrics_directory = '/homedirs/man112/access_inequality_index/data/run_metrics'
+
+# latency histogram bucket bounds (s)
+buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class RunMetrics:
+    '''
+    counters for one query run, safe to update from the client's threads
+    '''
+    def __init__(self, name='query'):
+        self.name = name
+        self.started = time.time()
+        self.latencies = []
+        self.bytes = 0
+        self.failures = 0
+        self.retries = 0
+        self.pairs = 0
+        self.tiles = 0
+        # size of the in-flight window, set by the client
+        self.workers = 1
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def request(self, seconds, nbytes, endpoint=None, failed=False):
+        '''
+        one HTTP request (osrm_client.TableClient.get)
+        '''
+        with self._lock:
+            self.latencies.append(seconds)
+            self.bytes += nbytes
+            self.failures += failed
+            if endpoint is not None:
+                self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def tile(self, pairs):
+        '''
+        one table request's O-D pairs delivered
+        '''
+        with self._lock:
+            self.tiles += 1
+            self.pairs += pairs
+
+    def pairs_per_s(self):
+        return self.pairs / max(time.time() - self.started, 1e-9)
+
+    def summary(self):
+        '''
+        the run summary as a dict
+        '''
+        with self._lock:
+            seconds = time.time() - self.started
+            latencies = np.array(self.latencies)
+            busy = latencies.sum()
+            counts = np.searchsorted(np.sort(latencies), buckets, side='right') if len(latencies) else np.zeros(len(buckets), int)
+            summary = {
+                'name': self.name,
+                'started': datetime.fromtimestamp(self.started).isoformat(),
+                'seconds': seconds,
+                'requests': len(latencies),
+                'failed_requests': self.failures,
+                'retries': self.retries,
+                'tiles': self.tiles,
+                'pairs': self.pairs,
+                'pairs_per_s': self.pairs / max(seconds, 1e-9),
+                'response_bytes': self.bytes,
+                'bytes_per_pair': self.bytes / max(self.pairs, 1),
+                # share of the in-flight window that had a request outstanding
+                'utilisation': busy / max(seconds * self.workers, 1e-9),
+                'workers': self.workers,
+                'latency_s': {},
+                # requests at or under each bound (cumulative, as Prometheus buckets are)
+                'latency_histogram': {str(le): int(n) for le, n in zip(buckets, counts)},
+                'endpoints': dict(self.endpoints),
+                }
+            if len(latencies):
+                summary['latency_s'] = {'mean': latencies.mean(), 'p50': np.percentile(latencies, 50),
+                                        'p90': np.percentile(latencies, 90), 'p99': np.percentile(latencies, 99),
+                                        'max': latencies.max()}
+        return summary
+
+    def log(self):
+        summary = self.summary()
+        logger.info('{} O-D pairs in {:.0f}s ({:.0f} pairs/s), {} requests, p50 {:.2f}s p99 {:.2f}s, {} retries, utilisation {:.0%}'.format(
+            summary['pairs'], summary['seconds'], summary['pairs_per_s'], summary['requests'],
+            summary['latency_s'].get('p50', 0), summary['latency_s'].get('p99', 0),
+            summary['retries'], summary['utilisation']))
+
+    ############## Output ##############
+    def write_json(self, filename=None):
+        '''
+        write the summary (by default to metrics_directory); returns the filename
+        '''
+        if filename is None:
+            stamp = datetime.fromtimestamp(self.started).strftime('%Y%m%d_%H%M%S')
+            filename = os.path.join(metrics_directory, '{}_{}.json'.format(self.name, stamp))
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+        return filename
+
+    def write_prometheus(self, filename):
+        '''
+        write the summary in the Prometheus text format; written to a
+        temporary file and renamed, as the textfile collector requires
+        '''
+        summary = self.summary()
+        label = 'run="{}"'.format(self.name)
+        lines = ['# TYPE osrm_query_latency_seconds histogram']
+        for le, n in summary['latency_histogram'].items():
+            lines.append('osrm_query_latency_seconds_bucket{{{},le="{}"}} {}'.format(label, le, n))
+        lines.append('osrm_query_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(label, summary['requests']))
+        lines.append('osrm_query_latency_seconds_sum{{{}}} {}'.format(label, sum(self.latencies)))
+        lines.append('osrm_query_latency_seconds_count{{{}}} {}'.format(label, summary['requests']))
+        for key, kind in (('pairs', 'counter'), ('tiles', 'counter'), ('retries', 'counter'),
+                          ('failed_requests', 'counter'), ('response_bytes', 'counter'),
+                          ('pairs_per_s', 'gauge'), ('utilisation', 'gauge'), ('seconds', 'gauge')):
+            lines.append('# TYPE osrm_query_{} {}'.format(key, kind))
+            lines.append('osrm_query_{}{{{}}} {}'.format(key, label, summary[key]))
+        partial = filename + '.tmp'
+        with open(partial, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(partial, filename)
+
+
+def write(run_metrics, prometheus=None):
+    '''
+    log the run summary and write it out
+    prometheus: path of a textfile to also write, if any
+    '''
+    run_metrics.log()
+    filename = run_metrics.write_json()
+    logger.info('Run metrics written to {}'.format(filename))
+    if prometheus:
+        run_metrics.write_prometheus(prometheus)
@@ -0,0 +1,282 @@
+'''
+In-process routing on the OSM network
+The extract init_osrm downloads is read (with pyosmium) into a compressed
+sparse row graph of the ways a transport mode can use, saved as .npz.
+Points are snapped to their nearest graph node, and a nearest-destination
+question is one multi-source Dijkstra (scipy.sparse.csgraph) seeded at every
+destination, rather than an origin x destination table from OSRM. Full
+matrices are filled a few destinations at a time, one one-to-all search per
+destination on the reversed graph, across all cores (iter_tiles).
+The way filters and speeds are a rough stand-in for the OSRM lua profiles.
+'''
+import os
+import yaml
+import numpy as np
+from joblib import Parallel, delayed
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+from table_tiles import Tile
+import nearest_query
+import init_osrm
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# where the graphs are kept: {graph_directory}/{state}/{transport_mode}_{fingerprint}.npz
+graph_directory = '/homedirs/man112/access_inequality_index/data/graph'
+
+# the highway types each mode may use, with their speed (km/h)
+speeds = {
+    'driving': {'motorway': 90, 'motorway_link': 45, 'trunk': 85, 'trunk_link': 40,
+                'primary': 65, 'primary_link': 30, 'secondary': 55, 'secondary_link': 25,
+                'tertiary': 40, 'tertiary_link': 20, 'unclassified': 25, 'residential': 25,
+                'living_street': 10, 'service': 15},
+    'walking': {highway: 5 for highway in ('trunk', 'trunk_link', 'primary', 'primary_link',
+                'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified',
+                'residential', 'living_street', 'service', 'road', 'track', 'path', 'footway',
+                'pedestrian', 'steps', 'cycleway', 'bridleway')},
+    'cycling': {highway: 15 for highway in ('trunk', 'trunk_link', 'primary', 'primary_link',
+                'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified',
+                'residential', 'living_street', 'service', 'road', 'track', 'path', 'cycleway')},
+}
+# the tag that can close a way to each mode
+mode_access = {'driving': 'motor_vehicle', 'walking': 'foot', 'cycling': 'bicycle'}
+
+
+def path(state, transport_mode, fingerprint):
+    return os.path.join(graph_directory, state, '{}_{}.npz'.format(transport_mode, fingerprint))
+
+
+############## Graph ##############
+class RoadGraph:
+    '''
+    nodes (lon, lat) and directed edges in CSR form, weighted by distance (m)
+    and duration (s)
+    '''
+    def __init__(self, xy, indptr, indices, distance, duration):
+        self.xy = xy
+        self.indptr, self.indices = indptr, indices
+        self.weights = {'distance': distance, 'duration': duration}
+        self._tree = None
+        self._matrices = {}
+
+    @classmethod
+    def from_edges(cls, xy, u, v, distance, duration):
+        '''
+        graph from edge arrays; of parallel edges the shortest is kept
+        '''
+        # csgraph drops zero weights, so coincident nodes get a token length
+        distance = np.maximum(distance, 0.01)
+        duration = np.maximum(duration, 0.001)
+        order = np.lexsort((distance, v, u))
+        keep = order[np.concatenate([[True], (np.diff(u[order]) != 0) | (np.diff(v[order]) != 0)])]
+        matrix = sparse.csr_matrix((np.arange(len(keep)) + 1, (u[keep], v[keep])), shape=(len(xy), len(xy)))
+        edge = matrix.data - 1
+        return cls(xy, matrix.indptr, matrix.indices, distance[keep][edge], duration[keep][edge])
+
+    @classmethod
+    def load(cls, filename):
+        saved = np.load(filename)
+        return cls(saved['xy'], saved['indptr'], saved['indices'], saved['distance'], saved['duration'])
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        np.savez(filename, xy=self.xy, indptr=self.indptr, indices=self.indices,
+                 distance=self.weights['distance'], duration=self.weights['duration'])
+
+    def matrix(self, metric='distance', reverse=False):
+        '''
+        the CSR adjacency weighted by metric; reverse: with every edge flipped
+        '''
+        if (metric, reverse) not in self._matrices:
+            n = len(self.xy)
+            matrix = sparse.csr_matrix((self.weights[metric], self.indices, self.indptr), shape=(n, n))
+            self._matrices[(metric, reverse)] = matrix.T.tocsr() if reverse else matrix
+        return self._matrices[(metric, reverse)]
+
+    def __getstate__(self):
+        # sent to worker processes without the derived structures
+        return dict(self.__dict__, _tree=None, _matrices={})
+
+    def snap(self, xy):
+        '''
+        nearest node of each point and the metres to it
+        '''
+        if self._tree is None:
+            self._tree = cKDTree(nearest_query.to_sphere(self.xy))
+        chord, node = self._tree.query(nearest_query.to_sphere(np.asarray(xy, dtype=float)))
+        return node, nearest_query.great_circle(chord)
+
+    def nearest(self, orig_xy, dest_xy, metric='distance'):
+        '''
+        nearest destination of every origin by metric, from one multi-source
+        Dijkstra over the reversed graph (origin -> destination routes)
+        returns a dict, as nearest_query.query_nearest: distance, duration,
+        index (-1 where no destination is reachable)
+        '''
+        orig_node = self.snap(orig_xy)[0]
+        dest_node = self.snap(dest_xy)[0]
+        seeds, first = np.unique(dest_node, return_index=True)
+        reverse = self.matrix(metric, reverse=True)
+        cost, predecessor, source = csgraph.dijkstra(reverse, indices=seeds, min_only=True, return_predecessors=True)
+        # the destination sitting at each seed node
+        dest_at = np.full(len(self.xy), -1)
+        dest_at[seeds] = first
+        result = {'index': np.where(source[orig_node] >= 0, dest_at[np.maximum(source[orig_node], 0)], -1)}
+        reached = np.isfinite(cost[orig_node])
+        result[metric] = np.where(reached, cost[orig_node], np.nan)
+        for other in self.weights:
+            if other != metric:
+                result[other] = np.where(reached, self.path_sums(other, predecessor)[orig_node], np.nan)
+        return result
+
+    def path_sums(self, metric, predecessor):
+        '''
+        metric summed along the shortest path tree (predecessors of the
+        reversed graph) from every node to its root, by pointer doubling
+        '''
+        reverse = self.matrix(metric, reverse=True)
+        if (metric, 'keys') not in self._matrices:
+            # row * n + column of every entry, sorted, to look edges up by
+            reverse.sort_indices()
+            rows = np.repeat(np.arange(len(self.xy), dtype=np.int64), np.diff(reverse.indptr))
+            self._matrices[(metric, 'keys')] = rows * len(self.xy) + reverse.indices
+        keys = self._matrices[(metric, 'keys')]
+        tree = np.flatnonzero(predecessor >= 0)
+        total = np.zeros(len(predecessor))
+        wanted = predecessor[tree].astype(np.int64) * len(self.xy) + tree
+        # searched in order, which is several times faster on large graphs
+        order = np.argsort(wanted)
+        total[tree[order]] = reverse.data[np.searchsorted(keys, wanted[order])]
+        # roots (the seeds, and nodes not reached) are their own parent
+        parent = np.arange(len(predecessor))
+        parent[tree] = predecessor[tree]
+        while not np.array_equal(parent[parent], parent):
+            total = total + total[parent]
+            parent = parent[parent]
+        return total
+
+    def to_sources(self, sources, targets, by='duration', metrics=('distance', 'duration')):
+        '''
+        (targets x sources) values of each metric for the routes from every
+        target node to each source node, the routes being shortest by `by`
+        (as OSRM, whose weight is the duration); nan where there is none
+        '''
+        reverse = self.matrix(by, reverse=True)
+        values = {metric: np.full((len(targets), len(sources)), np.nan, dtype=np.float32) for metric in metrics}
+        for j, source in enumerate(sources):
+            cost, predecessor = csgraph.dijkstra(reverse, indices=source, return_predecessors=True)
+            reached = np.isfinite(cost[targets])
+            for metric in metrics:
+                along = cost if metric == by else self.path_sums(metric, predecessor)
+                values[metric][reached, j] = along[targets][reached]
+        return values
+
+
+############## Many to Many ##############
+def plan(orig_n, dest_n, width=32):
+    '''
+    Tiles of every origin by `width` destinations
+    '''
+    return [Tile(0, orig_n, start, min(start + width, dest_n), False) for start in range(0, dest_n, width)]
+
+
+def iter_tiles(graph, orig_xy, dest_xy, metrics, tiles=None, by='duration', n_jobs=-1):
+    '''
+    (tile, values) pairs covering orig x dest, as table_query.iter_tiles
+    yields them, computed on the graph across n_jobs processes
+    '''
+    orig_node = graph.snap(orig_xy)[0]
+    dest_node = graph.snap(dest_xy)[0]
+    tiles = plan(len(orig_node), len(dest_node)) if tiles is None else tiles
+    logger.info('{} O-D pairs in {} graph searches'.format(len(orig_node) * len(dest_node), sum(t.dest_stop - t.dest_start for t in tiles)))
+    results = Parallel(n_jobs=n_jobs, return_as='generator')(
+        delayed(graph.to_sources)(dest_node[tile.dest_start:tile.dest_stop], orig_node, by, metrics) for tile in tiles)
+    for tile, values in zip(tiles, results):
+        yield tile, values
+
+
+############## OSM ##############
+def read_osm(pbf, transport_mode):
+    '''
+    RoadGraph of the ways transport_mode can use in an .osm.pbf extract
+    '''
+    # only needed to build a graph; saved graphs load without it
+    import osmium
+    mode_speeds, access_tag = speeds[transport_mode], mode_access[transport_mode]
+
+    class Ways(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.refs, self.lon, self.lat, self.speed, self.oneway, self.way = [], [], [], [], [], []
+
+        def way(self, w):
+            tags = w.tags
+            speed = mode_speeds.get(tags.get('highway'))
+            if speed is None or tags.get('area') == 'yes' or len(w.nodes) < 2:
+                return
+            if tags.get('access') in ('no', 'private') and tags.get(access_tag) not in ('yes', 'designated', 'permissive'):
+                return
+            if tags.get(access_tag) in ('no', 'private'):
+                return
+            oneway = 0
+            if transport_mode != 'walking' and tags.get('oneway:bicycle' if transport_mode == 'cycling' else 'oneway') != 'no':
+                oneway = {'yes': 1, '1': 1, 'true': 1, '-1': -1}.get(tags.get('oneway'), 0)
+                if tags.get('junction') == 'roundabout' or tags.get('highway') in ('motorway', 'motorway_link'):
+                    oneway = oneway or 1
+            self.refs.append(np.array([n.ref for n in w.nodes], dtype=np.int64))
+            self.lon.append(np.array([n.lon for n in w.nodes]))
+            self.lat.append(np.array([n.lat for n in w.nodes]))
+            self.speed.append(speed)
+            self.oneway.append(oneway)
+
+    handler = Ways()
+    handler.apply_file(pbf, locations=True)
+    logger.info('{} ways usable for {}'.format(len(handler.refs), transport_mode))
+    counts = np.array([len(refs) for refs in handler.refs])
+    refs, lon, lat = np.concatenate(handler.refs), np.concatenate(handler.lon), np.concatenate(handler.lat)
+    ids, first, node = np.unique(refs, return_index=True, return_inverse=True)
+    node = node.ravel()
+    xy = np.column_stack([lon[first], lat[first]])
+    # consecutive nodes of the same way
+    starts = np.cumsum(counts) - counts
+    within = np.ones(len(refs), dtype=bool)
+    within[starts] = False
+    head = np.flatnonzero(within)
+    u, v = node[head - 1], node[head]
+    distance = nearest_query.great_circle(np.linalg.norm(nearest_query.to_sphere(xy[u]) - nearest_query.to_sphere(xy[v]), axis=1))
+    way = np.repeat(np.arange(len(counts)), counts)[head]
+    duration = distance / (np.array(handler.speed)[way] / 3.6)
+    oneway = np.array(handler.oneway)[way]
+    forward, backward = oneway >= 0, oneway <= 0
+    return RoadGraph.from_edges(xy, np.concatenate([u[forward], v[backward]]), np.concatenate([v[forward], u[backward]]),
+                                np.concatenate([distance[forward], distance[backward]]),
+                                np.concatenate([duration[forward], duration[backward]]))
+
+
+def load_state(state, transport_mode):
+    '''
+    the graph for a state, from the OSM settings of its config/{state}.yaml
+    '''
+    with open('./src/config/{}.yaml'.format(state)) as file:
+        config = yaml.safe_load(file)
+    return load(config, transport_mode)
+
+
+def load(config, transport_mode=None):
+    '''
+    the graph for a config's state and transport mode, built from the
+    downloaded extract the first time
+    '''
+    transport_mode = transport_mode or init_osrm.transport_modes(config)[0]
+    directory, state_name = config['OSM']['data_directory'], config['OSM']['state']
+    fingerprint = init_osrm.dataset_fingerprint(directory, state_name, init_osrm.mode_dict[transport_mode])
+    filename = path(config['location']['state'], transport_mode, fingerprint)
+    if os.path.exists(filename):
+        return RoadGraph.load(filename)
+    logger.info('Building the {} graph from the OSM extract'.format(transport_mode))
+    graph = read_osm(os.path.join(directory, '{}-latest.osm.pbf'.format(state_name)), transport_mode)
+    logger.info('{} nodes, {} edges'.format(len(graph.xy), len(graph.indices)))
+    graph.save(filename)
+    return graph
@@ -0,0 +1,131 @@
+'''
+Checkpoint and resume long OSRM query runs
+- every table request (tile) gets a key and a content hash of its inputs
+- a tile's manifest row is committed in the same transaction as its
+  results, so a restarted run skips finished tiles and never writes one twice
+- runs over several transport modes key each tile by its mode as well, and
+  each mode is resumed (or started over) on its own
+- the manifest is dropped once every planned tile is written, so only an
+  interrupted run resumes
+'''
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def tile_key(tile, mode=None):
+    key = 'o{}-{}_d{}-{}'.format(tile.orig_start, tile.orig_stop, tile.dest_start, tile.dest_stop)
+    return key if mode is None else '{}:{}'.format(mode, key)
+
+
+def tile_digest(tile, orig_xy, dest_xy, orig_ids, dest_ids, options):
+    '''
+    hash of everything that determines a tile's results
+    '''
+    digest = hashlib.sha1()
+    orig = slice(tile.orig_start, tile.orig_stop)
+    dest = slice(tile.dest_start, tile.dest_stop)
+    for ids in (orig_ids[orig], dest_ids[dest]):
+        digest.update('\n'.join(map(str, ids)).encode())
+    for xy in (orig_xy[orig], dest_xy[dest]):
+        digest.update(np.ascontiguousarray(xy, dtype=np.float64).tobytes())
+    settings = {key: options.get(key) for key in ('transport_mode', 'metrics', 'fingerprint', 'algorithm', 'snapping', 'symmetric')}
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class RunManifest:
+    '''
+    completed tiles of a query run, kept in postgres as {table_name}_manifest
+    '''
+    def __init__(self, db, table_name):
+        self.db = db
+        self.table_name = table_name
+        self.name = '{}_manifest'.format(table_name)
+        # tile (or (mode, tile)): (key, digest) of the planned run
+        self.batches = {}
+        # whether the last resume() found earlier work to continue from
+        self.resumed = False
+
+    def completed(self):
+        '''
+        dict of key: digest for the tiles already written
+        '''
+        cursor = self.db['con'].cursor()
+        cursor.execute('SELECT to_regclass(%s);', (self.name,))
+        if cursor.fetchone()[0] is None:
+            return {}
+        done = pd.read_sql('SELECT batch, hash FROM {};'.format(self.name), self.db['con'])
+        return dict(zip(done.batch, done.hash))
+
+    def resume(self, tiles, orig_xy, dest_xy, orig_ids, dest_ids, options, mode=None):
+        '''
+        the tiles that still need querying
+        If the recorded tiles do not match this run's inputs, the results and
+        manifest are dropped and the run starts over.
+        mode: the transport mode of a multi-mode run; its tiles are then
+        recorded as (mode, tile) and only its own results are dropped
+        '''
+        batches = {(tile if mode is None else (mode, tile)): (tile_key(tile, mode), tile_digest(tile, orig_xy, dest_xy, orig_ids, dest_ids, options))
+                   for tile in tiles}
+        self.batches.update(batches)
+        done = self.completed()
+        if mode is not None:
+            done = {key: digest for key, digest in done.items() if key.startswith(mode + ':')}
+        planned = dict(batches.values())
+        if done and all(planned.get(key) == digest for key, digest in done.items()):
+            pending = [tile for tile, (key, digest) in zip(tiles, batches.values()) if key not in done]
+            self.resumed = True
+            logger.info('Resuming {}{}: {} of {} table requests already written'.format(
+                self.table_name, '' if mode is None else ' ({})'.format(mode), len(done), len(tiles)))
+        else:
+            if done:
+                logger.warning('Inputs changed since {} was last written, starting over'.format(self.table_name))
+            self.reset(mode)
+            pending = list(tiles)
+            self.resumed = False
+        return pending
+
+    def close(self):
+        '''
+        drop the manifest if every planned tile has been written
+        '''
+        done = self.completed()
+        if all(key in done for key, digest in self.batches.values()):
+            cursor = self.db['con'].cursor()
+            cursor.execute('DROP TABLE IF EXISTS {};'.format(self.name))
+            self.db['con'].commit()
+        else:
+            logger.info('{} of {} table requests written, {} kept for resuming'.format(
+                sum(key in done for key, digest in self.batches.values()), len(self.batches), self.name))
+
+    def reset(self, mode=None):
+        cursor = self.db['con'].cursor()
+        if mode is not None:
+            cursor.execute('SELECT to_regclass(%s);', (self.name,))
+            single = cursor.fetchone()[0] is None or any(':' not in key for key in self.completed())
+            if not single:
+                # keep the other modes' results
+                cursor.execute('DELETE FROM {} WHERE batch LIKE %s;'.format(self.name), (mode + ':%',))
+                cursor.execute('SELECT to_regclass(%s);', (self.table_name,))
+                if cursor.fetchone()[0] is not None:
+                    cursor.execute('DELETE FROM {} WHERE mode = %s;'.format(self.table_name), (mode,))
+                self.db['con'].commit()
+                return
+        # no manifest, or one from a single mode run: start the table over
+        cursor.execute('DROP TABLE IF EXISTS {};'.format(self.table_name))
+        cursor.execute('DROP TABLE IF EXISTS {};'.format(self.name))
+        cursor.execute('CREATE TABLE {} (batch text PRIMARY KEY, hash text, rows bigint, completed timestamp DEFAULT now());'.format(self.name))
+        self.db['con'].commit()
+
+    def record(self, cursor, tile, rows):
+        '''
+        mark a tile (or (mode, tile)) written; run on the cursor holding its
+        results, before commit
+        '''
+        key, digest = self.batches[tile]
+        cursor.execute('INSERT INTO {} (batch, hash, rows) VALUES (%s, %s, %s);'.format(self.name), (key, digest, rows))
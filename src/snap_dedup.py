@@ -0,0 +1,173 @@
+'''
+Query each network point once
+Many block centroids (and some destinations) snap to the same point on the
+OSRM network, and the table service returns identical rows for them. Every
+point is snapped through the nearest service (cached on disk), only the
+unique snapped points go into the table requests, and the rows are then
+fanned back out to every original point.
+https://github.com/Project-OSRM/osrm-backend/blob/master/docs/http.md#nearest-service
+'''
+import os
+import numpy as np
+try:
+    import orjson as json
+except ImportError:
+    import json
+from table_tiles import Tile
+import nearest_query
+import osrm_client
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+# where the snapped points are kept: {snap_directory}/{state}/{transport_mode}/{fingerprint}.npz
+# (per OSRM dataset fingerprint, see init_osrm.dataset_fingerprint, so a
+# rebuilt network starts a new file)
+snap_directory = '/homedirs/man112/access_inequality_index/data/snap'
+
+
+def path(state, transport_mode, fingerprint):
+    '''
+    the snap cache file of a network, None (not kept) without a fingerprint
+    '''
+    if fingerprint is None:
+        logger.warning('No dataset fingerprint (set by init_osrm), snapped points are not kept')
+        return None
+    return os.path.join(snap_directory, state, transport_mode, '{}.npz'.format(fingerprint))
+
+
+############## Snapping ##############
+class SnapCache:
+    '''
+    snapped location and snap distance of coordinates, kept in a .npz file
+    coordinates are matched at 6 decimals (about 0.1 m)
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.snaps = {}
+        self.changed = False
+        if filename is not None and os.path.exists(filename):
+            saved = np.load(filename)
+            self.snaps = dict(zip(map(tuple, saved['keys']), map(tuple, saved['snaps'])))
+
+    @staticmethod
+    def keys(xy):
+        return [tuple(key) for key in np.round(np.asarray(xy) * 1e6).astype(np.int64)]
+
+    def save(self):
+        if self.filename is None or not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        np.savez(self.filename, keys=np.array(list(self.snaps.keys()), dtype=np.int64).reshape(-1, 2),
+                 snaps=np.array(list(self.snaps.values()), dtype=np.float64).reshape(-1, 3))
+        self.changed = False
+
+
+def nearest_url(osrm_url, transport_mode, x, y, number=1):
+    return '{}/nearest/v1/{}/{:.6f},{:.6f}?number={}'.format(osrm_url, transport_mode, x, y, number)
+
+
+def req_nearest(query_string, client):
+    '''
+    (x, y, distance) of the snapped point, or None if nothing is in range
+    '''
+    response = json.loads(client.get(query_string).content)
+    if response.get('code') != 'Ok' or not response.get('waypoints'):
+        return None
+    waypoint = response['waypoints'][0]
+    return (waypoint['location'][0], waypoint['location'][1], waypoint['distance'])
+
+
+def snap(xy, options, cache):
+    '''
+    snapped (x, y) of every point and the metres it moved
+    points the network is out of range of stay where they are
+    '''
+    xy = np.asarray(xy, dtype=float)
+    keys = cache.keys(xy)
+    missing = sorted(set(key for key in keys if key not in cache.snaps))
+    if missing:
+        logger.info('Snapping {} points to the network ({} cached)'.format(len(missing), len(set(keys)) - len(missing)))
+        with osrm_client.client(options) as client:
+            def fetch(key):
+                x, y = key[0] / 1e6, key[1] / 1e6
+                return req_nearest(nearest_url(options['url'], options['transport_mode'], x, y), client) or (x, y, 0.0)
+            for key, snapped in zip(missing, client.imap(fetch, missing)):
+                cache.snaps[key] = snapped
+        cache.changed = True
+    snaps = np.array([cache.snaps[key] for key in keys], dtype=float).reshape(-1, 3)
+    return snaps[:, :2], snaps[:, 2]
+
+
+class SnapGroups:
+    '''
+    points grouped by the network point they snap to
+    precision: decimals snapped locations are matched at; 6 only merges
+    points OSRM treats as the same, fewer also merges near neighbours
+    '''
+    def __init__(self, xy, snapped, precision=6):
+        keys = np.round(snapped * 10**precision).astype(np.int64)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        # original positions, ordered so each group is contiguous
+        self.order = np.argsort(inverse, kind='stable')
+        self.counts = np.bincount(inverse)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)])
+        # the point each group is queried at
+        self.xy = snapped[first]
+        # metres from each (ordered) original point to its group's point
+        chord = np.linalg.norm(nearest_query.to_sphere(xy[self.order]) - nearest_query.to_sphere(self.xy[inverse[self.order]]), axis=1)
+        self.offset = nearest_query.great_circle(chord)
+        logger.info('{} points snap to {} network points'.format(len(xy), len(self.xy)))
+
+    def grouped(self, values):
+        '''
+        values reordered to match the fanned out rows
+        '''
+        return np.asarray(values)[self.order]
+
+    def permute(self, group_order):
+        '''
+        put the groups in a new order (e.g. od_cache.CachedRun.orig_order)
+        '''
+        counts = self.counts[group_order]
+        starts = np.concatenate([[0], np.cumsum(counts)])
+        within = np.arange(starts[-1]) - np.repeat(starts[:-1], counts)
+        moved = np.repeat(self.starts[group_order], counts) + within
+        self.order, self.offset = self.order[moved], self.offset[moved]
+        self.counts, self.starts = counts, starts
+        self.xy = self.xy[group_order]
+
+
+def snap_groups(xy, options, cache, precision=6):
+    return SnapGroups(np.asarray(xy, dtype=float), snap(xy, options, cache)[0], precision)
+
+
+############## Fan Out ##############
+def expand_tile(tile, orig, dest):
+    '''
+    the tile of original (grouped) points a tile of unique points covers
+    '''
+    return Tile(int(orig.starts[tile.orig_start]), int(orig.starts[tile.orig_stop]),
+                int(dest.starts[tile.dest_start]), int(dest.starts[tile.dest_stop]), tile.transpose)
+
+
+def fan_out(tiles, orig, dest, offsets=False):
+    '''
+    (tile, values) pairs of unique points to (tile, values) of the grouped
+    original points
+    offsets: add each origin's and destination's distance to its network
+    point to the distances (durations are left as they are)
+    '''
+    for tile, values in tiles:
+        orig_counts = orig.counts[tile.orig_start:tile.orig_stop]
+        dest_counts = dest.counts[tile.dest_start:tile.dest_stop]
+        full = expand_tile(tile, orig, dest)
+        rows, cols = (dest_counts, orig_counts) if tile.transpose else (orig_counts, dest_counts)
+        fanned = {}
+        for metric, tile_values in values.items():
+            fanned[metric] = np.repeat(np.repeat(tile_values, rows, axis=0), cols, axis=1)
+        if offsets and 'distance' in fanned:
+            offset = orig.offset[full.orig_start:full.orig_stop, None] + dest.offset[None, full.dest_start:full.dest_stop]
+            fanned['distance'] += (offset.T if tile.transpose else offset).astype(np.float32)
+        yield full, fanned
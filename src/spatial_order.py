@@ -0,0 +1,76 @@
+'''
+Order points along a space-filling curve
+Consecutive points on a Hilbert (or Z-order) curve are close together, so a
+table request over a run of origins and a tile of destinations covers a
+compact part of the network, which keeps OSRM's working set small.
+'''
+import numpy as np
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+curves = ('hilbert', 'zorder')
+
+
+def cells(xy, bits=16):
+    '''
+    (x, y) integer cells of a 2**bits grid over the points' bounding square
+    longitudes are scaled by cos(latitude) so cells are roughly square
+    '''
+    xy = np.asarray(xy, dtype=float)
+    scaled = xy * [np.cos(np.radians(np.nanmean(xy[:, 1]))), 1] if len(xy) else xy
+    low = np.nanmin(scaled, axis=0) if len(xy) else 0
+    extent = np.nanmax(np.ptp(scaled, axis=0)) if len(xy) else 0
+    side = 2**bits
+    grid = np.floor((scaled - low) / max(extent, 1e-12) * (side - 1))
+    return np.nan_to_num(grid).astype(np.int64)
+
+
+def hilbert_index(xy, bits=16):
+    '''
+    position of each point along a Hilbert curve
+    '''
+    return hilbert_cells(cells(xy, bits), bits)
+
+
+def hilbert_cells(grid, bits=16):
+    '''
+    Hilbert curve position of integer (x, y) cells of a 2**bits grid
+    '''
+    x, y = grid[:, 0].copy(), grid[:, 1].copy()
+    side = 2**bits
+    index = np.zeros(len(grid), dtype=np.int64)
+    s = side // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve continues into the next level
+        flip = ~ry & rx
+        x = np.where(flip, side - 1 - x, x)
+        y = np.where(flip, side - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return index
+
+
+def zorder_index(xy, bits=16):
+    '''
+    position of each point along a Z-order (Morton) curve
+    '''
+    grid = cells(xy, bits)
+    index = np.zeros(len(grid), dtype=np.int64)
+    for bit in range(bits):
+        index |= ((grid[:, 0] >> bit) & 1) << (2 * bit)
+        index |= ((grid[:, 1] >> bit) & 1) << (2 * bit + 1)
+    return index
+
+
+def order(xy, curve='hilbert'):
+    '''
+    permutation putting the points in curve order (ties keep their order)
+    '''
+    if curve not in curves:
+        raise ValueError('Unknown spatial order {} (expected one of {})'.format(curve, curves))
+    index = hilbert_index(xy) if curve == 'hilbert' else zorder_index(xy)
+    return np.argsort(index, kind='stable')
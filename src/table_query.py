@@ -0,0 +1,218 @@
+'''
+Query the OSRM table service for an origin x destination matrix
+Shared by query.py, query_every_block.py and query_block2blockgroup.py:
+- plan the matrix as 2D tiles
+- build the tile urls
+- fetch them over the pooled client and scatter them into the matrix
+https://github.com/Project-OSRM/osrm-backend/blob/master/docs/http.md#table-service
+'''
+import numpy as np
+from tqdm import tqdm
+# functions - decoding (orjson parses table responses several times faster)
+try:
+    import orjson as json
+except ImportError:
+    import json
+# functions - requests
+import requests
+import osrm_client
+import table_url
+import table_tiles
+import table_retry
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+############## Options ##############
+def table_options(osrm_url, transport_mode, metrics, batch_limit=10000, max_table_size=100000,
+                  coordinates='text', transpose=False, max_in_flight=None, retries=3, backoff=1.0,
+                  endpoints=None, run_metrics=None, fingerprint=None, algorithm=None, snapping=None,
+                  symmetric=False):
+    '''
+    settings for a table query run
+    batch_limit: most O-D pairs per request
+    max_table_size: the server's --max-table-size (see init_osrm)
+    transpose: allow origins to be sent as `destinations` (symmetric networks only)
+    retries, backoff: attempts after a failed request, and the first wait (s)
+    endpoints: other osrm-routed urls serving the same data, to spread the
+    requests over (see osrm_client.Endpoints)
+    run_metrics: a query_metrics.RunMetrics to record the run in
+    fingerprint, algorithm, snapping, symmetric: what else the results depend
+    on (the dataset, osrm-routed's algorithm, snapping settings and whether
+    only the upper triangle is stored), for run_manifest
+    '''
+    endpoints = [osrm_url] + [url for url in (endpoints or []) if url != osrm_url]
+    return {'url': osrm_url, 'transport_mode': transport_mode, 'metrics': list(metrics),
+            'batch_limit': batch_limit, 'max_table_size': max_table_size,
+            'coordinates': coordinates, 'transpose': transpose,
+            'max_in_flight': max_in_flight, 'retries': retries, 'backoff': backoff,
+            'endpoints': endpoints, 'run_metrics': run_metrics, 'fingerprint': fingerprint,
+            'algorithm': algorithm, 'snapping': snapping, 'symmetric': symmetric}
+
+
+def options_from_config(config):
+    '''
+    table query settings from a yaml config (see config/*.yaml)
+    config['run_metrics'], if set (see query.py), records the run
+    OSRM.routed_workers above 1: the workers on the ports after OSRM.port
+    (see init_osrm) are added to the endpoints
+    '''
+    osrm = config['OSRM']
+    workers = ['{}:{}'.format(osrm['host'], int(osrm['port']) + i) for i in range(1, osrm.get('routed_workers') or 1)]
+    return table_options(osrm['host'] + ':' + osrm['port'], config['transport_mode'], config['metric'],
+                         batch_limit=osrm.get('batch_limit', 10000),
+                         max_table_size=osrm.get('max_table_size', 100000),
+                         coordinates=osrm.get('coordinates', 'text'),
+                         transpose=osrm.get('transpose', False),
+                         max_in_flight=osrm_client.in_flight(config),
+                         retries=osrm.get('retries', 3),
+                         backoff=osrm.get('backoff', 1.0),
+                         endpoints=(osrm.get('endpoints') or []) + workers,
+                         run_metrics=config.get('run_metrics'),
+                         fingerprint=osrm.get('fingerprint'),
+                         algorithm=(osrm.get('algorithms') or {}).get(str(config['transport_mode']), osrm.get('algorithm')),
+                         snapping=[osrm.get(key) for key in ('snap_dedup', 'snap_precision', 'snap_offset')])
+
+
+############## Queries ##############
+def plan(orig_n, dest_n, options):
+    return table_tiles.plan_tiles(orig_n, dest_n, options['batch_limit'],
+                                  options['max_table_size'], options['transpose'])
+
+
+def iter_queries(orig_xy, dest_xy, options, tiles=None):
+    '''
+    yield (tile, url) for every table request covering orig x dest
+    orig_xy, dest_xy: arrays of (lon, lat)
+    '''
+    if tiles is None:
+        tiles = plan(len(orig_xy), len(dest_xy), options)
+    builders = {}
+    for tile in tiles:
+        orig = orig_xy[tile.orig_start:tile.orig_stop]
+        dest = dest_xy[tile.dest_start:tile.dest_stop]
+        # the `destinations` side of a tile is serialised once per range
+        if tile.transpose:
+            key, fixed, batch = ('orig', tile.orig_start, tile.orig_stop), orig, dest
+        else:
+            key, fixed, batch = ('dest', tile.dest_start, tile.dest_stop), dest, orig
+        if key not in builders:
+            if key[0] == 'dest':
+                # tiles are destination-major: earlier ranges are finished with
+                builders.clear()
+            builders[key] = table_url.TableUrlBuilder(options['url'], options['transport_mode'],
+                                                      fixed[:, 0], fixed[:, 1], options['metrics'],
+                                                      encoding=options['coordinates'])
+        yield tile, builders[key].build(batch[:, 0], batch[:, 1])
+
+
+def tile_url(orig_xy, dest_xy, tile, options):
+    '''
+    the url of a single tile (iter_queries reuses builders across tiles)
+    '''
+    return next(iter_queries(orig_xy, dest_xy, options, [tile]))[1]
+
+
+def iter_tiles(orig_xy, dest_xy, options, tiles=None, quarantine=None):
+    '''
+    yield (tile, dict of metric: (sources x destinations) array) as responses
+    arrive; at most max_in_flight responses are held at once
+    Failed requests are retried and split around the coordinates that fail
+    (see table_retry); those are left as nan and added to quarantine.
+    '''
+    if tiles is None:
+        tiles = plan(len(orig_xy), len(dest_xy), options)
+    if quarantine is None:
+        quarantine = table_retry.Quarantine()
+    pairs = sum((t.orig_stop - t.orig_start)*(t.dest_stop - t.dest_start) for t in tiles)
+    logger.info('{} O-D pairs in {} table requests'.format(pairs, len(tiles)))
+    metrics = options['metrics']
+    run_metrics = options.get('run_metrics')
+    probed = {}
+
+    def probe(side, position):
+        # the point as both source and destination of a 1x1 table
+        if (side, position) not in probed:
+            x, y = (orig_xy if side == 'orig' else dest_xy)[position]
+            builder = table_url.TableUrlBuilder(options['url'], options['transport_mode'], [x], [y], metrics[:1])
+            try:
+                table_retry.retry(lambda: req(builder.build([x], [y]), metrics[:1], client),
+                                  options['retries'], options['backoff'], run_metrics)
+                probed[(side, position)] = True
+            except ValueError:
+                probed[(side, position)] = False
+        return probed[(side, position)]
+
+    def fetch(query):
+        tile, query_string = query
+        get = lambda part: req(query_string if part == tile else tile_url(orig_xy, dest_xy, part, options),
+                               metrics, client, tile_shape(part))
+        return tile, table_retry.resolve(tile, get, probe, tile_shape, metrics, quarantine,
+                                         options['retries'], options['backoff'], run_metrics)
+
+    with osrm_client.client(options) as client:
+        responses = client.imap(fetch, iter_queries(orig_xy, dest_xy, options, tiles))
+        progress = tqdm(responses, total=len(tiles))
+        for tile, values in progress:
+            if run_metrics is not None:
+                run_metrics.tile((tile.orig_stop - tile.orig_start)*(tile.dest_stop - tile.dest_start))
+                progress.set_postfix(pairs_s='{:.0f}'.format(run_metrics.pairs_per_s()), refresh=False)
+            yield tile, values
+    quarantine.log()
+
+
+def query_matrix(orig_xy, dest_xy, options):
+    '''
+    dict of metric: (orig x dest) matrix, nan where OSRM found no route
+    '''
+    matrices = {metric: np.full((len(orig_xy), len(dest_xy)), np.nan, dtype=np.float32) for metric in options['metrics']}
+    for tile, values in iter_tiles(orig_xy, dest_xy, options):
+        for metric in options['metrics']:
+            table_tiles.scatter(matrices[metric], tile, values[metric])
+    return matrices
+
+
+############## Read JSON ##############
+def tile_shape(tile):
+    '''
+    (sources, destinations) of a tile's response
+    '''
+    shape = (tile.orig_stop - tile.orig_start, tile.dest_stop - tile.dest_start)
+    return shape[::-1] if tile.transpose else shape
+
+
+def req(query_string, metrics, client=requests, shape=None, snaps=False):
+    '''
+    one table request, as a dict of metric: (sources x destinations) float32 array
+    server errors raise requests.HTTPError, rejected queries ValueError
+    '''
+    response = client.get(query_string)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return decode_table(response.content, metrics, shape, snaps)
+
+
+def decode_table(content, metrics, shape=None, snaps=False):
+    '''
+    decode a table response body into float32 arrays
+    the response rows are copied straight into preallocated buffers, with
+    unroutable pairs (null) becoming nan
+    snaps: also return the metres each source and destination was moved to
+    snap onto the network ('source_snap', 'destination_snap'); the url must
+    not skip waypoints
+    '''
+    response = json.loads(content)
+    if response.get('code') != 'Ok':
+        raise ValueError('OSRM table request failed: {}'.format(response.get('message', response.get('code'))))
+    values = {}
+    for metric in metrics:
+        rows = response['{}s'.format(metric)]
+        if shape is None:
+            shape = (len(rows), len(rows[0]) if rows else 0)
+        values[metric] = np.empty(shape, dtype=np.float32)
+        values[metric][...] = rows
+    if snaps:
+        for side in ('source', 'destination'):
+            values['{}_snap'.format(side)] = np.array([w['distance'] for w in response['{}s'.format(side)]], dtype=np.float32)
+    return values
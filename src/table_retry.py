@@ -0,0 +1,127 @@
+'''
+Fault-isolated table requests
+- transient failures (connection errors, timeouts, 5xx responses) are
+  retried with exponential backoff
+- a request OSRM rejects (4xx, ValueError) is split in half, recursively,
+  until the coordinates that fail are isolated; their pairs are left as nan
+  and the points are quarantined, so the rest of the run carries on
+- a request that still fails in transit after its retries stops the run:
+  the server is down, not a coordinate bad, and the tiles already written
+  are kept for resuming
+'''
+import time
+import threading
+import numpy as np
+import pandas as pd
+# functions - requests
+import requests
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Quarantine:
+    '''
+    points (by position in the queried origin/destination arrays) whose
+    requests failed, with the error
+    orig_ids, dest_ids: ids aligned with those arrays, for the report; an
+    element may be a list of ids (e.g. every block sharing a snapped point)
+    '''
+    def __init__(self, orig_ids=None, dest_ids=None):
+        self.orig_ids = orig_ids
+        self.dest_ids = dest_ids
+        # (side, position): error, side being 'orig', 'dest' or 'pair'
+        self.points = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, side, position, reason):
+        with self._lock:
+            self.points[(side, position)] = reason
+
+    def frame(self):
+        '''
+        the report: one row per quarantined point (side, id, reason)
+        '''
+        rows = []
+        for (side, position), reason in sorted(self.points.items(), key=str):
+            if side == 'pair':
+                ids = ['{}->{}'.format(self._ids('orig', position[0]), self._ids('dest', position[1]))]
+            else:
+                ids = np.atleast_1d(self._ids(side, position))
+            rows += [(side, str(i), reason) for i in ids]
+        return pd.DataFrame(rows, columns=['side', 'id', 'reason'])
+
+    def _ids(self, side, position):
+        ids = self.orig_ids if side == 'orig' else self.dest_ids
+        return position if ids is None else ids[position]
+
+    def log(self):
+        if self.points:
+            sides = pd.Series([side for side, position in self.points]).value_counts()
+            logger.warning('Quarantined after failed requests: {}'.format(sides.to_dict()))
+
+
+def retry(func, retries=3, backoff=1.0, run_metrics=None):
+    '''
+    func(), retried with exponential backoff while it fails in transit;
+    rejections by OSRM itself (ValueError) are raised straight away
+    run_metrics: a query_metrics.RunMetrics to count the retries in
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except requests.RequestException as error:
+            if attempt == retries:
+                raise
+            if run_metrics is not None:
+                run_metrics.retry()
+            wait = backoff * 2**attempt
+            logger.warning('Request failed ({}), retrying in {:.0f}s'.format(error, wait))
+            time.sleep(wait)
+
+
+def split(tile):
+    '''
+    halve a tile along its longer side; returns the halves and the side
+    '''
+    orig_n, dest_n = tile.orig_stop - tile.orig_start, tile.dest_stop - tile.dest_start
+    if orig_n >= dest_n:
+        mid = tile.orig_start + orig_n // 2
+        return tile._replace(orig_stop=mid), tile._replace(orig_start=mid), 'orig'
+    mid = tile.dest_start + dest_n // 2
+    return tile._replace(dest_stop=mid), tile._replace(dest_start=mid), 'dest'
+
+
+def resolve(tile, fetch, probe, shape, metrics, quarantine, retries=3, backoff=1.0, run_metrics=None):
+    '''
+    values of a tile, isolating whatever makes it fail
+    fetch(tile): the tile's values; probe(side, position): whether the point
+    can be queried on its own (raising if the server cannot be reached);
+    shape(tile): the (sources, destinations) of its response
+    '''
+    try:
+        return retry(lambda: fetch(tile), retries, backoff, run_metrics)
+    except requests.RequestException:
+        logger.error('Table requests still failing in transit after {} retries, stopping the run'.format(retries))
+        raise
+    except ValueError as error:
+        reason = str(error)
+    empty = {metric: np.full(shape(tile), np.nan, dtype=np.float32) for metric in metrics}
+    # a single point on either side may be the culprit
+    for side, start, stop in (('orig', tile.orig_start, tile.orig_stop), ('dest', tile.dest_start, tile.dest_stop)):
+        if stop - start == 1 and not probe(side, start):
+            quarantine.add(side, start, reason)
+            return empty
+    if tile.orig_stop - tile.orig_start == 1 and tile.dest_stop - tile.dest_start == 1:
+        # both points work on their own, only the pair fails
+        quarantine.add('pair', (tile.orig_start, tile.dest_start), reason)
+        return empty
+    first, second, side = split(tile)
+    # the response's rows are its sources
+    axis = 0 if (side == 'orig') != tile.transpose else 1
+    values = [resolve(half, fetch, probe, shape, metrics, quarantine, retries, backoff, run_metrics)
+              for half in (first, second)]
+    return {metric: np.concatenate([values[0][metric], values[1][metric]], axis=axis) for metric in metrics}
@@ -0,0 +1,145 @@
+'''
+Stream table query results into postgres with bounded memory
+- each tile is turned into long-format rows as soon as it arrives
+- rows are fed to a COPY running on a writer thread, so querying and
+  writing overlap (with a run manifest, each tile is committed on its own)
+- a bounded queue between the two keeps peak memory flat
+'''
+import io
+import queue
+import threading
+import numpy as np
+import pandas as pd
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+############## Rows ##############
+def tile_frame(tile, values, orig_ids, dest_ids, metrics, dest_cols=None):
+    '''
+    long-format rows (id_orig, id_dest, metrics..., dest_cols...) for one tile
+    dest_cols: dict of column name: array aligned with dest_ids (e.g. dest_type)
+    '''
+    orig_n = tile.orig_stop - tile.orig_start
+    dest_slice = slice(tile.dest_start, tile.dest_stop)
+    frame = pd.DataFrame({
+        'id_orig': np.repeat(orig_ids[tile.orig_start:tile.orig_stop], tile.dest_stop - tile.dest_start),
+        'id_dest': np.tile(dest_ids[dest_slice], orig_n),
+        })
+    for metric in metrics:
+        # responses are (sources x destinations); rows are origin-major
+        tile_values = values[metric].T if tile.transpose else values[metric]
+        frame[metric] = tile_values.ravel()
+    for column, col_values in (dest_cols or {}).items():
+        frame[column] = np.tile(col_values[dest_slice], orig_n)
+    return frame
+
+
+def tile_frames(tiles, orig_ids, dest_ids, metrics, dest_cols=None):
+    '''
+    lazily convert (tile, values) pairs from table_query.iter_tiles to
+    (tile, frame) pairs
+    '''
+    for tile, values in tiles:
+        yield tile, tile_frame(tile, values, orig_ids, dest_ids, metrics, dest_cols)
+
+
+############## COPY ##############
+class _QueueReader:
+    '''
+    file-like view of a queue of text chunks, for cursor.copy_from
+    psycopg2 sends whatever read() returns, so whole chunks are handed over
+    '''
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def read(self, size=-1):
+        chunk = self.chunks.get()
+        return '' if chunk is None else chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def copy_frames(frames, db, table_name, if_exists='replace', queue_size=8, manifest=None):
+    '''
+    write (tile, frame) pairs (frames with the same columns) to table_name
+    The COPY runs on a writer thread fed through a queue of at most queue_size
+    chunks, so frames are produced and written concurrently. Without a
+    manifest everything goes through one COPY; with a run_manifest.RunManifest
+    each tile is committed on its own, together with its manifest row.
+    Returns the number of rows written. The table is created from the first
+    frame, so with no frames at all it is not created (and with
+    if_exists='replace' an earlier run's table is dropped): check
+    table_exists before indexing it.
+    '''
+    chunks = queue.Queue(maxsize=queue_size)
+    conn = db['engine'].raw_connection()
+    cur = conn.cursor()
+    failure = []
+
+    def write():
+        try:
+            if manifest is None:
+                cur.copy_from(_QueueReader(chunks), table_name, null="") # null values become ''
+            else:
+                for tile, text, rows in iter(chunks.get, None):
+                    cur.copy_from(io.StringIO(text), table_name, null="")
+                    manifest.record(cur, tile, rows)
+                    conn.commit()
+        except Exception as e:
+            failure.append(e)
+            # keep draining so the producer is never blocked on a dead writer
+            while chunks.get() is not None:
+                pass
+
+    writer = None
+    rows = 0
+
+    def finish():
+        if writer is not None:
+            chunks.put(None)
+            writer.join()
+
+    try:
+        for tile, frame in frames:
+            if writer is None:
+                # create (or truncate) the table from the first frame's columns
+                frame.head(0).to_sql(table_name, db['engine'], if_exists=if_exists, index=False)
+                writer = threading.Thread(target=write, daemon=True)
+                writer.start()
+            output = io.StringIO()
+            frame.to_csv(output, sep='\t', header=False, index=False)
+            chunks.put(output.getvalue() if manifest is None else (tile, output.getvalue(), len(frame)))
+            rows += len(frame)
+            if failure:
+                break
+    except BaseException:
+        # a failed query must not commit partial rows
+        finish()
+        conn.rollback()
+        conn.close()
+        raise
+    finish()
+    if failure:
+        conn.rollback()
+        conn.close()
+        raise failure[0]
+    if writer is None:
+        logger.warning('No rows to write to "{}"'.format(table_name))
+        if if_exists == 'replace':
+            # an earlier run's rows are not this run's results
+            cur.execute('DROP TABLE IF EXISTS {};'.format(table_name))
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def table_exists(db, table_name):
+    '''
+    whether table_name exists (copy_frames leaves none when nothing was written)
+    '''
+    cur = db['con'].cursor()
+    cur.execute('SELECT to_regclass(%s);', (table_name,))
+    return cur.fetchone()[0] is not None
@@ -0,0 +1,70 @@
+'''
+Query a near-symmetric matrix of points against themselves by its upper triangle
+On the foot network A->B and B->A are (nearly) the same route, so only the
+tiles on and above the diagonal are queried and stored - the pairs with
+id_orig's position at or before id_dest's - and the lower triangle is
+mirrored when the matrix is read (create_view, access_matrix.load with
+symmetric=True). A sample of mirrored pairs is checked against the true
+reverse query and the asymmetry reported.
+'''
+import numpy as np
+import pandas as pd
+import table_tiles
+import table_query
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def plan(n, options):
+    return table_tiles.plan_symmetric(n, options['batch_limit'], options['max_table_size'])
+
+
+def upper_frames(frames):
+    '''
+    (tile, frame) pairs of symmetric tiles with the rows below the diagonal
+    dropped from diagonal tiles (each unordered pair is kept once)
+    '''
+    for tile, frame in frames:
+        if tile.orig_start == tile.dest_start:
+            n = tile.orig_stop - tile.orig_start
+            frame = frame[np.triu(np.ones((n, n), dtype=bool)).ravel()]
+        yield tile, frame
+
+
+def create_view(db, table_name, metrics):
+    '''
+    {table_name}_full: the stored pairs and their mirror images, the full
+    matrix as an unsymmetric run would have written it
+    '''
+    columns = ', '.join(metrics)
+    cursor = db['con'].cursor()
+    cursor.execute('DROP VIEW IF EXISTS {}_full;'.format(table_name))
+    cursor.execute('CREATE VIEW {0}_full AS SELECT id_orig, id_dest, {1} FROM {0} '
+                   'UNION ALL SELECT id_dest AS id_orig, id_orig AS id_dest, {1} FROM {0} WHERE id_orig <> id_dest;'.format(table_name, columns))
+    db['con'].commit()
+
+
+def spot_check(xy, ids, options, sample=50, seed=0):
+    '''
+    query a sample of sample x sample pairs in both directions and report how
+    far mirroring is off; returns the pairs (id_orig, id_dest, and each
+    metric forward, reverse and the relative difference)
+    '''
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(xy), size=min(2 * sample, len(xy)), replace=False)
+    a, b = picked[:len(picked) // 2], picked[len(picked) // 2:]
+    # not counted in the run's metrics
+    options = dict(options, run_metrics=None)
+    forward = table_query.query_matrix(xy[a], xy[b], options)
+    reverse = table_query.query_matrix(xy[b], xy[a], options)
+    df = pd.DataFrame({'id_orig': np.repeat(ids[a], len(b)), 'id_dest': np.tile(ids[b], len(a))})
+    for metric in options['metrics']:
+        there, back = forward[metric].ravel(), reverse[metric].T.ravel()
+        df[metric] = there
+        df['{}_reverse'.format(metric)] = back
+        df['{}_asymmetry'.format(metric)] = np.abs(there - back) / np.maximum(np.fmax(there, back), 1e-9)
+        error = df['{}_asymmetry'.format(metric)]
+        logger.info('Symmetry check, {} over {} pairs: median {:.1%}, p95 {:.1%}, max {:.1%} off the true reverse ({:.0f} mean absolute)'.format(
+            metric, error.notna().sum(), error.median(), error.quantile(0.95), error.max(), np.nanmean(np.abs(there - back))))
+    return df
@@ -0,0 +1,97 @@
+'''
+Plan origin x destination table requests as 2D tiles
+- both axes are split so no request exceeds the pair limit or the
+  server's --max-table-size
+- tile results are scattered back into the full matrix
+'''
+import math
+from collections import namedtuple
+
+# one table request: the origin and destination ranges it covers, and whether
+# the origins are sent as `destinations` (and the destinations as `sources`)
+Tile = namedtuple('Tile', ['orig_start', 'orig_stop', 'dest_start', 'dest_stop', 'transpose'])
+
+
+############## Planning ##############
+def tile_shape(orig_n, dest_n, batch_limit, max_table_size=100000):
+    '''
+    the (origins, destinations) per tile
+
+    Each request carries a+b coordinates for a*b pairs, so tiles are kept as
+    square as the axes allow; an axis shorter than the square side is sent
+    whole. Sizes are then evened out so the last tile is not a sliver.
+    '''
+    if orig_n == 0 or dest_n == 0:
+        # nothing to plan
+        return 1, 1
+    # osrm-routed rejects tables with sources*destinations > max_table_size^2
+    pair_limit = min(batch_limit, max_table_size**2)
+    side = math.isqrt(pair_limit)
+    if dest_n <= side:
+        dest_per = dest_n
+        orig_per = pair_limit // dest_per
+    elif orig_n <= side:
+        orig_per = orig_n
+        dest_per = pair_limit // orig_per
+    else:
+        orig_per = dest_per = side
+    orig_per = max(1, min(orig_per, orig_n, max_table_size))
+    dest_per = max(1, min(dest_per, dest_n, max_table_size))
+    # balance the tiles along each axis
+    orig_per = math.ceil(orig_n / math.ceil(orig_n / orig_per))
+    dest_per = math.ceil(dest_n / math.ceil(dest_n / dest_per))
+    return orig_per, dest_per
+
+
+def plan_tiles(orig_n, dest_n, batch_limit, max_table_size=100000, transpose=False):
+    '''
+    list of Tiles covering the orig_n x dest_n matrix
+
+    Tiles are ordered destination-major, so consecutive requests share a
+    destination range. With transpose (only valid for a network where
+    orig->dest equals dest->orig) the shorter side of each tile goes in
+    `sources`: MLD table searches are run per source.
+    '''
+    orig_per, dest_per = tile_shape(orig_n, dest_n, batch_limit, max_table_size)
+    tiles = []
+    for dest_start in range(0, dest_n, dest_per):
+        dest_stop = min(dest_start + dest_per, dest_n)
+        for orig_start in range(0, orig_n, orig_per):
+            orig_stop = min(orig_start + orig_per, orig_n)
+            swap = transpose and (dest_stop - dest_start) < (orig_stop - orig_start)
+            tiles.append(Tile(orig_start, orig_stop, dest_start, dest_stop, swap))
+    return tiles
+
+
+def plan_symmetric(n, batch_limit, max_table_size=100000):
+    '''
+    Tiles covering the upper triangle (diagonal included) of an n x n matrix
+    of points against themselves; the tiles are square, so the lower
+    triangle is the transpose of tiles already planned
+    '''
+    per = tile_shape(n, n, batch_limit, max_table_size)[0]
+    tiles = []
+    for dest_start in range(0, n, per):
+        dest_stop = min(dest_start + per, n)
+        for orig_start in range(0, dest_start + 1, per):
+            tiles.append(Tile(orig_start, min(orig_start + per, n), dest_start, dest_stop, False))
+    return tiles
+
+
+############## Scatter ##############
+def scatter(matrix, tile, values):
+    '''
+    write a tile's (sources x destinations) values into the orig x dest matrix
+    '''
+    if tile.transpose:
+        values = values.T
+    matrix[tile.orig_start:tile.orig_stop, tile.dest_start:tile.dest_stop] = values
+
+
+def shift(tile, orig_offset=0, dest_offset=0):
+    '''
+    the tile moved by the given origin and destination offsets, for tiles
+    planned over part of a larger matrix
+    '''
+    return tile._replace(orig_start=tile.orig_start + orig_offset, orig_stop=tile.orig_stop + orig_offset,
+                         dest_start=tile.dest_start + dest_offset, dest_stop=tile.dest_stop + dest_offset)
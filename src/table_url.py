@@ -0,0 +1,96 @@
+'''
+Build OSRM table service urls
+- coordinates formatted in bulk with NumPy, as text or polyline(6)
+- the destination set is serialised once and reused for every batch
+https://github.com/Project-OSRM/osrm-backend/blob/master/docs/http.md#table-service
+'''
+from functools import lru_cache
+from urllib.parse import quote
+import numpy as np
+
+# digits kept for each coordinate encoding
+precisions = {'text':6, 'polyline':5, 'polyline6':6}
+
+
+############## Coordinates ##############
+def format_coords(x, y, precision=6):
+    '''
+    'x,y;x,y;...' for arrays of lon/lat, formatted in one call
+    '''
+    coords = np.column_stack([x, y]).ravel()
+    template = ';'.join(['%.{0}f,%.{0}f'.format(precision)] * len(x))
+    return template % tuple(coords)
+
+
+def encode_polyline(x, y, precision=5, start=(0, 0)):
+    '''
+    Google polyline encoding of lon/lat arrays (lat,lon order, as OSRM expects)
+    start is the (x, y) the first delta is taken from, so a polyline can be
+    continued from the last point of another one
+    '''
+    factor = 10**precision
+    points = np.round(np.column_stack([y, x]) * factor).astype(np.int64)
+    origin = np.round(np.array([[start[1], start[0]]]) * factor).astype(np.int64)
+    deltas = np.diff(np.vstack([origin, points]), axis=0).ravel()
+    # zig-zag encode the sign into the lowest bit
+    values = (deltas << 1) ^ (deltas >> 63)
+    # split into 5 bit chunks, least significant first
+    shifts = 5 * np.arange(7)
+    chunks = (values[:, None] >> shifts) & 0x1f
+    lengths = 1 + ((values[:, None] >> shifts[1:]) > 0).sum(axis=1)
+    position = np.arange(7)
+    # every chunk but the last of each value carries the continuation bit
+    chunks |= (position < (lengths - 1)[:, None]) * 0x20
+    chars = (chunks + 63)[position < lengths[:, None]]
+    return chars.astype(np.uint8).tobytes().decode('ascii')
+
+
+@lru_cache(maxsize=64)
+def index_string(start, stop):
+    '''
+    '0;1;2;...' for the sources/destinations parameters
+    '''
+    return ';'.join(map(str, range(start, stop)))
+
+
+############## Url Builder ##############
+class TableUrlBuilder:
+    '''
+    table urls for a fixed set of destinations
+
+    The destinations are placed first in every url, so their coordinates and
+    the `destinations` parameter are serialised once; each batch of origins is
+    appended after them and addressed through `sources`.
+    '''
+    def __init__(self, osrm_url, transport_mode, dest_x, dest_y, metrics, encoding='text', skip_waypoints=True):
+        if encoding not in precisions:
+            raise ValueError('Unknown coordinate encoding: {}'.format(encoding))
+        self.encoding = encoding
+        self.precision = precisions[encoding]
+        self.base = osrm_url + '/table/v1/{}/'.format(transport_mode)
+        self.dest_n = len(dest_x)
+        self.options = '?annotations={}'.format(','.join(metrics))
+        if skip_waypoints:
+            # the snapped waypoints are not used and make up much of the response
+            self.options += '&skip_waypoints=true'
+        self.options += '&destinations=' + index_string(0, self.dest_n)
+        dest_x, dest_y = np.asarray(dest_x, dtype=float), np.asarray(dest_y, dtype=float)
+        if encoding == 'text':
+            self.dest_string = format_coords(dest_x, dest_y, self.precision)
+        else:
+            self.dest_string = encode_polyline(dest_x, dest_y, self.precision)
+            # origins continue the polyline from the last destination
+            self.last = (dest_x[-1], dest_y[-1])
+
+    def build(self, orig_x, orig_y):
+        '''
+        the url for one batch of origins
+        '''
+        orig_n = len(orig_x)
+        sources = '&sources=' + index_string(self.dest_n, self.dest_n + orig_n)
+        if self.encoding == 'text':
+            coords = self.dest_string + ';' + format_coords(orig_x, orig_y, self.precision)
+        else:
+            line = self.dest_string + encode_polyline(orig_x, orig_y, self.precision, start=self.last)
+            coords = '{}({})'.format(self.encoding, quote(line, safe=''))
+        return self.base + coords + self.options + sources
@@ -0,0 +1,158 @@
+'''
+Find origins OSRM routes badly from and query only them again
+A block centroid that snaps onto an isolated footway or a service road cut off
+from the rest of the network gets null (unreachable) or very roundabout
+routes to most destinations. These origins are counted while the run
+streams; afterwards each is tried from other points - the next nearest
+network points and a point on the block's surface - and, if one does better,
+its rows are replaced with that point's.
+'''
+import numpy as np
+import pandas as pd
+try:
+    import orjson as json
+except ImportError:
+    import json
+from table_tiles import Tile
+import table_query
+import table_stream
+import nearest_query
+import snap_dedup
+import osrm_client
+# functions - logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def bad_pairs(values, straight, max_circuity=4.0, min_straight=500):
+    '''
+    pairs that are unreachable (nan) or whose network distance is over
+    max_circuity times the straight line (only checked past min_straight metres)
+    straight: None when values are not distances
+    '''
+    bad = np.isnan(values)
+    if straight is not None:
+        bad |= (straight > min_straight) & (values > max_circuity * straight)
+    return bad
+
+
+def straight_line(orig_xyz, dest_xyz):
+    return nearest_query.great_circle(np.linalg.norm(orig_xyz - dest_xyz, axis=-1))
+
+
+class ReachCheck:
+    '''
+    per origin, the number of pairs seen and how many were bad (see bad_pairs)
+    metrics: the run's metrics; circuity is only checked on distance
+    '''
+    def __init__(self, orig_ids, orig_xy, dest_ids, dest_xy, metrics, max_circuity=4.0):
+        self.orig_index, self.dest_index = pd.Index(orig_ids), pd.Index(dest_ids)
+        self.orig_xyz = nearest_query.to_sphere(np.asarray(orig_xy, dtype=float))
+        self.dest_xyz = nearest_query.to_sphere(np.asarray(dest_xy, dtype=float))
+        self.metric = 'distance' if 'distance' in metrics else metrics[0]
+        self.max_circuity = max_circuity
+        self.pairs = np.zeros(len(self.orig_index))
+        self.bad = np.zeros(len(self.orig_index))
+
+    def add(self, frame):
+        orig = self.orig_index.get_indexer(frame['id_orig'].values)
+        dest = self.dest_index.get_indexer(frame['id_dest'].values)
+        straight = straight_line(self.orig_xyz[orig], self.dest_xyz[dest]) if self.metric == 'distance' else None
+        bad = bad_pairs(frame[self.metric].to_numpy(dtype=float), straight, self.max_circuity)
+        self.pairs += np.bincount(orig, minlength=len(self.pairs))
+        self.bad += np.bincount(orig, weights=bad, minlength=len(self.bad))
+
+    def watch(self, frames):
+        '''
+        pass (tile, frame) pairs through, counting each frame
+        '''
+        for tile, frame in frames:
+            self.add(frame)
+            yield tile, frame
+
+    def share(self):
+        return self.bad / np.maximum(self.pairs, 1)
+
+    def flagged(self, threshold=0.5):
+        '''
+        positions of the origins with more than threshold of their pairs bad
+        '''
+        return np.flatnonzero((self.pairs > 0) & (self.share() > threshold))
+
+
+############## Re-query ##############
+def candidates(xy, surface_xy, options, number=5):
+    '''
+    other points to query each origin from: its surface point (if given)
+    and the network points after the nearest
+    returns the origin position of each candidate and the candidates' (x, y)
+    '''
+    def fetch(point):
+        url = snap_dedup.nearest_url(options['url'], options['transport_mode'], point[0], point[1], number)
+        response = json.loads(client.get(url).content)
+        if response.get('code') != 'Ok':
+            return []
+        return [waypoint['location'] for waypoint in response.get('waypoints', [])[1:]]
+    with osrm_client.client(options) as client:
+        found = list(client.imap(fetch, list(map(tuple, xy))))
+    if surface_xy is not None:
+        found = [[tuple(surface)] + points for surface, points in zip(surface_xy, found)]
+    owner = np.repeat(np.arange(len(xy)), [len(points) for points in found])
+    return owner, np.array([p for points in found for p in points], dtype=float).reshape(-1, 2)
+
+
+class Requery:
+    '''
+    watches a run's frames (watch) and afterwards re-queries the origins that
+    came out badly from alternate points (run)
+    surface_xy: a point on each origin's block surface, or None
+    dest_cols: extra columns aligned with dest_ids, as for table_stream.tile_frame
+    '''
+    def __init__(self, orig_ids, orig_xy, surface_xy, dest_ids, dest_xy, options, dest_cols=None,
+                 threshold=0.5, max_circuity=4.0, number=5):
+        self.orig_ids, self.orig_xy = np.asarray(orig_ids), np.asarray(orig_xy, dtype=float)
+        self.surface_xy = None if surface_xy is None else np.asarray(surface_xy, dtype=float)
+        self.dest_ids, self.dest_xy = np.asarray(dest_ids), np.asarray(dest_xy, dtype=float)
+        self.options, self.dest_cols = options, dest_cols
+        self.threshold, self.number = threshold, number
+        self.check = ReachCheck(orig_ids, orig_xy, dest_ids, dest_xy, options['metrics'], max_circuity)
+
+    def watch(self, frames):
+        return self.check.watch(frames)
+
+    def run(self):
+        '''
+        the replacement rows (None if no origin improved) and a report of the
+        flagged origins: id, share of bad pairs before and after, and the
+        point used (x, y; nan where the origin was kept)
+        '''
+        flagged = self.check.flagged(self.threshold)
+        if len(flagged) == 0:
+            return None, None
+        logger.warning('{} origins have over {:.0%} of their pairs unreachable or circuitous, re-querying them from other points'.format(
+            len(flagged), self.threshold))
+        surface = None if self.surface_xy is None else self.surface_xy[flagged]
+        owner, cand_xy = candidates(self.orig_xy[flagged], surface, self.options, self.number)
+        report = pd.DataFrame({'id_orig': self.orig_ids[flagged], 'share_before': self.check.share()[flagged],
+                               'share_after': self.check.share()[flagged], 'x': np.nan, 'y': np.nan})
+        if len(cand_xy) == 0:
+            return None, report
+        values = table_query.query_matrix(cand_xy, self.dest_xy, self.options)
+        metric = self.check.metric
+        straight = straight_line(nearest_query.to_sphere(cand_xy)[:, None], self.check.dest_xyz[None]) if metric == 'distance' else None
+        share = bad_pairs(values[metric].astype(float), straight, self.check.max_circuity).mean(axis=1)
+        # the best candidate of each origin, kept if it beats the original point
+        order = np.lexsort((share, owner))
+        best = order[np.concatenate([[True], owner[order][1:] != owner[order][:-1]])]
+        better = best[share[best] < report['share_before'].values[owner[best]]]
+        if len(better) == 0:
+            logger.warning('No alternate point did better for any of them')
+            return None, report
+        rows = owner[better]
+        report.loc[rows, 'share_after'] = share[better]
+        report.loc[rows, 'x'], report.loc[rows, 'y'] = cand_xy[better, 0], cand_xy[better, 1]
+        logger.info('{} of {} origins re-queried from a better point'.format(len(better), len(flagged)))
+        tile = Tile(0, len(better), 0, len(self.dest_ids), False)
+        frame = table_stream.tile_frame(tile, {m: values[m][better] for m in self.options['metrics']},
+                                        self.orig_ids[flagged][rows], self.dest_ids, self.options['metrics'], self.dest_cols)
+        return frame, report